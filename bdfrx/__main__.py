@@ -10,6 +10,10 @@ from bdfrx import __version__
 from bdfrx.completion import Completion
 from bdfrx.configuration import Configuration
 from bdfrx.downloader import RedditDownloader
+from bdfrx.failure_retrier import FailureRetrier
+from bdfrx.hash_exporter import HashExporter
+from bdfrx.hashing import HASH_ALGORITHMS
+from bdfrx.rehasher import Rehasher
 
 logger = logging.getLogger()
 
@@ -52,17 +56,25 @@ _common_options = [
 ]
 
 _downloader_options = [
+    click.option("--engine", type=click.Choice(("async", "requests"), case_sensitive=False), default=None),
+    click.option("--hash-algorithm", type=click.Choice(HASH_ALGORITHMS, case_sensitive=False), default=None),
+    click.option("--import-hashes", type=str, multiple=True, default=None),
     click.option("--make-hard-links", is_flag=True, default=None),
+    click.option("--max-inflight-bytes", type=int, default=None),
+    click.option("--max-retries", type=int, default=None),
     click.option("--max-wait-time", type=int, default=None),
     click.option("--min-score", type=int, default=None),
     click.option("--max-score", type=int, default=None),
     click.option("--min-score-ratio", type=float, default=None),
     click.option("--max-score-ratio", type=float, default=None),
     click.option("--no-dupes", is_flag=True, default=None),
+    click.option("--queue-size", type=int, default=None),
     click.option("--search-existing", is_flag=True, default=None),
     click.option("--skip", multiple=True, default=None),
     click.option("--skip-domain", multiple=True, default=None),
     click.option("--skip-subreddit", multiple=True, default=None),
+    click.option("--stage-threads", type=str, multiple=True, default=None),
+    click.option("--threads", type=int, default=None),
 ]
 
 
@@ -123,6 +135,74 @@ def cli_download(context: click.Context, **_) -> None:
         logger.info(f"Program complete - BDFRx Downloader v{__version__}")
 
 
+@cli.command("retry-failed")
+@_add_options(_common_options)
+@_add_options(_downloader_options)
+@click.help_option("-h", "--help")
+@click.pass_context
+def cli_retry_failed(context: click.Context, **_) -> None:
+    """Downloads again the failed submissions in the database that are due to be retried."""
+    config = Configuration()
+    config.process_click_arguments(context)
+    silence_module_loggers()
+    stream = make_console_logging_handler(config.verbose)
+    try:
+        FailureRetrier(config, [stream]).download()
+    except Exception:
+        logger.exception(f"Failure retrier exited unexpectedly - BDFRx Failure Retrier v{__version__}")
+        raise
+    else:
+        logger.info(f"Program complete - BDFRx Failure Retrier v{__version__}")
+
+
+@cli.command("rehash")
+@click.option("--config", type=str, default=None)
+@click.option("--db-file", type=str, default=None)
+@click.option("--hash-algorithm", type=click.Choice(HASH_ALGORITHMS, case_sensitive=False), default=None)
+@click.option("--log", type=str, default=None)
+@click.option("-v", "--verbose", count=True, default=None)
+@click.help_option("-h", "--help")
+@click.pass_context
+def cli_rehash(context: click.Context, **_) -> None:
+    """Updates the hashes in the database to the chosen hash algorithm."""
+    config = Configuration()
+    config.process_click_arguments(context)
+    silence_module_loggers()
+    stream = make_console_logging_handler(config.verbose)
+    try:
+        Rehasher(config, [stream]).rehash()
+    except Exception:
+        logger.exception(f"Rehasher exited unexpectedly - BDFRx Rehasher v{__version__}")
+        raise
+    else:
+        logger.info(f"Program complete - BDFRx Rehasher v{__version__}")
+
+
+@cli.command("export-hashes")
+@click.argument("output_file", type=str)
+@click.option("--config", type=str, default=None)
+@click.option("--db-file", type=str, default=None)
+@click.option("--from-directory", type=str, default=None)
+@click.option("--hash-algorithm", type=click.Choice(HASH_ALGORITHMS, case_sensitive=False), default=None)
+@click.option("--log", type=str, default=None)
+@click.option("-v", "--verbose", count=True, default=None)
+@click.help_option("-h", "--help")
+@click.pass_context
+def cli_export_hashes(context: click.Context, **_) -> None:
+    """Writes the hashes in the database, or of the files in a directory, to a file for other instances to import."""
+    config = Configuration()
+    config.process_click_arguments(context)
+    silence_module_loggers()
+    stream = make_console_logging_handler(config.verbose)
+    try:
+        HashExporter(config, [stream]).export()
+    except Exception:
+        logger.exception(f"Hash exporter exited unexpectedly - BDFRx Hash Exporter v{__version__}")
+        raise
+    else:
+        logger.info(f"Program complete - BDFRx Hash Exporter v{__version__}")
+
+
 @cli.command("completion")
 @click.argument("shell", type=click.Choice(("all", "bash", "fish", "zsh"), case_sensitive=False), default="all")
 @click.help_option("-h", "--help")
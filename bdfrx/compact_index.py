@@ -0,0 +1,132 @@
+import os
+from array import array
+from pathlib import Path
+from typing import Optional
+
+
+class PathTable:
+    """Stores paths as numbers, keeping each directory once and the file names in one shared buffer
+
+    A path held this way takes the bytes of its name and twelve more, instead of the few hundred bytes of a Path
+    """
+
+    def __init__(self) -> None:
+        self._directories: list[str] = []
+        self._directory_ids: dict[str, int] = {}
+        self._names = bytearray()
+        self._name_ends = array("Q")
+        self._name_directories = array("I")
+
+    def __len__(self) -> int:
+        return len(self._name_ends)
+
+    def add(self, path: Path) -> int:
+        directory, name = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self._directory_ids[directory] = len(self._directories)
+            self._directories.append(directory)
+        self._names += os.fsencode(name)
+        self._name_ends.append(len(self._names))
+        self._name_directories.append(directory_id)
+        return len(self._name_ends) - 1
+
+    def __getitem__(self, path_id: int) -> Path:
+        start = self._name_ends[path_id - 1] if path_id else 0
+        name = os.fsdecode(bytes(self._names[start : self._name_ends[path_id]]))
+        return Path(self._directories[self._name_directories[path_id]], name)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            len(self._names)
+            + self._name_ends.itemsize * len(self._name_ends)
+            + self._name_directories.itemsize * len(self._name_directories)
+            + sum(len(directory) for directory in self._directories)
+        )
+
+
+class DigestTable:
+    """Maps byte strings of one length to numbers, in a flat open-addressing table instead of a dict of objects
+
+    The keys are kept side by side in one buffer and the values in an array, so an entry takes the length of its
+    key and four more bytes, divided by how full the table is
+    """
+
+    max_load = 0.75
+
+    def __init__(self, key_size: int, capacity: int = 1024) -> None:
+        self.key_size = key_size
+        self._count = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._keys = bytearray(capacity * self.key_size)
+        # Values are stored plus one, so that 0 marks an empty slot
+        self._values = array("I", bytes(4 * capacity))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _slot(self, key: bytes) -> int:
+        """The slot holding a key, or the empty slot it would go in"""
+        if len(key) != self.key_size:
+            raise ValueError(f"Key of {len(key)} bytes in a table of {self.key_size} byte keys")
+        keys, values, size, mask = self._keys, self._values, self.key_size, self._capacity - 1
+        slot = hash(key) & mask
+        while values[slot]:
+            start = slot * size
+            if keys[start : start + size] == key:
+                break
+            slot = (slot + 1) & mask
+        return slot
+
+    def get(self, key: bytes) -> Optional[int]:
+        if len(key) != self.key_size:
+            return None
+        value = self._values[self._slot(key)]
+        return value - 1 if value else None
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.get(key) is not None
+
+    def setdefault(self, key: bytes, value: int) -> int:
+        """Adds a key if it is not there already, returning the value it has"""
+        slot = self._slot(key)
+        if self._values[slot]:
+            return self._values[slot] - 1
+        self._put(slot, key, value)
+        return value
+
+    def __setitem__(self, key: bytes, value: int) -> None:
+        slot = self._slot(key)
+        if self._values[slot]:
+            self._values[slot] = value + 1
+        else:
+            self._put(slot, key, value)
+
+    def _put(self, slot: int, key: bytes, value: int) -> None:
+        self._keys[slot * self.key_size : (slot + 1) * self.key_size] = key
+        self._values[slot] = value + 1
+        self._count += 1
+        if self._count > self._capacity * self.max_load:
+            self._grow()
+
+    def _grow(self) -> None:
+        old_keys, old_values, size = self._keys, self._values, self.key_size
+        self._allocate(self._capacity * 2)
+        keys, values, mask = self._keys, self._values, self._capacity - 1
+        for old_slot, value in enumerate(old_values):
+            if value:
+                key = bytes(old_keys[old_slot * size : old_slot * size + size])
+                # Every key is different, so there is no need to compare them to find a free slot
+                slot = hash(key) & mask
+                while values[slot]:
+                    slot = (slot + 1) & mask
+                keys[slot * size : slot * size + size] = key
+                values[slot] = value
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._keys) + self._values.itemsize * len(self._values)
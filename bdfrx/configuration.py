@@ -10,7 +10,7 @@ logger = logging.getLogger(__name__)
 
 
 class Configuration(Namespace):
-    def __init__(self) -> None:
+    def __init__(self) -> None:  # noqa: PLR0915
         super().__init__()
         self.authenticate = False
         self.config = None
@@ -19,17 +19,23 @@ class Configuration(Namespace):
         self.directory: str = "."
         self.disable_module: list[str] = []
         self.downvoted: bool = False
+        self.engine: Optional[str] = None
         self.exclude_id = []
         self.exclude_id_file = []
         self.file_scheme: str = "{REDDITOR}_{TITLE}_{POSTID}"
         self.filename_restriction_scheme = None
+        self.hash_algorithm: Optional[str] = None
         self.folder_scheme: str = "{SUBREDDIT}"
+        self.from_directory: Optional[str] = None
         self.ignore_user = []
+        self.import_hashes: list[str] = []
         self.include_id_file = []
         self.limit: Optional[int] = None
         self.link: list[str] = []
         self.log: Optional[str] = None
         self.make_hard_links = False
+        self.max_inflight_bytes: Optional[int] = None
+        self.max_retries: Optional[int] = None
         self.max_wait_time = None
         self.min_score = None
         self.max_score = None
@@ -38,6 +44,8 @@ class Configuration(Namespace):
         self.multireddit: list[str] = []
         self.no_dupes: bool = False
         self.opts: Optional[str] = None
+        self.output_file: Optional[str] = None
+        self.queue_size: Optional[int] = None
         self.saved: bool = False
         self.search: Optional[str] = None
         self.search_existing: bool = False
@@ -45,10 +53,12 @@ class Configuration(Namespace):
         self.skip_domain: list[str] = []
         self.skip_subreddit: list[str] = []
         self.sort: str = "hot"
+        self.stage_threads: list[str] = []
         self.submitted: bool = False
         self.subscribed: bool = False
         self.subreddit: list[str] = []
         self.time: str = "all"
+        self.threads: Optional[int] = None
         self.time_format = None
         self.upvoted: bool = False
         self.user: list[str] = []
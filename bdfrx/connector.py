@@ -6,7 +6,6 @@ import logging.handlers
 import platform
 import re
 import shutil
-import sqlite3
 from abc import ABCMeta, abstractmethod
 from collections.abc import Callable, Iterable, Iterator
 from datetime import datetime
@@ -24,10 +23,16 @@ import prawcore
 from bdfrx import __version__
 from bdfrx import exceptions as errors
 from bdfrx.configuration import Configuration
+from bdfrx.database import Database
 from bdfrx.download_filter import DownloadFilter
+from bdfrx.existing_files import ExistingFileIndex
 from bdfrx.file_name_formatter import FileNameFormatter
+from bdfrx.hashing import get_hash_algorithm, set_hash_algorithm
 from bdfrx.oauth2 import OAuth2Authenticator, OAuth2TokenManager
+from bdfrx.scheduler import HostLimit, HostScheduler
 from bdfrx.site_authenticator import SiteAuthenticator
+from bdfrx.site_downloaders.download_factory import DownloadFactory
+from bdfrx.transport import Transport, create_transport, set_transport
 
 logger = logging.getLogger(__name__)
 
@@ -87,14 +92,18 @@ class RedditConnector(metaclass=ABCMeta):
 
         self.args.link = list(itertools.chain(self.args.link, self.read_id_files(self.args.include_id_file)))
 
-        self.master_hash_list = {}
+        self.master_hash_list = ExistingFileIndex()
         if self.args.db or self.args.db_file:
             self.args.db = True if not self.args.db else self.args.db
             logger.debug("DB option selected, setting no-dupes active")
             self.args.no_dupes = True
             self.load_db()
+            self.warn_outdated_hashes()
         self.authenticator = self.create_authenticator()
         logger.log(9, "Created site authenticator")
+        self.transport = self.create_transport()
+        set_transport(self.transport)
+        logger.log(9, "Created download transport")
 
         self.args.skip_subreddit = self.split_args_input(self.args.skip_subreddit)
         self.args.skip_subreddit = {sub.lower() for sub in self.args.skip_subreddit}
@@ -105,11 +114,36 @@ class RedditConnector(metaclass=ABCMeta):
         for handler in handlers:
             main_logger.addHandler(handler)
 
-    def read_config(self) -> None:
+    def read_config(self) -> None:  # noqa: PLR0912
         """Read any cfg values that need to be processed"""
         if self.args.max_wait_time is None:
             self.args.max_wait_time = self.cfg_parser.getint("DEFAULT", "max_wait_time", fallback=120)
             logger.debug(f"Setting maximum download wait time to {self.args.max_wait_time} seconds")
+        if self.args.max_retries is None:
+            self.args.max_retries = self.cfg_parser.getint("DEFAULT", "max_retries", fallback=3)
+            logger.debug(f"Setting maximum download retries to {self.args.max_retries}")
+        if self.args.max_inflight_bytes is None:
+            self.args.max_inflight_bytes = self.cfg_parser.getint("DEFAULT", "max_inflight_bytes", fallback=0)
+            logger.debug(f"Setting maximum bytes in flight to {self.args.max_inflight_bytes or 'unlimited'}")
+        if self.args.hash_algorithm is None:
+            self.args.hash_algorithm = self.cfg_parser.get("DEFAULT", "hash_algorithm", fallback="md5")
+        set_hash_algorithm(self.args.hash_algorithm)
+        logger.debug(f"Hashing files with {self.args.hash_algorithm}")
+        if not self.args.import_hashes:
+            self.args.import_hashes = [self.cfg_parser.get("DEFAULT", "import_hashes", fallback="")]
+        if self.args.engine is None:
+            self.args.engine = self.cfg_parser.get("DEFAULT", "engine", fallback="requests")
+            logger.debug(f"Setting download engine to {self.args.engine}")
+        if self.args.threads is None:
+            self.args.threads = self.cfg_parser.getint("DEFAULT", "threads", fallback=1)
+            logger.debug(f"Setting download threads to {self.args.threads}")
+        if self.args.threads < 1:
+            raise errors.BulkDownloaderException(f"Thread count must be at least 1, got {self.args.threads}")
+        if not self.args.stage_threads:
+            self.args.stage_threads = [self.cfg_parser.get("DEFAULT", "stage_threads", fallback="")]
+        if self.args.queue_size is None:
+            self.args.queue_size = self.cfg_parser.getint("DEFAULT", "queue_size", fallback=100)
+            logger.debug(f"Setting download stage queue size to {self.args.queue_size}")
         if self.args.time_format is None:
             option = self.cfg_parser.get("DEFAULT", "time_format", fallback="ISO")
             if re.match(r"^[\s\'\"]*$", option):
@@ -227,12 +261,12 @@ class RedditConnector(metaclass=ABCMeta):
         if self.args.db_file:
             if (db_path := Path(self.args.db_file)).exists():
                 logger.debug(f"Loading DB from {self.args.db_file}")
-                self.db = sqlite3.connect(db_path)
+                self.db = Database(db_path)
                 return
             with importlib.resources.path("bdfrx", "bdfrx.db") as path:
                 logger.info(f"DB not found at {self.args.db_file} loading clean DB")
                 shutil.copy(path, Path(self.args.db_file))
-                self.db = sqlite3.connect(self.args.db_file)
+                self.db = Database(self.args.db_file)
                 return
         possible_paths = [
             Path("./bdfrx.db"),
@@ -242,14 +276,31 @@ class RedditConnector(metaclass=ABCMeta):
         for path in possible_paths:
             if path.resolve().expanduser().exists():
                 logger.debug(f"Loading DB from {path}")
-                self.db = sqlite3.connect(path)
+                self.db = Database(path)
                 break
         if not self.db:
             with importlib.resources.path("bdfrx", "bdfrx.db") as path:
                 db_path = Path(self.config_directory, "bdfrx.db")
                 logger.info(f"No DB found, loading clean DB to {db_path}")
                 shutil.copy(path, Path(self.config_directory, "bdfrx.db"))
-                self.db = sqlite3.connect(db_path)
+                self.db = Database(db_path)
+
+    def warn_outdated_hashes(self) -> None:
+        """Warn about hashes in the DB that were made with another algorithm
+
+        Only the rows of other algorithms are counted, from the index on the algorithm, so a DB with none of them is
+        not scanned. The schema itself is brought up to date when the DB is loaded
+        """
+        algorithm = get_hash_algorithm()
+        outdated = self.db.query(
+            "SELECT COUNT(*) FROM download WHERE (algorithm < ? OR algorithm > ?) AND hash IS NOT NULL;",
+            (algorithm, algorithm),
+        ).fetchone()[0]
+        if outdated:
+            logger.warning(
+                f"{outdated} hashes in the DB were not made with {algorithm} and will not match new downloads,"
+                " run 'bdfrx rehash' to update them",
+            )
 
     def create_file_logger(self) -> logging.handlers.RotatingFileHandler:
         if self.args.log is None:
@@ -475,6 +526,35 @@ class RedditConnector(metaclass=ABCMeta):
     def create_authenticator(self) -> SiteAuthenticator:
         return SiteAuthenticator(self.cfg_parser)
 
+    def create_transport(self) -> Transport:
+        pool_size = self.cfg_parser.getint("DEFAULT", "pool_size", fallback=10)
+        engine_options = {}
+        if self.args.engine.lower() == "async":
+            engine_options["max_tasks"] = self.cfg_parser.getint("DEFAULT", "async_tasks", fallback=256)
+        return create_transport(
+            self.args.engine,
+            pool_size=pool_size,
+            pool_hosts=self.cfg_parser.getint("DEFAULT", "pool_hosts", fallback=100),
+            retries=self.cfg_parser.getint("DEFAULT", "http_retries", fallback=2),
+            timeout=self.cfg_parser.getfloat("DEFAULT", "http_timeout", fallback=16),
+            scheduler=self.create_scheduler(pool_size),
+            segments=self.cfg_parser.getint("DEFAULT", "segments", fallback=4),
+            segment_threshold=self.cfg_parser.getint("DEFAULT", "segment_threshold", fallback=32) * 1024 * 1024,
+            **engine_options,
+        )
+
+    def create_scheduler(self, default_in_flight: int) -> HostScheduler:
+        limits = DownloadFactory.host_limits()
+        limits.update(HostScheduler.parse_limits([self.cfg_parser.get("DEFAULT", "host_limits", fallback="")]))
+        for host, limit in sorted(limits.items()):
+            logger.log(9, f"Limiting {host} to {limit.max_in_flight} requests in flight, {limit.rate or 'unlimited'}/s")
+        return HostScheduler(
+            limits,
+            default_limit=HostLimit(default_in_flight),
+            adaptive=self.cfg_parser.getboolean("DEFAULT", "adaptive_concurrency", fallback=True),
+            max_penalty=self.cfg_parser.getfloat("DEFAULT", "max_retry_after", fallback=300),
+        )
+
     @abstractmethod
     def download(self) -> None:
         pass
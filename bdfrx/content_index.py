@@ -0,0 +1,104 @@
+import logging
+import re
+import urllib.parse
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import requests
+
+from bdfrx.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def total_length(response: requests.Response) -> Optional[int]:
+    """The size of the whole file a response is for, even if it only holds a range of it"""
+    if match := re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", "")):
+        return int(match.group(1))
+    if response.headers.get("Content-Length", "").isdigit():
+        return int(response.headers["Content-Length"])
+    return None
+
+
+class ResponseMetadata(NamedTuple):
+    """The headers of a response that identify its content before the body is read"""
+
+    url: str
+    etag: Optional[str]
+    size: Optional[int]
+    last_modified: Optional[str]
+
+    @property
+    def host(self) -> str:
+        return (urllib.parse.urlsplit(self.url).hostname or "").lower()
+
+    @property
+    def strong_etag(self) -> Optional[str]:
+        # A weak entity tag only says that two responses are equivalent, not that they are the same bytes
+        return self.etag if self.etag and not self.etag.startswith("W/") else None
+
+    @staticmethod
+    def from_response(url: str, response: requests.Response) -> "ResponseMetadata":
+        return ResponseMetadata(
+            url,
+            response.headers.get("ETag"),
+            total_length(response),
+            response.headers.get("Last-Modified"),
+        )
+
+
+class ContentIndex:
+    """Finds content that has already been downloaded from the headers of a response, before its body is read
+
+    Files are recorded by the host and entity tag of the response they came from, and by its URL, size and
+    modification time. Most image hosts give the same entity tag to the same content under any URL, so a repost
+    is recognised from its headers alone. A file is only returned while it is still there at the same size
+
+    With a database, the records are also kept in it so they are used again by later runs
+    """
+
+    def __init__(self, db: Optional[Database] = None) -> None:
+        self.db = db
+        self._by_etag: dict[tuple[str, str], Path] = {}
+        self._by_url: dict[tuple[str, int, str], Path] = {}
+
+    def add(self, metadata: ResponseMetadata, path: Path) -> None:
+        etag = metadata.strong_etag
+        has_validators = metadata.size is not None and metadata.last_modified
+        if etag:
+            self._by_etag[(metadata.host, etag)] = path
+        if has_validators:
+            self._by_url[(metadata.url, metadata.size, metadata.last_modified)] = path
+        if self.db is not None and (etag or has_validators):
+            self.db.write(
+                "INSERT OR REPLACE INTO content_metadata (url, host, etag, size, last_modified, path) "
+                "VALUES (?, ?, ?, ?, ?, ?);",
+                (metadata.url, metadata.host, etag, metadata.size, metadata.last_modified, str(path)),
+            )
+
+    def find(self, metadata: ResponseMetadata) -> Optional[Path]:
+        for path in self._candidates(metadata):
+            try:
+                size = path.stat().st_size
+            except OSError:
+                size = None
+            if size is not None and metadata.size in (None, size):
+                return path
+            logger.log(9, f"File {path} recorded for {metadata.url} has been moved or changed")
+        return None
+
+    def _candidates(self, metadata: ResponseMetadata) -> list[Path]:
+        candidates = []
+        etag = metadata.strong_etag
+        if etag and (path := self._by_etag.get((metadata.host, etag))):
+            candidates.append(path)
+        if path := self._by_url.get((metadata.url, metadata.size, metadata.last_modified)):
+            candidates.append(path)
+        if self.db is not None:
+            rows = self.db.query(
+                "SELECT path FROM content_metadata WHERE (host=? AND etag=?) "
+                "OR (url=? AND size=? AND last_modified=?);",
+                (metadata.host, etag, metadata.url, metadata.size, metadata.last_modified),
+            )
+            candidates.extend(Path(row[0]) for row in rows)
+        return candidates
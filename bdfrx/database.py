@@ -0,0 +1,171 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Union
+
+from bdfrx.schema import upgrade_schema
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Write(NamedTuple):
+    sql: str
+    parameters: Sequence[Any]
+    many: bool
+    size: int
+
+
+class Database:
+    """The SQLite database, written by one thread of its own and read on a connection per thread
+
+    Writes are queued and return at once. The writer thread runs them in a transaction that is committed every
+    batch_size writes, or batch_interval seconds after the first write in it, so downloads do not wait on the disk.
+    A write waits while a full batch is still to be committed, so a crash loses no more than the last batch.
+
+    Reads see every committed write. The database is kept in WAL mode, so readers never wait on the writer or on each
+    other. Each connection keeps the statements it has run prepared, so repeated queries are not parsed again. The
+    schema is brought up to date when the database is opened
+    """
+
+    batch_size = 500
+    batch_interval = 1.0
+    cache_size_kib = 16384
+    mmap_size = 256 * 2**20
+    cached_statements = 256
+
+    def __init__(
+        self,
+        path: Union[Path, str],
+        batch_size: Optional[int] = None,
+        batch_interval: Optional[float] = None,
+    ) -> None:
+        self.path = Path(path)
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if batch_interval is not None:
+            self.batch_interval = batch_interval
+        self._connection = self._connect()
+        journal_mode = self._connection.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            logger.warning(f"Could not use WAL mode for the DB at {self.path}, readers may wait on writes")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        upgrade_schema(self._connection, self.path)
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        # The number of writes queued or in the open transaction
+        self._pending = 0
+        self._space = threading.Condition()
+        self._queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are begun and committed by hand, and every connection may be closed by whoever closes the DB
+        connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.cached_statements,
+        )
+        connection.execute(f"PRAGMA cache_size=-{self.cache_size_kib};")
+        connection.execute(f"PRAGMA mmap_size={self.mmap_size};")
+        return connection
+
+    def query(self, sql: str, parameters: Sequence[Any] = ()) -> sqlite3.Cursor:
+        """Runs a read on the calling thread's connection"""
+        return self._reader().execute(sql, parameters)
+
+    def _reader(self) -> sqlite3.Connection:
+        reader = getattr(self._local, "connection", None)
+        if reader is None:
+            reader = self._connect()
+            reader.execute("PRAGMA query_only=ON;")
+            self._local.connection = reader
+            with self._readers_lock:
+                self._readers.append(reader)
+        return reader
+
+    def write(self, sql: str, parameters: Sequence[Any] = ()) -> None:
+        self._put(_Write(sql, parameters, many=False, size=1))
+
+    def write_many(self, sql: str, rows: Iterable[Sequence[Any]]) -> None:
+        rows = list(rows)
+        if rows:
+            self._put(_Write(sql, rows, many=True, size=len(rows)))
+
+    def _put(self, write: _Write) -> None:
+        with self._space:
+            while self._pending and self._pending + write.size > self.batch_size:
+                self._space.wait()
+            self._pending += write.size
+        self._queue.put(write)
+
+    def commit(self) -> None:
+        """Waits until every write made so far has been committed"""
+        if self._writer.is_alive():
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait()
+
+    def close(self) -> None:
+        """Commits the writes made so far and closes every connection"""
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+            self._connection.close()
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+
+    def _write_loop(self) -> None:
+        batch = 0
+        deadline = 0.0
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+            except queue.Empty:
+                item = None
+            if isinstance(item, _Write):
+                if not batch:
+                    self._connection.execute("BEGIN;")
+                    deadline = time.monotonic() + self.batch_interval
+                self._apply(item)
+                batch += item.size
+                if batch < self.batch_size:
+                    continue
+            if batch:
+                self._commit(batch)
+                batch = 0
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is _STOP:
+                return
+
+    def _apply(self, write: _Write) -> None:
+        try:
+            if write.many:
+                self._connection.executemany(write.sql, write.parameters)
+            else:
+                self._connection.execute(write.sql, write.parameters)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write to the DB with {write.sql!r}: {e}")
+
+    def _commit(self, size: int) -> None:
+        try:
+            self._connection.execute("COMMIT;")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to commit {size} writes to the DB: {e}")
+            with contextlib.suppress(sqlite3.Error):
+                self._connection.execute("ROLLBACK;")
+        with self._space:
+            self._pending -= size
+            self._space.notify_all()
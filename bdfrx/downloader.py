@@ -1,14 +1,16 @@
-import hashlib
 import logging.handlers
 import os
-import sqlite3
+import random
+import re
+import threading
 import time
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future
 from datetime import datetime
-from multiprocessing import Pool
+from enum import Enum, auto
+from functools import partial
 from pathlib import Path
-from time import sleep
-from typing import Union
+from typing import Any, NamedTuple, Optional, Union
 
 import praw
 import praw.exceptions
@@ -18,64 +20,248 @@ import prawcore
 from bdfrx import exceptions as errors
 from bdfrx.configuration import Configuration
 from bdfrx.connector import RedditConnector
+from bdfrx.content_index import ContentIndex, ResponseMetadata
+from bdfrx.database import Database
+from bdfrx.existing_files import ExistingFileIndex, FileHasher, sample_bytes, sample_file, walk_files
+from bdfrx.failure_ledger import FailureLedger
+from bdfrx.hashing import get_hash_algorithm
+from bdfrx.known_submissions import DownloadRecord, KnownItems, KnownSubmissions
+from bdfrx.negative_cache import NO_RESOURCES, NegativeCache, is_dead_link
+from bdfrx.pipeline import ByteBudget, Pipeline, RetryLater, Stage
+from bdfrx.resource import Resource
+from bdfrx.scan_cache import FileKey, ScanCache
+from bdfrx.shared_hashes import SharedHashSet
 from bdfrx.site_downloaders.download_factory import DownloadFactory
+from bdfrx.transport import AsyncTransport
 
 logger = logging.getLogger(__name__)
 
 
-def _calc_hash(existing_file: Path) -> tuple[Path, str]:
-    chunk_size = 1024 * 1024
-    md5_hash = hashlib.md5(usedforsecurity=False)
-    with existing_file.open("rb") as file:
-        chunk = file.read(chunk_size)
-        while chunk:
-            md5_hash.update(chunk)
-            chunk = file.read(chunk_size)
-    file_hash = md5_hash.hexdigest()
-    return existing_file, file_hash
+class SubmissionJob:
+    """Tracks the resources of one submission as they move through the download stages"""
+
+    def __init__(self, submission: praw.models.Submission, downloader_name: str) -> None:
+        self.submission = submission
+        self.downloader_name = downloader_name
+        self.stopped = False
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def add_resources(self, count: int) -> None:
+        with self._lock:
+            self._pending += count
+
+    def stop(self) -> None:
+        self.stopped = True
+
+    def finish_resource(self) -> bool:
+        """Returns True when the last resource of a job that was not stopped has finished"""
+        with self._lock:
+            self._pending -= 1
+            return self._pending == 0 and not self.stopped
+
+
+class StoreOutcome(Enum):
+    WRITTEN = auto()
+    # Already downloaded, as a duplicate of a stored file or a hard link to one
+    DUPLICATE = auto()
+    FAILED = auto()
+
+
+class ResourceTask(NamedTuple):
+    job: SubmissionJob
+    destination: Path
+    resource: Resource
+    attempt: int = 0
+
+
+class ResolveTask(NamedTuple):
+    submission: praw.models.Submission
+    attempt: int = 0
+
+
+class ListingTask(NamedTuple):
+    listing: Iterable[praw.models.Submission]
+    attempt: int = 0
+    last_id: Optional[str] = None
 
 
 class RedditDownloader(RedditConnector):
+    pipeline_stages = ("listing", "filter", "resolve", "fetch", "write")
+    listing_page_size = 100
+    retry_base_delay = 15
+
     def __init__(self, args: Configuration, logging_handlers: Iterable[logging.Handler] = ()) -> None:
         super().__init__(args, logging_handlers)
+        self.state_lock = threading.RLock()
+        self.stage_threads = self.determine_stage_threads()
+        self.byte_budget = ByteBudget(self.args.max_inflight_bytes)
+        self.content_index = ContentIndex(self.db if self.args.db else None)
+        self.negative_cache = self.create_negative_cache()
+        if self.args.db:
+            self.known_submissions = KnownSubmissions(self.db)
+            # Hashes written in this run, which the DB may not have committed yet
+            self.stored_hashes: dict[str, str] = {}
+            self.failure_ledger = FailureLedger(self.db)
+        hash_files = {path.strip() for entry in self.args.import_hashes for path in re.split(r"[,;]", entry)}
+        self.shared_hashes = [SharedHashSet(Path(path).expanduser()) for path in sorted(hash_files) if path]
         if self.args.search_existing:
-            if self.args.db:
-                self.scan_existing_files(self.download_directory, db=self.db)
-            else:
-                self.master_hash_list = self.scan_existing_files(self.download_directory)
+            scan_cache = ScanCache(Path(self.config_directory, "scan_cache.db"))
+            scan_threads = self.cfg_parser.getint("DEFAULT", "scan_threads", fallback=15)
+            try:
+                if self.args.db:
+                    self.scan_existing_files(self.download_directory, self.db, scan_cache, scan_threads)
+                else:
+                    self.master_hash_list = self.scan_existing_files(self.download_directory, cache=scan_cache)
+            finally:
+                scan_cache.close()
+
+    def determine_stage_threads(self) -> dict[str, int]:
+        stage_threads = dict.fromkeys(self.pipeline_stages, 1)
+        stage_threads["resolve"] = stage_threads["fetch"] = self.args.threads
+        split_pattern = re.compile(r"[,;]\s?")
+        for entry in self.args.stage_threads:
+            for setting in filter(None, split_pattern.split(entry)):
+                name, _, count = setting.partition("=")
+                name = name.strip().lower()
+                if name not in stage_threads:
+                    raise errors.BulkDownloaderException(f"Unknown download stage {name!r} in {setting!r}")
+                try:
+                    stage_threads[name] = int(count)
+                except ValueError:
+                    raise errors.BulkDownloaderException(f"Could not read thread count in {setting!r}")
+                if stage_threads[name] < 1:
+                    raise errors.BulkDownloaderException(f"Stage {name} must have at least 1 thread")
+        logger.debug(f"Download stage threads: {', '.join(f'{k}={v}' for k, v in stage_threads.items())}")
+        return stage_threads
+
+    def create_negative_cache(self) -> Optional[NegativeCache]:
+        if not self.cfg_parser.getboolean("DEFAULT", "negative_cache", fallback=True):
+            return None
+        ttls = NegativeCache.parse_ttls([self.cfg_parser.get("DEFAULT", "negative_cache_ttls", fallback="")])
+        return NegativeCache(Path(self.config_directory, "negative_cache.db"), ttls)
+
+    def create_pipeline(self) -> Pipeline:
+        functions = {
+            "listing": self._list_submissions,
+            "filter": self._filter_page,
+            "resolve": self._resolve_submission,
+            "fetch": self._fetch_resource,
+            "write": self._write_resource,
+        }
+        stages = [Stage(name, functions[name], self.stage_threads[name]) for name in self.pipeline_stages]
+        return Pipeline(stages, queue_size=self.args.queue_size)
 
     def download(self) -> None:
-        for generator in self.reddit_lists:
-            try:
-                for submission in generator:
-                    try:
-                        self._download_submission(submission)
-                    except prawcore.PrawcoreException as e:
-                        logger.error(f"Submission {submission.id} failed to download due to a PRAW exception: {e}")
-            except prawcore.PrawcoreException as e:
-                logger.error(f"The submission after {submission.id} failed to download due to a PRAW exception: {e}")
-                logger.debug("Waiting 60 seconds to continue")
-                sleep(60)
+        try:
+            self.create_pipeline().run(self.reddit_lists)
+        finally:
+            self.transport.close()
+            if self.negative_cache:
+                self.negative_cache.close()
             if self.args.db:
-                self.db.commit()
-        if self.args.db:
-            self.db.commit()
-            self.db.close()
+                self.db.close()
 
-    def _download_submission(self, submission: praw.models.Submission) -> None:  # noqa: PLR0911,PLR0912,PLR0915
-        if self.args.db:
-            if self.db.execute("SELECT post_id FROM post_id WHERE post_id=?;", (submission.id,)).fetchone():
-                logger.debug(f"Object {submission.id} in the DB, skipping")
-                return
-            if self.db.execute("SELECT link FROM link WHERE link=?;", (submission.url,)).fetchone():
-                logger.debug(f"Submission {submission.id} link exists in the DB, skipping")
-                return
+    def _download_submission(self, submission: praw.models.Submission) -> None:
+        """Runs a single submission through every stage in the current thread, waiting in place to retry"""
+        for accepted in self._filter_submission(submission):
+            for task in self._until_done(self._resolve_submission, accepted):
+                for fetched in self._until_done(self._fetch_resource, task):
+                    self._write_resource(fetched)
+
+    @staticmethod
+    def _until_done(function: Callable[[Any], Union[list, Future]], item: Any) -> list:  # noqa: ANN401
+        while True:
+            try:
+                results = function(item)
+                return results.result() if isinstance(results, Future) else results
+            except RetryLater as e:  # noqa: PERF203
+                time.sleep(e.delay)
+                item = e.item
+
+    def retry_delay(self, attempt: int, minimum: float = 0) -> float:
+        """Exponential backoff with jitter, capped by the maximum wait time"""
+        delay = min(self.args.max_wait_time, self.retry_base_delay * 2**attempt)
+        return max(minimum, random.uniform(delay / 2, delay))  # noqa: S311
+
+    def _list_submissions(
+        self,
+        task: Union[ListingTask, Iterable[praw.models.Submission]],
+    ) -> Iterator[list[praw.models.Submission]]:
+        """Yields the submissions of a listing in pages, so that they can be checked against the DB together"""
+        if not isinstance(task, ListingTask):
+            task = ListingTask(task)
+        last_id = task.last_id
+        page = []
+        try:
+            for submission in task.listing:
+                last_id = submission.id
+                page.append(submission)
+                if len(page) >= self.listing_page_size:
+                    yield page
+                    page = []
+        except prawcore.PrawcoreException as e:
+            logger.error(f"The submission after {last_id} failed to download due to a PRAW exception: {e}")
+            if page:
+                yield page
+                page = []
+            if task.attempt < self.args.max_retries:
+                # A listing generator that raised keeps its place, so it carries on from the failed page
+                delay = self.retry_delay(task.attempt)
+                logger.debug(f"Retrying listing in {delay:.0f} seconds")
+                raise RetryLater(ListingTask(task.listing, task.attempt + 1, last_id), delay)
+        if page:
+            yield page
+
+    def _filter_submission(self, submission: praw.models.Submission) -> list[praw.models.Submission]:
+        return self._filter_page([submission])
+
+    def _filter_page(self, page: list[praw.models.Submission]) -> list[praw.models.Submission]:
+        known = self._find_known_submissions(page)
+        accepted = []
+        for submission in page:
+            try:
+                if self._check_submission(submission, known):
+                    accepted.append(submission)
+            except prawcore.PrawcoreException as e:  # noqa: PERF203
+                logger.error(f"Submission {submission.id} failed to download due to a PRAW exception: {e}")
+                self._record_failure(submission.id, "", None, e)
+        return accepted
+
+    def _find_known_submissions(self, page: list[praw.models.Submission]) -> KnownItems:
+        if not self.args.db:
+            return KnownItems(set(), set())
+        links = []
+        for submission in page:
+            try:
+                links.append(submission.url)
+            except prawcore.PrawcoreException:  # noqa: PERF203
+                # Raised again when the submission is checked, where it is logged
+                continue
+        return self.known_submissions.find((submission.id for submission in page), links)
+
+    def _check_submission(  # noqa: PLR0911
+        self,
+        submission: praw.models.Submission,
+        known: Optional[KnownItems] = None,
+    ) -> bool:
+        if known is None:
+            known = self._find_known_submissions([submission])
+        if submission.id in known.post_ids:
+            logger.debug(f"Object {submission.id} in the DB, skipping")
+            return False
+        if submission.url in known.links:
+            logger.debug(f"Submission {submission.id} link exists in the DB, skipping")
+            return False
+        if self.args.db and self.failure_ledger.given_up(submission.id):
+            logger.debug(f"Submission {submission.id} failed before and is not to be tried again, skipping")
+            return False
         if submission.id in self.excluded_submission_ids:
             logger.debug(f"Object {submission.id} in exclusion list, skipping")
-            return
+            return False
         if submission.subreddit.display_name.lower() in self.args.skip_subreddit:
             logger.debug(f"Submission {submission.id} in {submission.subreddit.display_name} in skip list")
-            return
+            return False
         if (submission.author and submission.author.name in self.args.ignore_user) or (
             submission.author is None and "DELETED" in self.args.ignore_user
         ):
@@ -85,45 +271,74 @@ class RedditDownloader(RedditConnector):
                     f" due to {submission.author.name if submission.author else 'DELETED'} being an ignored user"
                 ),
             )
-            return
+            return False
         if self.args.min_score and submission.score < self.args.min_score:
             logger.debug(
                 f"Submission {submission.id} filtered due to score {submission.score} < [{self.args.min_score}]",
             )
-            return
+            return False
         if self.args.max_score and self.args.max_score < submission.score:
             logger.debug(
                 f"Submission {submission.id} filtered due to score {submission.score} > [{self.args.max_score}]",
             )
-            return
+            return False
         if (self.args.min_score_ratio and submission.upvote_ratio < self.args.min_score_ratio) or (
             self.args.max_score_ratio and self.args.max_score_ratio < submission.upvote_ratio
         ):
             logger.debug(f"Submission {submission.id} filtered due to score ratio ({submission.upvote_ratio})")
-            return
+            return False
         if not isinstance(submission, praw.models.Submission):
             logger.warning(f"{submission.id} is not a submission")
-            return
+            return False
         if not self.download_filter.check_url(submission.url):
             logger.debug(f"Submission {submission.id} filtered due to URL {submission.url}")
-            return
+            return False
+        return True
 
+    def _resolve_submission(  # noqa: PLR0911,PLR0912
+        self,
+        task: Union[ResolveTask, praw.models.Submission],
+    ) -> list[ResourceTask]:
+        if not isinstance(task, ResolveTask):
+            task = ResolveTask(task)
+        submission = task.submission
         logger.debug(f"Attempting to download submission {submission.id}")
+        if self.negative_cache and (cached := self.negative_cache.get(submission.url)):
+            logger.debug(f"Submission {submission.id} link {submission.url} failed before, skipping: {cached.message}")
+            return []
         try:
             downloader_class = DownloadFactory.pull_lever(submission.url)
             downloader = downloader_class(submission)
             logger.debug(f"Using {downloader_class.__name__} with url {submission.url}")
         except errors.NotADownloadableLinkError as e:
             logger.error(f"Could not download submission {submission.id}: {e}")
-            return
+            self._record_failure(submission.id, submission.url, None, e)
+            if self.negative_cache:
+                # No module handles the link, which only changes with an upgrade that empties the cache
+                self.negative_cache.add(submission.url, type(e).__name__, str(e))
+            return []
+        except errors.RetryableDownloadError as e:
+            return self._retry_resolve(task, None, e)
         if downloader_class.__name__.lower() in self.args.disable_module:
             logger.debug(f"Submission {submission.id} skipped due to disabled module {downloader_class.__name__}")
-            return
+            return []
         try:
             content = downloader.find_resources(self.authenticator)
         except errors.SiteDownloaderError as e:
             logger.error(f"Site {downloader_class.__name__} failed to download submission {submission.id}: {e}")
-            return
+            self._record_failure(submission.id, submission.url, downloader_class.__name__, e)
+            self._cache_dead_link(submission.url, e)
+            return []
+        except errors.RetryableDownloadError as e:
+            return self._retry_resolve(task, downloader_class.__name__, e)
+        except prawcore.PrawcoreException as e:
+            logger.error(f"Submission {submission.id} failed to download due to a PRAW exception: {e}")
+            self._record_failure(submission.id, submission.url, downloader_class.__name__, e)
+            return []
+        if not content and self.negative_cache:
+            self.negative_cache.add(submission.url, NO_RESOURCES, f"{downloader_class.__name__} found nothing")
+        job = SubmissionJob(submission, downloader_class.__name__)
+        tasks = []
         for destination, res in self.file_name_formatter.format_resource_paths(content, self.download_directory):
             if destination.exists():
                 logger.debug(f"File {destination} from submission {submission.id} already exists, continuing")
@@ -131,89 +346,324 @@ class RedditDownloader(RedditConnector):
             if not self.download_filter.check_resource(res):
                 logger.debug(f"Download filter removed {submission.id} file with URL {submission.url}")
                 continue
-            try:
-                res.download({"max_wait_time": self.args.max_wait_time})
-            except errors.BulkDownloaderException as e:
-                logger.error(
-                    (
-                        f"Failed to download resource {res.url} in submission {submission.id} "
-                        f"with downloader {downloader_class.__name__}: {e}"
-                    ),
+            tasks.append(ResourceTask(job, destination, res))
+        if not tasks:
+            self._log_submission_complete(submission)
+            self._clear_failures(submission.id)
+        job.add_resources(len(tasks))
+        return tasks
+
+    def _retry_resolve(
+        self,
+        task: ResolveTask,
+        module: Optional[str],
+        error: errors.RetryableDownloadError,
+    ) -> list[ResourceTask]:
+        submission = task.submission
+        if task.attempt < self.args.max_retries:
+            delay = self.retry_delay(task.attempt, error.retry_after)
+            logger.warning(f"{error}, retrying submission {submission.id} in {delay:.0f} seconds")
+            raise RetryLater(task._replace(attempt=task.attempt + 1), delay)
+        logger.error(f"Submission {submission.id} failed to download: {error}")
+        self._record_failure(submission.id, submission.url, module, error)
+        return []
+
+    def _fetch_resource(self, task: ResourceTask) -> Union[list[ResourceTask], Future]:
+        job, destination, res, _ = task
+        if job.stopped:
+            return []
+        if res.expected_size:
+            self._reserve_bytes(res, res.expected_size)
+        download_parameters = {
+            "max_wait_time": self.args.max_wait_time,
+            "destination": destination,
+            "find_known_content": self._find_known_content,
+        }
+        if isinstance(self.transport, AsyncTransport) and res.http_url:
+            # Plain file downloads run as coroutines on the transport's loop instead of taking up this worker
+            download_parameters["reserve_bytes"] = partial(self._reserve_bytes_async, res)
+            return self.transport.submit(self._fetch_resource_async(task, download_parameters))
+        download_parameters["reserve_bytes"] = partial(self._reserve_bytes, res)
+        try:
+            res.download(download_parameters)
+        except errors.BulkDownloaderException as e:
+            return self._fetch_failed(task, e)
+        return [task]
+
+    async def _fetch_resource_async(self, task: ResourceTask, download_parameters: dict) -> list[ResourceTask]:
+        try:
+            await task.resource.download_async(self.transport, download_parameters)
+        except errors.BulkDownloaderException as e:
+            return self._fetch_failed(task, e)
+        return [task]
+
+    def _fetch_failed(self, task: ResourceTask, error: errors.BulkDownloaderException) -> list[ResourceTask]:
+        job, _, res, attempt = task
+        self._release_bytes(res)
+        retryable = isinstance(error, errors.RetryableDownloadError)
+        if retryable and attempt < self.args.max_retries:
+            delay = self.retry_delay(attempt, error.retry_after)
+            logger.warning(f"{error}, retrying in {delay:.0f} seconds")
+            raise RetryLater(task._replace(attempt=attempt + 1), delay)
+        self._log_fetch_failure(task, error)
+        self._record_failure(job.submission.id, res.url, job.downloader_name, error)
+        if not retryable and res.url == job.submission.url:
+            # The link is the file itself, so it does not need resolving again either
+            self._cache_dead_link(res.url, error)
+        return []
+
+    def _find_known_content(self, metadata: ResponseMetadata) -> Optional[Path]:
+        """Returns an existing file with the same content as a response, if duplicates are not being kept"""
+        if not (self.args.no_dupes or self.args.make_hard_links):
+            return None
+        return self.content_index.find(metadata)
+
+    def _reserve_bytes(self, res: Resource, size: int) -> None:
+        """Wait until a download fits in the in-flight byte budget, once its size is known"""
+        if size > res.reserved_bytes:
+            # Only the first reservation waits, so downloads already holding part of the budget cannot deadlock
+            res.reserved_bytes += self.byte_budget.reserve(size - res.reserved_bytes, wait=not res.reserved_bytes)
+
+    async def _reserve_bytes_async(self, res: Resource, size: int) -> None:
+        """As _reserve_bytes, for downloads running on the transport's event loop"""
+        if size > res.reserved_bytes:
+            reserved = await self.byte_budget.reserve_async(size - res.reserved_bytes, wait=not res.reserved_bytes)
+            res.reserved_bytes += reserved
+
+    def _release_bytes(self, res: Resource) -> None:
+        self.byte_budget.release(res.reserved_bytes)
+        res.reserved_bytes = 0
+
+    @staticmethod
+    def _log_fetch_failure(task: ResourceTask, error: errors.BulkDownloaderException) -> None:
+        task.job.stop()
+        logger.error(
+            (
+                f"Failed to download resource {task.resource.url} in submission {task.job.submission.id} "
+                f"with downloader {task.job.downloader_name}: {error}"
+            ),
+        )
+
+    def _write_resource(self, task: ResourceTask) -> None:
+        job = task.job
+        if job.stopped:
+            self._release_bytes(task.resource)
+            task.resource.release()
+            return
+        # Dedup checks and writes share state with other workers, so they happen under the lock. Existing files
+        # can take long to hash, so they are looked for first and only checked again under the lock
+        try:
+            existing = self._find_existing_file(task.resource)
+            with self.state_lock:
+                outcome = self._store_resource(task, existing)
+        finally:
+            # Anything not moved into place, such as a duplicate, is deleted, and the payload is let go of so that
+            # the rest of a large album does not pile up in memory
+            self._release_bytes(task.resource)
+            task.resource.release()
+        if outcome is StoreOutcome.DUPLICATE:
+            # The content is already downloaded, so a submission that failed before has nothing left to retry
+            job.stop()
+            self._clear_failures(job.submission.id)
+        elif outcome is StoreOutcome.FAILED:
+            job.stop()
+        elif job.finish_resource():
+            self._log_submission_complete(job.submission)
+            self._clear_failures(job.submission.id)
+
+    def _store_resource(  # noqa: PLR0911,PLR0912,PLR0915
+        self,
+        task: ResourceTask,
+        existing: Optional[Path] = None,
+    ) -> StoreOutcome:
+        """Writes or links a downloaded resource, the rest of the submission being skipped unless it was written
+
+        An existing file with the same content can be given if one was found before the state lock was taken.
+        Otherwise only the files that have been hashed already are checked for one
+        """
+        job, destination, res, _ = task
+        submission = job.submission
+        if destination.exists():
+            logger.debug(f"File {destination} from submission {submission.id} already exists, continuing")
+            return StoreOutcome.WRITTEN
+        if res.known_file:
+            if self.args.make_hard_links:
+                self._hard_link(destination, res.known_file)
+                logger.info(f"Hard link made linking {destination} to {res.known_file} in submission {submission.id}")
+            else:
+                logger.info(
+                    f"Resource {res.url} from submission {submission.id} already downloaded to {res.known_file}",
                 )
-                return
-            resource_hash = res.hash.hexdigest()
-            if self.args.db and (
-                hard_link := self.db.execute("SELECT path FROM hash WHERE hash=?;", (resource_hash,)).fetchone()
-            ):
-                if self.args.make_hard_links:
-                    destination.parent.mkdir(parents=True, exist_ok=True)
-                    hard_link = hard_link[0].strip()
-                    try:
-                        destination.hardlink_to(hard_link)
-                    except AttributeError:
-                        hard_link.link_to(destination)
-                    self.db.execute("INSERT OR IGNORE INTO post_id (post_id) values(?);", (submission.id,))
-                    logger.info(f"Hard link made linking {destination} to {hard_link} in submission {submission.id}")
-                    return
-                self.db.execute("INSERT OR IGNORE INTO link (link) values(?);", (submission.url,))
-                self.db.execute("INSERT OR IGNORE INTO post_id (post_id) values(?);", (submission.id,))
+            if self.args.make_hard_links:
+                self._record_download(task, "linked", destination)
+            else:
+                self._record_download(task, "duplicate", res.known_file)
+            return StoreOutcome.DUPLICATE
+        resource_hash = res.hash.hexdigest()
+        if self.args.db and (hard_link := self._find_stored_hash(resource_hash)):
+            self._remember_metadata(res, Path(hard_link))
+            if self.args.make_hard_links:
+                self._hard_link(destination, Path(hard_link))
+                self._record_download(task, "linked", destination, resource_hash)
+                logger.info(f"Hard link made linking {destination} to {hard_link} in submission {submission.id}")
+                return StoreOutcome.DUPLICATE
+            self._record_download(task, "duplicate", hard_link, resource_hash)
+            logger.info(f"Resource hash {resource_hash} from submission {submission.id} downloaded elsewhere")
+            return StoreOutcome.DUPLICATE
+        if any(resource_hash in shared_hashes for shared_hashes in self.shared_hashes):
+            self._record_download(task, "duplicate", None, resource_hash)
+            logger.info(f"Resource hash {resource_hash} from submission {submission.id} downloaded by another instance")
+            return StoreOutcome.DUPLICATE
+        if (self.args.no_dupes or self.args.make_hard_links) and (
+            existing := existing or self.master_hash_list.get(resource_hash)
+        ):
+            self._remember_metadata(res, existing)
+            if self.args.no_dupes:
                 logger.info(f"Resource hash {resource_hash} from submission {submission.id} downloaded elsewhere")
-                return
-            if resource_hash in self.master_hash_list:
-                if self.args.no_dupes:
-                    logger.info(f"Resource hash {resource_hash} from submission {submission.id} downloaded elsewhere")
-                    return
-                if self.args.make_hard_links:
-                    destination.parent.mkdir(parents=True, exist_ok=True)
-                    try:
-                        destination.hardlink_to(self.master_hash_list[resource_hash])
-                    except AttributeError:
-                        self.master_hash_list[resource_hash].link_to(destination)
-                    logger.info(
-                        (
-                            f"Hard link made linking {destination} to {self.master_hash_list[resource_hash]}"
-                            f" in submission {submission.id}"
-                        ),
-                    )
-                    return
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            try:
+                return StoreOutcome.DUPLICATE
+            if self.args.make_hard_links:
+                self._hard_link(destination, existing)
+                logger.info(f"Hard link made linking {destination} to {existing} in submission {submission.id}")
+                return StoreOutcome.DUPLICATE
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            if res.path:
+                res.path.replace(destination)
+                res.path = None
+            else:
                 with destination.open("wb") as file:
                     file.write(res.content)
-                logger.debug(f"Written file to {destination}")
-            except OSError as e:
-                logger.exception(e)
-                logger.error(f"Failed to write file in submission {submission.id} to {destination}: {e}")
-                return
-            creation_time = time.mktime(datetime.fromtimestamp(submission.created_utc).timetuple())
-            os.utime(destination, (creation_time, creation_time))
-            if self.args.db:
-                self.db.execute("INSERT INTO hash (hash, path) values(?, ?);", (resource_hash, str(destination)))
-                self.db.execute("INSERT OR IGNORE INTO link (link) values(?);", (submission.url,))
-                self.db.execute("INSERT OR IGNORE INTO post_id (post_id) values(?);", (submission.id,))
-                logger.debug(f"Hash added to DB: {resource_hash} with link: {submission.url}")
-            else:
-                self.master_hash_list[resource_hash] = destination
-                logger.debug(f"Hash added to master list: {resource_hash}")
+            logger.debug(f"Written file to {destination}")
+        except OSError as e:
+            logger.exception(e)
+            logger.error(f"Failed to write file in submission {submission.id} to {destination}: {e}")
+            self._record_failure(submission.id, res.url, job.downloader_name, e)
+            return StoreOutcome.FAILED
+        creation_time = time.mktime(datetime.fromtimestamp(submission.created_utc).timetuple())
+        os.utime(destination, (creation_time, creation_time))
+        self._remember_metadata(res, destination)
+        if self.args.db:
+            self._record_download(task, "downloaded", destination, resource_hash, destination.stat().st_size)
+            self.stored_hashes[resource_hash] = str(destination)
+            logger.debug(f"Hash added to DB: {resource_hash} with link: {submission.url}")
+        else:
+            self.master_hash_list[resource_hash] = destination
+            logger.debug(f"Hash added to master list: {resource_hash}")
+        return StoreOutcome.WRITTEN
+
+    @staticmethod
+    def _hard_link(destination: Path, target: Path) -> None:
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            destination.hardlink_to(target)
+        except AttributeError:
+            # Path.hardlink_to is only in Python 3.10 and later
+            os.link(target, destination)
+
+    def _find_stored_hash(self, resource_hash: str) -> Optional[str]:
+        if path := self.stored_hashes.get(resource_hash):
+            return path
+        row = self.db.query(
+            "SELECT path FROM download WHERE algorithm=? AND hash=? AND path IS NOT NULL LIMIT 1;",
+            (get_hash_algorithm(), resource_hash),
+        ).fetchone()
+        return row[0].strip() if row else None
+
+    def _record_download(
+        self,
+        task: ResourceTask,
+        status: str,
+        path: Optional[Union[Path, str]],
+        resource_hash: Optional[str] = None,
+        size: Optional[int] = None,
+    ) -> None:
+        if not self.args.db:
+            return
+        job, _, res, _ = task
+        if size is None:
+            size = self._payload_size(res)
+        self.known_submissions.add(
+            DownloadRecord(
+                job.submission.id,
+                job.submission.url,
+                status,
+                res.url,
+                resource_hash,
+                get_hash_algorithm() if resource_hash else None,
+                size,
+                str(path) if path else None,
+                job.downloader_name,
+                int(job.submission.created_utc),
+            ),
+        )
+
+    def _record_failure(self, post_id: str, url: str, module: Optional[str], error: Exception) -> None:
+        if self.args.db:
+            self.failure_ledger.record(post_id, url, module, error)
+
+    def _cache_dead_link(self, url: str, error: Exception) -> None:
+        # A module failing on a link, such as yt-dlp hitting a bot check, may well work later so is not cached
+        if self.negative_cache and is_dead_link(error):
+            self.negative_cache.add(url, type(error).__name__, str(error))
+
+    def _clear_failures(self, post_id: str) -> None:
+        if self.args.db:
+            self.failure_ledger.clear(post_id)
+
+    @staticmethod
+    def _payload_size(res: Resource) -> Optional[int]:
+        if res.path:
+            return res.path.stat().st_size
+        if res.content is not None:
+            return len(res.content)
+        return res.metadata.size if res.metadata else None
+
+    def _remember_metadata(self, res: Resource, path: Path) -> None:
+        if res.metadata:
+            self.content_index.add(res.metadata, path)
+
+    def _find_existing_file(self, res: Resource) -> Optional[Path]:
+        """Returns a file in the download directory with the same content, hashing files of the same size if needed"""
+        if not (self.args.no_dupes or self.args.make_hard_links) or res.known_file or not res.hash:
+            return None
+        resource_hash = res.hash.hexdigest()
+        if res.path:
+            return self.master_hash_list.find(resource_hash, self._payload_size(res), partial(sample_file, res.path))
+        return self.master_hash_list.find(resource_hash, self._payload_size(res), partial(sample_bytes, res.content))
+
+    @staticmethod
+    def _log_submission_complete(submission: praw.models.Submission) -> None:
         logger.info(f"Downloaded submission {submission.id} from {submission.subreddit.display_name}")
 
     @staticmethod
     def scan_existing_files(
         directory: Path,
-        db: Union[sqlite3.Connection, None] = None,
-    ) -> Union[dict[str, Path], None]:
-        files = []
-        for dirpath, _dirnames, filenames in os.walk(directory):
-            files.extend([Path(dirpath, file) for file in filenames])
-        logger.info(f"Calculating hashes for {len(files)} files")
-
-        pool = Pool(15)
-        results = pool.map(_calc_hash, files)
-        pool.close()
-
-        if db:
-            hashes = [(res[1], str(res[0])) for res in results]
-            db.executemany("INSERT OR IGNORE INTO hash (hash, path) values(?, ?);", hashes)
-            db.commit()
-            return None
-        return {res[1]: res[0] for res in results}
+        db: Union[Database, None] = None,
+        cache: Optional[ScanCache] = None,
+        workers: int = 15,
+    ) -> Union[ExistingFileIndex, None]:
+        if not db:
+            # Files only need to be hashed when a download of the same size turns up
+            index = ExistingFileIndex()
+            for file, stat in walk_files(directory):
+                if cache is not None and (file_hash := cache.get(FileKey.from_stat(file, stat))):
+                    index[file_hash] = file
+                else:
+                    index.add_unhashed(file, stat.st_size)
+            logger.info(
+                f"Indexed {len(index)} existing files, they will be hashed if a download of the same size is found",
+            )
+            return index
+
+        logger.info(f"Calculating hashes for files in {directory} with {workers} threads")
+        algorithm = get_hash_algorithm()
+        recorded_at = int(time.time())
+        for file, file_hash in FileHasher(workers, cache).hash_files(walk_files(directory)):
+            # A file scanned by an earlier run is already there
+            db.write(
+                "INSERT INTO download (status, hash, algorithm, path, recorded_at) SELECT 'existing', ?, ?, ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM download WHERE algorithm=? AND hash=? AND path=?);",
+                (file_hash, algorithm, str(file), recorded_at, algorithm, file_hash, str(file)),
+            )
+        db.commit()
+        return None
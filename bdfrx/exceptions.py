@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class BulkDownloaderException(Exception):
     pass
 
@@ -19,4 +22,12 @@ class NotADownloadableLinkError(SiteDownloaderError):
 
 
 class ResourceNotFound(SiteDownloaderError):
-    pass
+    def __init__(self, message: str, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RetryableDownloadError(BulkDownloaderException):
+    def __init__(self, message: str, retry_after: float = 0) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,302 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from array import array
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Optional
+
+from bdfrx.compact_index import DigestTable, PathTable
+from bdfrx.hashing import new_hash
+from bdfrx.scan_cache import FileKey, ScanCache
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 64 * 1024
+
+# The scratch directories that yt-dlp downloads into, next to their destination
+SCRATCH_PREFIX = ".bdfrx-"
+# The files of downloads that are in progress or were interrupted, and their validators
+PARTIAL_SUFFIXES = (".part", ".part.json")
+
+
+def sample_bytes(content: bytes) -> bytes:
+    """The start and end of some content, which differ between most files of the same size"""
+    if len(content) <= 2 * SAMPLE_SIZE:
+        return content
+    return content[:SAMPLE_SIZE] + content[-SAMPLE_SIZE:]
+
+
+def sample_file(path: Path) -> bytes:
+    with path.open("rb") as file:
+        head = file.read(2 * SAMPLE_SIZE + 1)
+        if len(head) <= 2 * SAMPLE_SIZE:
+            return head
+        file.seek(-SAMPLE_SIZE, 2)
+        return head[:SAMPLE_SIZE] + file.read(SAMPLE_SIZE)
+
+
+def _digest(sample: bytes) -> bytes:
+    # Only a digest of each sample is kept, so many files of the same size do not fill up memory
+    return hashlib.md5(sample, usedforsecurity=False).digest()
+
+
+def hash_file(path: Path) -> str:
+    file_hash = new_hash()
+    with path.open("rb") as file:
+        while chunk := file.read(1024 * 1024):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ExistingFileIndex:
+    """Finds files that are already in the download directory by their hash, hashing as few of them as possible
+
+    Files are first indexed by size, since only a file of the same size can be a duplicate. A file is only
+    hashed when a download of the same size comes along and the start and end of both files match
+
+    Millions of files can be indexed, so hashes are kept as binary digests and paths as numbers in compact tables.
+    The files of each size are chained together through an array of path numbers
+
+    The index can be used from several threads. Files are hashed without holding its lock, so one large file does
+    not hold up lookups for other sizes, and two lookups that hash the same file both count it only once
+    """
+
+    def __init__(self) -> None:
+        self._paths = PathTable()
+        self._hashes: Optional[DigestTable] = None
+        # Values are the first unhashed path of a size plus one, and the next one of the same size plus one
+        self._sizes = DigestTable(8)
+        self._next_unhashed = array("I")
+        self._unhashed_count = 0
+        self._samples: dict[int, bytes] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._hashes or ()) + self._unhashed_count
+
+    def __contains__(self, file_hash: str) -> bool:
+        with self._lock:
+            return self._hashed_path_id(file_hash) is not None
+
+    def __getitem__(self, file_hash: str) -> Path:
+        if (path := self.get(file_hash)) is None:
+            raise KeyError(file_hash)
+        return path
+
+    def __setitem__(self, file_hash: str, path: Path) -> None:
+        digest = bytes.fromhex(file_hash)
+        with self._lock:
+            self._hash_table(digest)[digest] = self._add_path(path)
+
+    def get(self, file_hash: str) -> Optional[Path]:
+        """Returns the file with a hash if it has been hashed already, without reading any files"""
+        with self._lock:
+            path_id = self._hashed_path_id(file_hash)
+            return None if path_id is None else self._paths[path_id]
+
+    def _hashed_path_id(self, file_hash: str) -> Optional[int]:
+        if self._hashes is None:
+            return None
+        try:
+            return self._hashes.get(bytes.fromhex(file_hash))
+        except ValueError:
+            return None
+
+    def _hash_table(self, digest: bytes) -> DigestTable:
+        if self._hashes is None:
+            self._hashes = DigestTable(len(digest))
+        return self._hashes
+
+    def _add_path(self, path: Path) -> int:
+        self._next_unhashed.append(0)
+        return self._paths.add(path)
+
+    def add_unhashed(self, path: Path, size: int) -> None:
+        size_key = size.to_bytes(8, "little")
+        with self._lock:
+            path_id = self._add_path(path)
+            self._next_unhashed[path_id] = self._sizes.get(size_key) or 0
+            self._sizes[size_key] = path_id + 1
+            self._unhashed_count += 1
+
+    def _unhashed(self, size_key: bytes) -> list[int]:
+        path_ids = []
+        next_id = self._sizes.get(size_key)
+        while next_id:
+            path_ids.append(next_id - 1)
+            next_id = self._next_unhashed[next_id - 1]
+        return path_ids
+
+    def _set_unhashed(self, size_key: bytes, path_ids: list[int]) -> None:
+        self._sizes[size_key] = path_ids[0] + 1 if path_ids else 0
+        for path_id, next_id in zip(path_ids, path_ids[1:]):
+            self._next_unhashed[path_id] = next_id + 1
+        if path_ids:
+            self._next_unhashed[path_ids[-1]] = 0
+
+    def find(self, file_hash: str, size: int, sample: Callable[[], bytes]) -> Optional[Path]:
+        """Returns an existing file with the given hash, sample giving the start and end of the new file"""
+        if (path := self.get(file_hash)) is not None:
+            return path
+        size_key = size.to_bytes(8, "little")
+        with self._lock:
+            candidates = [
+                (path_id, self._paths[path_id], self._samples.get(path_id)) for path_id in self._unhashed(size_key)
+            ]
+        if not candidates:
+            return None
+        new_sample = _digest(sample())
+        # Samples of files that do not match, and hashes of files that were read, by path number
+        samples: dict[int, bytes] = {}
+        hashes: dict[int, Optional[str]] = {}
+        for path_id, path, known_sample in candidates:
+            try:
+                samples[path_id] = known_sample or _digest(sample_file(path))
+                if samples[path_id] != new_sample:
+                    continue
+                logger.debug(f"Hashing {path} as a possible duplicate")
+                hashes[path_id] = hash_file(path)
+            except OSError as e:
+                logger.warning(f"Could not read {path}: {e}")
+                hashes[path_id] = None
+        with self._lock:
+            # Files taken off the list by another lookup in the meantime are already counted
+            remaining = []
+            for path_id in self._unhashed(size_key):
+                if path_id not in hashes:
+                    if path_id in samples:
+                        self._samples[path_id] = samples[path_id]
+                    remaining.append(path_id)
+                    continue
+                self._unhashed_count -= 1
+                self._samples.pop(path_id, None)
+                if existing_hash := hashes[path_id]:
+                    digest = bytes.fromhex(existing_hash)
+                    self._hash_table(digest).setdefault(digest, path_id)
+            self._set_unhashed(size_key, remaining)
+        return self.get(file_hash)
+
+    @property
+    def nbytes(self) -> int:
+        """The memory taken by the index, apart from a small fixed overhead"""
+        return (
+            self._paths.nbytes
+            + (self._hashes.nbytes if self._hashes else 0)
+            + self._sizes.nbytes
+            + self._next_unhashed.itemsize * len(self._next_unhashed)
+        )
+
+
+def walk_files(directory: Path) -> Iterator[tuple[Path, os.stat_result]]:
+    """Yields every file below a directory with its stat, as the directories are read
+
+    Partial downloads and the scratch directories of downloads in progress are skipped
+    """
+    directories = [directory]
+    while directories:
+        current = directories.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith(SCRATCH_PREFIX):
+                                directories.append(Path(entry.path))
+                        elif entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIXES):
+                            yield Path(entry.path), entry.stat()
+                    except OSError as e:  # noqa: PERF203
+                        logger.warning(f"Could not read {entry.path}: {e}")
+        except OSError as e:
+            logger.warning(f"Could not read directory {current}: {e}")
+
+
+class FileHasher:
+    """Hashes files on a pool of threads, yielding each result as soon as it is ready
+
+    Only a few files per thread are queued at once, so a directory of any size can be hashed without listing it
+    first. A file with several hard links is only read once, and files whose hash is in the scan cache are not
+    read at all
+    """
+
+    def __init__(self, workers: int = 15, cache: Optional[ScanCache] = None, report_interval: float = 30) -> None:
+        self.workers = workers
+        self.cache = cache
+        self.report_interval = report_interval
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.files_cached = 0
+        self._started = 0.0
+        self._last_report = 0.0
+        self._linked_hashes: dict[tuple[int, int], str] = {}
+
+    def hash_files(self, files: Iterable[tuple[Path, os.stat_result]]) -> Iterator[tuple[Path, str]]:
+        self._started = self._last_report = time.monotonic()
+        pending: dict[Future, list[tuple[Path, os.stat_result]]] = {}
+        linked_in_flight: dict[tuple[int, int], Future] = {}
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="hash") as executor:
+            try:
+                for file, stat in files:
+                    if self.cache is not None and (file_hash := self.cache.get(FileKey.from_stat(file, stat))):
+                        self.files_cached += 1
+                        yield file, file_hash
+                        continue
+                    inode = (stat.st_dev, stat.st_ino)
+                    if stat.st_nlink > 1 and inode in self._linked_hashes:
+                        yield file, self._linked_hashes[inode]
+                        continue
+                    if stat.st_nlink > 1 and inode in linked_in_flight:
+                        pending[linked_in_flight[inode]].append((file, stat))
+                        continue
+                    future = executor.submit(hash_file, file)
+                    pending[future] = [(file, stat)]
+                    if stat.st_nlink > 1:
+                        linked_in_flight[inode] = future
+                    if len(pending) >= self.workers * 4:
+                        yield from self._collect(pending, linked_in_flight)
+                while pending:
+                    yield from self._collect(pending, linked_in_flight)
+            finally:
+                for future in pending:
+                    future.cancel()
+                if self.cache is not None:
+                    self.cache.commit()
+        self._report()
+
+    def _collect(
+        self,
+        pending: dict[Future, list[tuple[Path, os.stat_result]]],
+        linked_in_flight: dict[tuple[int, int], Future],
+    ) -> Iterator[tuple[Path, str]]:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            links = pending.pop(future)
+            first_file, stat = links[0]
+            if stat.st_nlink > 1:
+                linked_in_flight.pop((stat.st_dev, stat.st_ino), None)
+            try:
+                file_hash = future.result()
+            except OSError as e:
+                logger.warning(f"Could not hash {first_file}: {e}")
+                continue
+            self.files_hashed += 1
+            self.bytes_hashed += stat.st_size
+            if stat.st_nlink > 1:
+                self._linked_hashes[(stat.st_dev, stat.st_ino)] = file_hash
+            if self.cache is not None:
+                self.cache.put_many((FileKey.from_stat(file, link_stat), file_hash) for file, link_stat in links)
+            for file, _ in links:
+                yield file, file_hash
+        if time.monotonic() - self._last_report >= self.report_interval:
+            self._report()
+
+    def _report(self) -> None:
+        self._last_report = time.monotonic()
+        elapsed = max(self._last_report - self._started, 1e-9)
+        logger.info(
+            f"Hashed {self.files_hashed} files ({self.bytes_hashed / 2**20:.0f} MiB) at "
+            f"{self.bytes_hashed / 2**20 / elapsed:.1f} MiB/s, {self.files_cached} files unchanged since the last scan",
+        )
@@ -0,0 +1,92 @@
+import logging
+import time
+from typing import Optional
+
+import prawcore
+
+from bdfrx import exceptions as errors
+from bdfrx.database import Database
+from bdfrx.scheduler import PERMANENT_STATUS_CODES
+
+logger = logging.getLogger(__name__)
+
+
+def is_permanent(error: Exception) -> bool:
+    """Whether an error will come up again however often the download is tried, such as a link that is gone"""
+    if isinstance(error, (errors.NotADownloadableLinkError, prawcore.NotFound)):
+        return True
+    return isinstance(error, errors.ResourceNotFound) and error.status_code in PERMANENT_STATUS_CODES
+
+
+class FailureLedger:
+    """The failed downloads kept in the failure table, so that only they need to be tried again
+
+    A failure is kept per submission and URL, with the error, the module that was used and the number of attempts.
+    The next attempt is put off by retry_base_delay, doubled with every failed attempt up to max_retry_delay. A
+    permanent failure, or one that has failed max_attempts times, is given up on and has no next attempt. The
+    failures of a submission are removed once it downloads in full
+    """
+
+    retry_base_delay = 3600
+    max_retry_delay = 7 * 24 * 3600
+    max_attempts = 8
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        # Loaded once, so that submissions which never failed are not deleted from the table one by one
+        self._failed_post_ids = {row[0] for row in db.query("SELECT DISTINCT post_id FROM failure;")}
+        self._given_up_post_ids = {
+            row[0]
+            for row in db.query("SELECT post_id FROM failure GROUP BY post_id HAVING COUNT(next_attempt_at) = 0;")
+        }
+
+    def record(self, post_id: str, url: str, module: Optional[str], error: Exception) -> None:
+        permanent = is_permanent(error)
+        now = int(time.time())
+        self._failed_post_ids.add(post_id)
+        # The backoff of a failure already in the table is worked out from its attempts by SQLite
+        self.db.write(
+            "INSERT INTO failure (post_id, url, module, error, message, permanent, attempts, first_failed_at, "
+            "last_failed_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (post_id, url) DO UPDATE SET module=excluded.module, error=excluded.error, "
+            "message=excluded.message, permanent=excluded.permanent, attempts=failure.attempts + 1, "
+            "last_failed_at=excluded.last_failed_at, next_attempt_at=CASE "
+            "WHEN excluded.permanent OR failure.attempts + 1 >= ? THEN NULL "
+            "ELSE excluded.last_failed_at + MIN(?, ? << failure.attempts) END;",
+            (
+                post_id,
+                url,
+                module,
+                type(error).__name__,
+                str(error),
+                permanent,
+                now,
+                now,
+                None if permanent or self.max_attempts <= 1 else now + self.retry_base_delay,
+                self.max_attempts,
+                self.max_retry_delay,
+                self.retry_base_delay,
+            ),
+        )
+        logger.debug(f"Recorded {'permanent ' if permanent else ''}failure of {url or post_id} in submission {post_id}")
+
+    def clear(self, post_id: str) -> None:
+        """Removes the failures of a submission that has downloaded in full"""
+        if post_id in self._failed_post_ids:
+            self._failed_post_ids.discard(post_id)
+            self._given_up_post_ids.discard(post_id)
+            self.db.write("DELETE FROM failure WHERE post_id=?;", (post_id,))
+
+    def given_up(self, post_id: str) -> bool:
+        """Whether every failure of a submission, as of the start of the run, is not to be tried again"""
+        return post_id in self._given_up_post_ids
+
+    def due(self, now: Optional[float] = None) -> list[str]:
+        """Returns the IDs of the submissions with a failure that is due to be tried again, the longest due first"""
+        now = time.time() if now is None else now
+        # Only the failures that are due are read, from the index of next attempts
+        rows = self.db.query(
+            "SELECT post_id FROM failure WHERE next_attempt_at <= ? ORDER BY next_attempt_at;",
+            (int(now),),
+        )
+        return list(dict.fromkeys(row[0] for row in rows))
@@ -0,0 +1,34 @@
+import logging
+from collections.abc import Iterable
+
+import praw.models
+
+from bdfrx import exceptions as errors
+from bdfrx.configuration import Configuration
+from bdfrx.downloader import RedditDownloader
+from bdfrx.known_submissions import KnownItems
+
+logger = logging.getLogger(__name__)
+
+
+class FailureRetrier(RedditDownloader):
+    """Downloads again the submissions in the DB with a failure that is due to be retried, and nothing else
+
+    A retried submission is downloaded even though some of its resources are in the DB, as the rest of it failed.
+    Files already in the download directory are skipped as they are in any download
+    """
+
+    def __init__(self, args: Configuration, logging_handlers: Iterable[logging.Handler] = ()) -> None:
+        if not (args.db or args.db_file):
+            raise errors.BulkDownloaderException("Failures are only recorded in a DB, use --db or --db-file")
+        super().__init__(args, logging_handlers)
+        due = self.failure_ledger.due()
+        logger.info(f"{len(due)} failed submissions are due to be retried")
+        self.reddit_lists = [[self.reddit_instance.submission(id=post_id) for post_id in due]]
+
+    def retrieve_reddit_lists(self) -> list[praw.models.ListingGenerator]:
+        # The submissions to download come from the DB once it is loaded, not from any source given
+        return []
+
+    def _find_known_submissions(self, page: list[praw.models.Submission]) -> KnownItems:
+        return KnownItems(set(), set())
@@ -0,0 +1,60 @@
+import itertools
+import logging
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import appdirs
+
+from bdfrx.configuration import Configuration
+from bdfrx.connector import RedditConnector
+from bdfrx.existing_files import FileHasher, walk_files
+from bdfrx.hashing import get_hash_algorithm
+from bdfrx.scan_cache import ScanCache
+from bdfrx.shared_hashes import write_hash_file
+
+logger = logging.getLogger(__name__)
+
+
+class HashExporter(RedditConnector):
+    """Writes the hashes in the DB, or of the files in a directory, to a hash file that other instances can import"""
+
+    def __init__(self, args: Configuration, logging_handlers: Iterable[logging.Handler] = ()) -> None:
+        self.args = args
+        self.config_directories = appdirs.AppDirs("bdfrx", "BDFRx")
+        self.determine_directories()
+        self.load_config()
+        self.read_config()
+        file_log = self.create_file_logger()
+        self._apply_logging_handlers(itertools.chain(logging_handlers, [file_log]))
+        if not self.args.from_directory:
+            self.load_db()
+            self.warn_outdated_hashes()
+
+    def download(self) -> None:
+        self.export()
+
+    def export(self) -> int:
+        output = Path(self.args.output_file).expanduser()
+        algorithm = get_hash_algorithm()
+        if self.args.from_directory:
+            digests = self._directory_digests(Path(self.args.from_directory).expanduser())
+        else:
+            # Hex digests sort in the same order as the bytes they stand for, so the DB's index gives the order
+            rows = self.db.query(
+                "SELECT DISTINCT hash FROM download WHERE algorithm=? AND hash IS NOT NULL ORDER BY hash;",
+                (algorithm,),
+            )
+            digests = (bytes.fromhex(row[0]) for row in rows)
+        count = write_hash_file(output, digests, algorithm)
+        logger.info(f"Exported {count} {algorithm} hashes to {output}")
+        return count
+
+    def _directory_digests(self, directory: Path) -> Iterator[bytes]:
+        workers = self.cfg_parser.getint("DEFAULT", "scan_threads", fallback=15)
+        scan_cache = ScanCache(Path(self.config_directory, "scan_cache.db"))
+        try:
+            hasher = FileHasher(workers, scan_cache)
+            digests = sorted({bytes.fromhex(file_hash) for _, file_hash in hasher.hash_files(walk_files(directory))})
+        finally:
+            scan_cache.close()
+        return iter(digests)
@@ -0,0 +1,30 @@
+import hashlib
+from typing import TYPE_CHECKING
+
+from bdfrx.exceptions import BulkDownloaderException
+
+if TYPE_CHECKING:
+    import _hashlib
+
+# Algorithms that hashlib provides on every platform. sha256 is accelerated on CPUs with the SHA extensions, and
+# blake2b is usually the fastest on 64-bit CPUs without them
+HASH_ALGORITHMS = ("blake2b", "blake2s", "md5", "sha1", "sha256", "sha512")
+
+_algorithm = "md5"
+
+
+def get_hash_algorithm() -> str:
+    return _algorithm
+
+
+def set_hash_algorithm(name: str) -> None:
+    global _algorithm  # noqa: PLW0603
+    name = name.lower()
+    if name not in HASH_ALGORITHMS:
+        raise BulkDownloaderException(f"Unknown hash algorithm {name!r}, choose from {', '.join(HASH_ALGORITHMS)}")
+    _algorithm = name
+
+
+def new_hash(data: bytes = b"") -> "_hashlib.HASH":
+    """Start a hash of file contents with the configured algorithm"""
+    return hashlib.new(_algorithm, data, usedforsecurity=False)
@@ -0,0 +1,79 @@
+import logging
+import time
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+from bdfrx.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class KnownItems(NamedTuple):
+    post_ids: set[str]
+    links: set[str]
+
+
+class DownloadRecord(NamedTuple):
+    """What became of a resource of a submission, kept as a row of the download table
+
+    The status is downloaded, duplicate for a resource skipped as a copy of the file at the path, if there is one, or
+    linked for a hard link made at the path. The link of a linked resource does not stop later submissions with it
+    """
+
+    post_id: str
+    link: str
+    status: str
+    resource_url: Optional[str] = None
+    file_hash: Optional[str] = None
+    algorithm: Optional[str] = None
+    size: Optional[int] = None
+    path: Optional[str] = None
+    module: Optional[str] = None
+    created_utc: Optional[int] = None
+
+
+class KnownSubmissions:
+    """The post IDs and links in the download table, for skipping submissions that have already been downloaded
+
+    Submissions are looked up a page at a time, with one query for the post IDs and one for the links of the whole
+    page, instead of two queries for every submission. The items added in this run are also kept in memory, as they
+    may not have been committed yet when they are next looked up
+    """
+
+    query_batch_size = 500
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        self._added_post_ids: set[str] = set()
+        self._added_links: set[str] = set()
+
+    def find(self, post_ids: Iterable[str], links: Iterable[str]) -> KnownItems:
+        """Returns those of the post IDs and links that are in the database"""
+        return KnownItems(
+            self._query("post_id", list(post_ids), self._added_post_ids),
+            self._query("link", list(links), self._added_links),
+        )
+
+    def _query(self, column: str, items: list[str], added: set[str]) -> set[str]:
+        found = {item for item in items if item in added}
+        items = [item for item in items if item not in found]
+        condition = " AND status != 'linked'" if column == "link" else ""
+        for start in range(0, len(items), self.query_batch_size):
+            batch = items[start : start + self.query_batch_size]
+            rows = self.db.query(
+                f"SELECT {column} FROM download "  # noqa: S608
+                f"WHERE {column} IN ({', '.join('?' * len(batch))}){condition};",
+                batch,
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def add(self, record: DownloadRecord) -> None:
+        self._added_post_ids.add(record.post_id)
+        if record.status != "linked":
+            self._added_links.add(record.link)
+        self.db.write(
+            "INSERT INTO download (post_id, link, status, resource_url, hash, algorithm, size, path, module, "
+            "created_utc, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            (*record, int(time.time())),
+        )
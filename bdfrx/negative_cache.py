@@ -0,0 +1,120 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import yt_dlp
+
+from bdfrx import __version__
+from bdfrx.exceptions import BulkDownloaderException, ResourceNotFound
+from bdfrx.scheduler import PERMANENT_STATUS_CODES
+
+logger = logging.getLogger(__name__)
+
+# Recorded for a link that a module resolved to nothing, such as an empty album
+NO_RESOURCES = "NoResources"
+
+# Hours that a link stays in the cache, by the error it failed with
+DEFAULT_TTLS = {
+    "NotADownloadableLinkError": 30 * 24,
+    "ResourceNotFound": 7 * 24,
+    NO_RESOURCES: 24,
+}
+
+
+def is_dead_link(error: Exception) -> bool:
+    """Whether a link failed because it is gone, rather than because a module could not get anything from it"""
+    return isinstance(error, ResourceNotFound) and error.status_code in PERMANENT_STATUS_CODES
+
+
+def _cache_version() -> str:
+    # Which links can be downloaded also depends on the extractors of yt-dlp
+    return f"{__version__} yt-dlp {yt_dlp.version.__version__}"
+
+
+class CachedFailure(NamedTuple):
+    error: str
+    message: str
+
+
+class NegativeCache:
+    """Links that failed in a way that will not change soon, kept between runs so they are not resolved again
+
+    Each link is kept for as many hours as is given for the error it failed with, and an error with no time given is
+    not kept. Entries are also dropped when BDFRx or yt-dlp is upgraded, as a new version may download links an old
+    one could not. The number of links skipped is counted by error. New entries are committed every
+    checkpoint_interval links
+    """
+
+    checkpoint_interval = 100
+
+    def __init__(self, path: Path, ttls: Optional[dict[str, float]] = None) -> None:
+        self.path = path
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.hits: Counter[str] = Counter()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        with self._lock:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS negative_cache (
+                    url TEXT NOT NULL PRIMARY KEY,
+                    error TEXT NOT NULL,
+                    message TEXT,
+                    version TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL
+                );""",
+            )
+            self._connection.execute(
+                "DELETE FROM negative_cache WHERE expires_at <= ? OR version != ?;",
+                (int(time.time()), _cache_version()),
+            )
+            self._connection.commit()
+
+    @staticmethod
+    def parse_ttls(entries: list[str]) -> dict[str, float]:
+        """Parse times given as error=hours, on top of the default times"""
+        ttls = dict(DEFAULT_TTLS)
+        for entry in entries:
+            for ttl in filter(None, (part.strip() for part in re.split(r"[,;]\s?", entry))):
+                match = re.fullmatch(r"(\w+)\s*=\s*(\d+(?:\.\d+)?)", ttl)
+                if not match:
+                    raise BulkDownloaderException(f"Invalid negative cache time {ttl!r}")
+                ttls[match.group(1)] = float(match.group(2))
+        return ttls
+
+    def get(self, url: str) -> Optional[CachedFailure]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT error, message FROM negative_cache WHERE url=? AND expires_at > ?;",
+                (url, int(time.time())),
+            ).fetchone()
+            if row:
+                self.hits[row[0]] += 1
+        return CachedFailure(*row) if row else None
+
+    def add(self, url: str, error: str, message: str) -> None:
+        if not url or not (ttl := self.ttls.get(error)):
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO negative_cache (url, error, message, version, expires_at) "
+                "VALUES (?, ?, ?, ?, ?);",
+                (url, error, message, _cache_version(), int(time.time() + ttl * 3600)),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.checkpoint_interval:
+                self._connection.commit()
+                self._uncommitted = 0
+
+    def close(self) -> None:
+        if self.hits:
+            counts = ", ".join(f"{error} {count}" for error, count in sorted(self.hits.items()))
+            logger.info(f"Skipped {sum(self.hits.values())} links that failed in earlier runs ({counts})")
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
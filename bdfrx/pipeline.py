@@ -0,0 +1,299 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from functools import partial
+from typing import Any, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RetryLater(Exception):
+    """Raised by a stage function to run an item through the same stage again after a delay"""
+
+    def __init__(self, item: Any, delay: float) -> None:  # noqa: ANN401
+        super().__init__(f"Retrying in {delay:.0f} seconds")
+        self.item = item
+        self.delay = delay
+
+
+class ByteBudget:
+    """Limits the bytes held by the items in flight, blocking until enough of them have been released
+
+    A request for more than the whole budget waits until nothing else is held, so a single large item can still
+    go through on its own. A limit of 0 means there is no limit
+    """
+
+    def __init__(self, limit: int = 0) -> None:
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+        # Coroutines waiting for bytes to be released, with the loop each is running on
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def reserve(self, size: int, wait: bool = True) -> int:  # noqa: FBT001,FBT002
+        """Returns the number of bytes reserved, which must be given back to release"""
+        if self.limit <= 0 or size <= 0:
+            return 0
+        with self._condition:
+            if wait:
+                size = min(size, self.limit)
+                if self.used + size > self.limit:
+                    logger.log(9, f"Waiting for {size} bytes of the in-flight byte budget")
+                while self.used + size > self.limit:
+                    self._condition.wait()
+            self.used += size
+        return size
+
+    async def reserve_async(self, size: int, wait: bool = True) -> int:  # noqa: FBT001,FBT002
+        """As reserve, waiting on the running event loop instead of blocking the thread"""
+        if self.limit <= 0 or size <= 0 or not wait:
+            return self.reserve(size, wait=False)
+        size = min(size, self.limit)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.used + size <= self.limit:
+                    self.used += size
+                    return size
+                logger.log(9, f"Waiting for {size} bytes of the in-flight byte budget")
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    def release(self, size: int) -> None:
+        if size <= 0:
+            return
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+            for loop, waiter in self._waiters:
+                loop.call_soon_threadsafe(_wake, waiter)
+            self._waiters.clear()
+
+
+StageResult = Union[Optional[Iterable], concurrent.futures.Future]
+
+
+class Stage:
+    def __init__(self, name: str, function: Callable[[Any], StageResult], workers: int = 1) -> None:
+        if workers < 1:
+            raise ValueError(f"Stage {name} must have at least one worker")
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processed = 0
+
+
+class Pipeline:
+    """Runs items through a chain of stages, each with its own worker threads and bounded input queue
+
+    Each stage function takes one item and returns an iterable of items for the next stage, or None. A stage
+    can raise RetryLater to put an item back into its own queue after a delay, without holding up its workers.
+    A stage function can also return a future of its result, such as for a coroutine running on an event loop, in
+    which case the worker goes on to the next item and the result is handed on by another thread once it is done.
+    A stage is only stopped once every item given to it has been processed, including deferred and pending ones
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 100, report_interval: float = 30) -> None:
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.report_interval = report_interval
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._running = [stage.workers for stage in stages]
+        self._outstanding = [0 for _ in stages]
+        self._upstream_done = [False for _ in stages]
+        self._stopping = [False for _ in stages]
+        self._lock = threading.Lock()
+        self._retries: list[tuple[float, int, int, Any]] = []
+        self._retry_condition = threading.Condition()
+        self._retry_counter = itertools.count()
+        self._completed: queue.Queue = queue.Queue()
+        self._finished = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def queue_depths(self) -> dict[str, int]:
+        return {stage.name: stage_queue.qsize() for stage, stage_queue in zip(self.stages, self.queues)}
+
+    def deferred_count(self) -> int:
+        with self._retry_condition:
+            return len(self._retries)
+
+    def run(self, source: Iterable) -> None:
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index,),
+                    name=f"{stage.name}-{number}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+        threads.append(threading.Thread(target=self._feed, args=(source,), name="feeder", daemon=True))
+        threads.append(threading.Thread(target=self._retry, name="retry", daemon=True))
+        threads.append(threading.Thread(target=self._collect, name="collector", daemon=True))
+        for thread in threads[-3:]:
+            thread.start()
+
+        while not self._finished.wait(self.report_interval):
+            logger.debug(f"Pipeline queue depths: {self._format_depths()}")
+        with self._retry_condition:
+            self._retry_condition.notify_all()
+        self._completed.put(_STOP)
+        for thread in threads:
+            thread.join()
+        logger.debug(
+            "Pipeline finished, items processed: "
+            + ", ".join(f"{stage.name}={stage.processed}" for stage in self.stages),
+        )
+        if self._error is not None:
+            raise self._error
+
+    def _format_depths(self) -> str:
+        depths = [f"{name}={depth}" for name, depth in self.queue_depths().items()]
+        depths.append(f"waiting to retry={self.deferred_count()}")
+        return ", ".join(depths)
+
+    def _put(self, index: int, item: Any) -> None:  # noqa: ANN401
+        with self._lock:
+            self._outstanding[index] += 1
+        self.queues[index].put(item)
+
+    def _item_done(self, index: int) -> None:
+        with self._lock:
+            self._outstanding[index] -= 1
+        self._stop_if_drained(index)
+
+    def _upstream_finished(self, index: int) -> None:
+        with self._lock:
+            self._upstream_done[index] = True
+        self._stop_if_drained(index)
+
+    def _stop_if_drained(self, index: int) -> None:
+        with self._lock:
+            if self._stopping[index] or not self._upstream_done[index] or self._outstanding[index]:
+                return
+            self._stopping[index] = True
+        for _ in range(self.stages[index].workers):
+            self.queues[index].put(_STOP)
+
+    def _feed(self, source: Iterable) -> None:
+        try:
+            for item in source:
+                if self._error is not None:
+                    break
+                self._put(0, item)
+        except BaseException as e:  # noqa: BLE001
+            self._fail(e)
+        finally:
+            self._upstream_finished(0)
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        in_queue = self.queues[index]
+        while (item := in_queue.get()) is not _STOP:
+            if self._error is not None:
+                # Keep draining so that upstream stages never block on a full queue
+                self._item_done(index)
+                continue
+            try:
+                results = stage.function(item)
+                if isinstance(results, concurrent.futures.Future):
+                    # The item stays outstanding until the collector has handed on its results
+                    results.add_done_callback(partial(self._complete, index))
+                    continue
+                self._pass_on(index, results)
+            except RetryLater as e:
+                self._defer(index, e.item, e.delay)
+                continue
+            except BaseException as e:  # noqa: BLE001
+                self._fail(e)
+            self._processed(index)
+        with self._lock:
+            self._running[index] -= 1
+            last_worker = self._running[index] == 0
+        if last_worker:
+            if index + 1 == len(self.stages):
+                self._finished.set()
+            else:
+                self._upstream_finished(index + 1)
+
+    def _pass_on(self, index: int, results: Optional[Iterable]) -> None:
+        for result in results or ():
+            if index + 1 < len(self.stages):
+                self._put(index + 1, result)
+
+    def _processed(self, index: int) -> None:
+        with self._lock:
+            self.stages[index].processed += 1
+        self._item_done(index)
+
+    def _complete(self, index: int, future: concurrent.futures.Future) -> None:
+        # Called from the thread that finished the future, which must not be held up by a full queue
+        self._completed.put((index, future))
+
+    def _collect(self) -> None:
+        while (entry := self._completed.get()) is not _STOP:
+            index, future = entry
+            try:
+                self._pass_on(index, future.result())
+            except RetryLater as e:
+                self._defer(index, e.item, e.delay)
+                continue
+            except BaseException as e:  # noqa: BLE001
+                self._fail(e)
+            self._processed(index)
+
+    def _defer(self, index: int, item: Any, delay: float) -> None:  # noqa: ANN401
+        with self._retry_condition:
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_counter), index, item))
+            self._retry_condition.notify()
+
+    def _retry(self) -> None:
+        while True:
+            with self._retry_condition:
+                if self._finished.is_set():
+                    return
+                if self._retries and self._error is None:
+                    wait = self._retries[0][0] - time.monotonic()
+                elif self._retries:
+                    wait = 0
+                else:
+                    wait = None
+                if wait is None or wait > 0:
+                    self._retry_condition.wait(wait)
+                    continue
+                _, _, index, item = heapq.heappop(self._retries)
+            if self._error is None:
+                # The item is still counted as outstanding in its stage, so it goes straight back on the queue
+                self.queues[index].put(item)
+            else:
+                self._item_done(index)
+
+    def _fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                logger.debug(f"Pipeline stopping due to error in {threading.current_thread().name}: {error}")
+                self._error = error
+        with self._retry_condition:
+            self._retry_condition.notify_all()
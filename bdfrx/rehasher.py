@@ -0,0 +1,77 @@
+import itertools
+import logging
+import os
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import appdirs
+
+from bdfrx.configuration import Configuration
+from bdfrx.connector import RedditConnector
+from bdfrx.existing_files import FileHasher
+from bdfrx.hashing import get_hash_algorithm
+from bdfrx.scan_cache import ScanCache
+
+logger = logging.getLogger(__name__)
+
+
+class Rehasher(RedditConnector):
+    """Updates the hashes in the DB to the configured hash algorithm, without connecting to Reddit"""
+
+    batch_size = 1000
+
+    def __init__(self, args: Configuration, logging_handlers: Iterable[logging.Handler] = ()) -> None:
+        self.args = args
+        self.config_directories = appdirs.AppDirs("bdfrx", "BDFRx")
+        self.determine_directories()
+        self.load_config()
+        self.read_config()
+        file_log = self.create_file_logger()
+        self._apply_logging_handlers(itertools.chain(logging_handlers, [file_log]))
+        self.load_db()
+
+    def download(self) -> None:
+        self.rehash()
+
+    def rehash(self) -> None:
+        """Hash every file in the DB again, the DB committing in batches so that an interrupted rehash can be resumed"""
+        algorithm = get_hash_algorithm()
+        workers = self.cfg_parser.getint("DEFAULT", "scan_threads", fallback=15)
+        scan_cache = ScanCache(Path(self.config_directory, "scan_cache.db"))
+        outdated_rows: dict[Path, list[int]] = {}
+        updated = 0
+        try:
+            hasher = FileHasher(workers, scan_cache)
+            for file, file_hash in hasher.hash_files(self._outdated_files(algorithm, outdated_rows)):
+                for row_id in outdated_rows.pop(file, []):
+                    self.db.write("UPDATE download SET hash=?, algorithm=? WHERE id=?;", (file_hash, algorithm, row_id))
+                    updated += 1
+        finally:
+            self.db.commit()
+            scan_cache.close()
+        logger.info(f"Updated {updated} hashes in the DB to {algorithm}")
+
+    def _outdated_files(
+        self,
+        algorithm: str,
+        outdated_rows: dict[Path, list[int]],
+    ) -> Iterator[tuple[Path, os.stat_result]]:
+        """Yields the files whose hashes were made with another algorithm, noting the rows to update"""
+        last_row = 0
+        missing = 0
+        while rows := self.db.query(
+            "SELECT id, path FROM download WHERE algorithm != ? AND hash IS NOT NULL AND id > ? ORDER BY id LIMIT ?;",
+            (algorithm, last_row, self.batch_size),
+        ).fetchall():
+            last_row = rows[-1][0]
+            for row_id, path in rows:
+                try:
+                    file = Path(path)
+                    stat = file.stat()
+                except (TypeError, OSError):
+                    missing += 1
+                    continue
+                outdated_rows.setdefault(file, []).append(row_id)
+                yield file, stat
+        if missing:
+            logger.warning(f"{missing} files in the DB no longer exist, so their hashes could not be updated")
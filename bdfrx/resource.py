@@ -1,15 +1,25 @@
-import hashlib
+import asyncio
+import errno
+import json
 import logging
 import re
-import time
+import shutil
+import threading
 import urllib.parse
-from collections.abc import Callable
-from typing import TYPE_CHECKING, Optional
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple, Optional, Union
 
 import requests
 from praw.models import Submission
 
-from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.content_index import ResponseMetadata, total_length
+from bdfrx.exceptions import BulkDownloaderException, ResourceNotFound, RetryableDownloadError
+from bdfrx.hashing import new_hash
+from bdfrx.scheduler import PERMANENT_STATUS_CODES, RETRYABLE_STATUS_CODES
+from bdfrx.transport import AsyncTransport, Transport, get_transport
 
 if TYPE_CHECKING:
     import _hashlib
@@ -17,44 +27,135 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+class DownloadedFile(NamedTuple):
+    path: Path
+    file_hash: "_hashlib.HASH"
+    metadata: Optional[ResponseMetadata] = None
+
+
+class KnownContent(NamedTuple):
+    """A download that was stopped before its body was read, as its headers match an existing file"""
+
+    path: Path
+
+
 class Resource:
+    chunk_size = 1024 * 1024
+
     def __init__(
         self,
         source_submission: Submission,
         url: str,
         download_function: Callable,
         extension: Optional[str] = None,
+        expected_size: Optional[int] = None,
     ) -> None:
         self.source_submission = source_submission
         self.content: Optional[bytes] = None
+        self.path: Optional[Path] = None
+        self.metadata: Optional[ResponseMetadata] = None
+        self.known_file: Optional[Path] = None
         self.url = url
         self.hash: Optional[_hashlib.HASH] = None
         self.extension = extension
+        self.expected_size = expected_size
+        self.reserved_bytes = 0
         self.download_function = download_function
         if not self.extension:
             self.extension = self._determine_extension()
 
     @staticmethod
     def retry_download(url: str) -> Callable:
-        return lambda global_params: Resource.http_download(url, global_params)
+        return partial(Resource.http_download, url)
+
+    @property
+    def http_url(self) -> Optional[str]:
+        """The URL of a resource that is a plain download with http_download, which download_async can fetch"""
+        function = self.download_function
+        if isinstance(function, partial) and function.func is Resource.http_download and len(function.args) == 1:
+            return function.args[0]
+        return None
 
     def download(self, download_parameters: Optional[dict] = None) -> None:
+        """Download the resource into memory, or into a file when the download function streams to disk
+
+        If a destination is given in the download parameters, downloads that support it are streamed to a
+        temporary file next to the destination instead of being held in memory. If a download is found to be
+        of an existing file from its headers, only known_file is set
+        """
         if download_parameters is None:
             download_parameters = {}
-        if not self.content:
+        if not self.content and not self.path and not self.known_file:
             try:
                 content = self.download_function(download_parameters)
             except requests.exceptions.ConnectionError as e:
-                raise BulkDownloaderException(f"Could not download resource: {e}")
+                raise RetryableDownloadError(f"Could not download resource: {e}")
             except BulkDownloaderException:
                 raise
-            if content:
-                self.content = content
-        if not self.hash and self.content:
+            self._keep_download(content)
+        if not self.hash and (self.content or self.path):
             self.create_hash()
 
+    async def download_async(self, transport: AsyncTransport, download_parameters: Optional[dict] = None) -> None:
+        """Download the resource as download does, as a coroutine on the event loop of the transport
+
+        Only resources with an http_url can be downloaded this way, and reserve_bytes in the download parameters
+        is a coroutine function
+        """
+        if not self.content and not self.path and not self.known_file:
+            self._keep_download(await self.http_download_async(self.http_url, transport, download_parameters or {}))
+        if not self.hash and (self.content or self.path):
+            self.create_hash()
+
+    def _keep_download(self, content: Union[bytes, DownloadedFile, KnownContent, Path, None]) -> None:
+        if isinstance(content, DownloadedFile):
+            self.path, self.hash, self.metadata = content
+        elif isinstance(content, KnownContent):
+            self.known_file = content.path
+        elif isinstance(content, Path):
+            self.path = content
+        elif content:
+            self.content = content
+
     def create_hash(self) -> None:
-        self.hash = hashlib.md5(self.content, usedforsecurity=False)
+        if self.path:
+            self.hash = new_hash()
+            with self.path.open("rb") as file:
+                while chunk := file.read(self.chunk_size):
+                    self.hash.update(chunk)
+        else:
+            self.hash = new_hash(self.content)
+
+    def discard_download(self) -> None:
+        """Delete the temporary file of a download that was not moved into place"""
+        if self.path:
+            self.path.unlink(missing_ok=True)
+            self.validator_path(self.path).unlink(missing_ok=True)
+            self.path = None
+
+    def release(self) -> None:
+        """Drop the downloaded data and the source submission once the resource has been written or skipped"""
+        self.discard_download()
+        self.content = None
+        self.source_submission = None
+
+    @staticmethod
+    def part_path(destination: Path) -> Path:
+        return destination.with_name(destination.name + ".part")
+
+    @staticmethod
+    def validator_path(part_path: Path) -> Path:
+        return part_path.with_name(part_path.name + ".json")
+
+    @staticmethod
+    def move_file(source: Path, target: Path) -> None:
+        """Rename a file into place, or copy it in the kernel with sendfile when it is on another filesystem"""
+        try:
+            source.replace(target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(source, target)
 
     def _determine_extension(self) -> Optional[str]:
         extension_pattern = re.compile(r".*(\..{3,5})$")
@@ -65,29 +166,424 @@ class Resource:
         return None
 
     @staticmethod
-    def http_download(url: str, download_parameters: dict) -> Optional[bytes]:
+    def http_download(url: str, download_parameters: dict) -> Union[bytes, DownloadedFile, KnownContent]:
         headers = download_parameters.get("headers")
-        current_wait_time = 60
-        max_wait_time = download_parameters.get("max_wait_time", 300)
-        while True:
-            try:
-                response = requests.get(url, headers=headers, timeout=16)
+        destination = download_parameters.get("destination")
+        reserve = download_parameters.get("reserve_bytes", _reserve_nothing)
+        find_known = download_parameters.get("find_known_content", _know_nothing)
+        transport = get_transport()
+        try:
+            if destination is not None:
+                partial = PartialDownload(url, destination)
+                response, downloaded = partial.download(transport, headers, reserve, find_known)
+                if downloaded:
+                    return downloaded
+            else:
+                response = transport.get(url, headers=headers)
                 if re.match(r"^2\d{2}", str(response.status_code)) and response.content:
+                    reserve(len(response.content))
                     return response.content
-                if response.status_code in (408, 429):
-                    raise requests.exceptions.ConnectionError(f"Response code {response.status_code}")
-                raise BulkDownloaderException(
-                    f"Unrecoverable error requesting resource: HTTP Code {response.status_code}",
-                )
-            except (
-                requests.exceptions.ConnectionError,
-                requests.exceptions.ChunkedEncodingError,
-                requests.exceptions.Timeout,
-            ) as e:
-                logger.warning(f"Error occured downloading from {url}, waiting {current_wait_time} seconds: {e}")
-                time.sleep(current_wait_time)
-                if current_wait_time < max_wait_time:
-                    current_wait_time += 60
-                else:
-                    logger.error(f"Max wait time exceeded for resource at url {url}")
-                    raise
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as e:
+            raise RetryableDownloadError(f"Error occured downloading from {url}: {e}")
+        response.close()
+        raise Resource._status_error(url, response, transport)
+
+    @staticmethod
+    async def http_download_async(
+        url: str,
+        transport: AsyncTransport,
+        download_parameters: dict,
+    ) -> Union[bytes, DownloadedFile, KnownContent]:
+        headers = download_parameters.get("headers")
+        destination = download_parameters.get("destination")
+        reserve = download_parameters.get("reserve_bytes", _reserve_nothing_async)
+        find_known = download_parameters.get("find_known_content", _know_nothing)
+        try:
+            if destination is not None:
+                partial_download = PartialDownload(url, destination)
+                response, downloaded = await partial_download.download_async(transport, headers, reserve, find_known)
+                if downloaded:
+                    return downloaded
+            else:
+                response = await transport.get_async(url, headers=headers)
+                if re.match(r"^2\d{2}", str(response.status_code)):
+                    try:
+                        content = b"".join(
+                            [chunk async for chunk in transport.iter_content_async(response, Resource.chunk_size)],
+                        )
+                    finally:
+                        response.close()
+                    if content:
+                        await reserve(len(content))
+                        return content
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as e:
+            raise RetryableDownloadError(f"Error occured downloading from {url}: {e}")
+        response.close()
+        raise Resource._status_error(url, response, transport)
+
+    @staticmethod
+    def _status_error(url: str, response: requests.Response, transport: Transport) -> BulkDownloaderException:
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            # Requests to a rate-limited host are held back by the scheduler, so wait at least that long to retry
+            host = urllib.parse.urlsplit(url).hostname
+            return RetryableDownloadError(
+                f"Response code {response.status_code} downloading from {url}",
+                retry_after=transport.scheduler.remaining_delay(host),
+            )
+        if response.status_code in PERMANENT_STATUS_CODES:
+            return ResourceNotFound(
+                f"Unrecoverable error requesting resource: HTTP Code {response.status_code}",
+                response.status_code,
+            )
+        return BulkDownloaderException(
+            f"Unrecoverable error requesting resource: HTTP Code {response.status_code}",
+        )
+
+
+def _reserve_nothing(_size: int) -> None:
+    pass
+
+
+async def _reserve_nothing_async(_size: int) -> None:
+    pass
+
+
+def _know_nothing(_metadata: ResponseMetadata) -> Optional[Path]:
+    return None
+
+
+def _range_start(response: requests.Response) -> Optional[int]:
+    if match := re.match(r"bytes (\d+)-", response.headers.get("Content-Range", "")):
+        return int(match.group(1))
+    return None
+
+
+class PartialDownload:
+    """A download streamed to a .part file beside its destination
+
+    The validators of the response are kept in a sidecar file while the download is in progress, so that a retry
+    or a later run can continue the same file with a Range request. The file is started again if the server does
+    not support ranges or the file has changed
+    """
+
+    def __init__(self, url: str, destination: Path) -> None:
+        self.url = url
+        self.path = Resource.part_path(destination)
+        self.validator_path = Resource.validator_path(self.path)
+
+    def resume_headers(self) -> dict[str, str]:
+        try:
+            size = self.path.stat().st_size
+            validators = json.loads(self.validator_path.read_text())
+        except (OSError, ValueError):
+            return {}
+        if not size or validators.get("url") != self.url:
+            return {}
+        # Weak entity tags cannot be used for a range request, only the modification time
+        etag = validators.get("etag")
+        validator = etag if etag and not etag.startswith("W/") else validators.get("last_modified")
+        if not validator:
+            return {}
+        return {"Range": f"bytes={size}-", "If-Range": validator}
+
+    def save_validators(self, response: requests.Response) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        accepts_ranges = response.status_code == 206 or response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        if accepts_ranges and (etag or last_modified):
+            validators = {
+                "url": self.url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_length": total_length(response),
+            }
+            self.validator_path.write_text(json.dumps(validators))
+        else:
+            self.validator_path.unlink(missing_ok=True)
+
+    def _request(self, transport: Transport, headers: Optional[dict], resume_headers: dict) -> requests.Response:
+        request_headers = {**(headers or {}), **resume_headers}
+        return transport.get(self.url, headers=request_headers or None, stream=True)
+
+    def download(
+        self,
+        transport: Transport,
+        headers: Optional[dict],
+        reserve: Callable[[int], None] = _reserve_nothing,
+        find_known: Callable[[ResponseMetadata], Optional[Path]] = _know_nothing,
+    ) -> tuple[requests.Response, Union[DownloadedFile, KnownContent, None]]:
+        """Returns the response, and the downloaded file if the response was successful
+
+        The headers of the response are passed to find_known first, and if it returns an existing file the body
+        is not read. Otherwise the size of the body is passed to reserve before it is read, which may block until
+        there is room for it. A file that is large enough to be segmented is fetched in ranges instead, the first
+        response only being used for its headers
+        """
+        resume_headers = self.resume_headers()
+        response = self._request(transport, headers, resume_headers)
+        offset = self._resume_offset(response, resume_headers)
+        if offset is None:
+            response.close()
+            self.discard()
+            response = self._request(transport, headers, {})
+            offset = 0
+        if not re.match(r"^2\d{2}", str(response.status_code)):
+            return response, None
+        metadata = ResponseMetadata.from_response(self.url, response)
+        if known := self._find_known(response, find_known, metadata):
+            return response, known
+        segment_size, validator = (None, {}) if offset else SegmentedDownload.probe(transport, response)
+        if segment_size is not None:
+            response.close()
+            reserve(segment_size)
+            segmented = SegmentedDownload(self.url, self.path)
+            if downloaded := segmented.download(transport, headers, segment_size, validator, metadata):
+                return response, downloaded
+            response = self._request(transport, headers, {})
+            if not re.match(r"^2\d{2}", str(response.status_code)):
+                return response, None
+        elif response.headers.get("Content-Length", "").isdigit():
+            # The response holds a slot for its host, which a download holding the budget may be waiting for
+            with transport.scheduler.suspend(urllib.parse.urlsplit(self.url).hostname):
+                reserve(int(response.headers["Content-Length"]))
+
+        file_hash = self._start_file(response, offset)
+        size = offset
+        try:
+            with self.path.open("ab" if offset else "wb") as file:
+                for chunk in response.iter_content(chunk_size=Resource.chunk_size):
+                    file_hash.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self._keep_if_resumable()
+            raise
+        finally:
+            response.close()
+        return response, self._finish_file(size, file_hash, metadata)
+
+    async def download_async(
+        self,
+        transport: AsyncTransport,
+        headers: Optional[dict],
+        reserve: Callable[[int], Awaitable[None]] = _reserve_nothing_async,
+        find_known: Callable[[ResponseMetadata], Optional[Path]] = _know_nothing,
+    ) -> tuple[requests.Response, Union[DownloadedFile, KnownContent, None]]:
+        """As download, as a coroutine on the event loop of the transport, with reserve being a coroutine function
+
+        A file large enough to be segmented has its ranges fetched in a thread of the loop's executor, as they are
+        written into the file from threads of their own
+        """
+        resume_headers = self.resume_headers()
+        response = await self._request_async(transport, headers, resume_headers)
+        offset = self._resume_offset(response, resume_headers)
+        if offset is None:
+            response.close()
+            self.discard()
+            response = await self._request_async(transport, headers, {})
+            offset = 0
+        if not re.match(r"^2\d{2}", str(response.status_code)):
+            return response, None
+        metadata = ResponseMetadata.from_response(self.url, response)
+        if known := self._find_known(response, find_known, metadata):
+            return response, known
+        segment_size, validator = (None, {}) if offset else SegmentedDownload.probe(transport, response)
+        if segment_size is not None:
+            response.close()
+            await reserve(segment_size)
+            segmented = SegmentedDownload(self.url, self.path)
+            if downloaded := await asyncio.get_running_loop().run_in_executor(
+                None,
+                partial(segmented.download, transport, headers, segment_size, validator, metadata),
+            ):
+                return response, downloaded
+            response = await self._request_async(transport, headers, {})
+            if not re.match(r"^2\d{2}", str(response.status_code)):
+                return response, None
+        elif response.headers.get("Content-Length", "").isdigit():
+            async with transport.scheduler.suspend_async(urllib.parse.urlsplit(self.url).hostname):
+                await reserve(int(response.headers["Content-Length"]))
+
+        file_hash = self._start_file(response, offset)
+        size = offset
+        try:
+            with self.path.open("ab" if offset else "wb") as file:
+                async for chunk in transport.iter_content_async(response, Resource.chunk_size):
+                    file_hash.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self._keep_if_resumable()
+            raise
+        finally:
+            response.close()
+        return response, self._finish_file(size, file_hash, metadata)
+
+    async def _request_async(
+        self,
+        transport: AsyncTransport,
+        headers: Optional[dict],
+        resume_headers: dict,
+    ) -> requests.Response:
+        request_headers = {**(headers or {}), **resume_headers}
+        return await transport.get_async(self.url, headers=request_headers or None)
+
+    def _resume_offset(self, response: requests.Response, resume_headers: dict) -> Optional[int]:
+        """Returns where the response continues the file from, or None if it must be requested again in full"""
+        if not resume_headers:
+            return 0
+        if response.status_code == 206 and _range_start(response) == self.path.stat().st_size:
+            offset = self.path.stat().st_size
+            logger.debug(f"Resuming download of {self.url} from byte {offset}")
+            return offset
+        if response.status_code in (206, 416):
+            # The range was not the one asked for or is past the end of the file, so start again
+            return None
+        return 0
+
+    def _find_known(
+        self,
+        response: requests.Response,
+        find_known: Callable[[ResponseMetadata], Optional[Path]],
+        metadata: ResponseMetadata,
+    ) -> Optional[KnownContent]:
+        if existing := find_known(metadata):
+            response.close()
+            self.discard()
+            logger.debug(f"Headers of {self.url} match {existing}, not downloading it")
+            return KnownContent(existing)
+        return None
+
+    def _start_file(self, response: requests.Response, offset: int) -> "_hashlib.HASH":
+        """Hashes the part of the file already downloaded, and saves the validators of the response beside it"""
+        file_hash = new_hash()
+        if offset:
+            with self.path.open("rb") as file:
+                while chunk := file.read(Resource.chunk_size):
+                    file_hash.update(chunk)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.save_validators(response)
+        return file_hash
+
+    def _keep_if_resumable(self) -> None:
+        # Keep what has been downloaded only if the server will let it be continued
+        if not self.validator_path.exists():
+            self.path.unlink(missing_ok=True)
+
+    def _finish_file(
+        self,
+        size: int,
+        file_hash: "_hashlib.HASH",
+        metadata: ResponseMetadata,
+    ) -> Optional[DownloadedFile]:
+        if not size:
+            self.discard()
+            return None
+        self.validator_path.unlink(missing_ok=True)
+        return DownloadedFile(self.path, file_hash, metadata)
+
+    def discard(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.validator_path.unlink(missing_ok=True)
+
+
+class SegmentedDownload:
+    """A large download split into byte ranges that are fetched at once over separate connections
+
+    Some servers limit the speed of each connection, so a large file comes down faster in several ranges. The
+    ranges are written into a file of the full size, which is then hashed as a whole. Whether a file is segmented
+    is decided from the headers of the response that would otherwise stream it, so no request is made to find out.
+    A range that comes back other than as asked means the file is downloaded as a single stream instead
+    """
+
+    def __init__(self, url: str, path: Path) -> None:
+        self.url = url
+        self.path = path
+        self._failed = threading.Event()
+
+    @staticmethod
+    def probe(transport: Transport, response: requests.Response) -> tuple[Optional[int], dict[str, str]]:
+        """Returns the size of the file if it should be segmented, and the validator to send with each range"""
+        size = response.headers.get("Content-Length", "")
+        if (
+            transport.segments < 2
+            or response.status_code != 200
+            or response.headers.get("Accept-Ranges", "").lower() != "bytes"
+            or not size.isdigit()
+            or int(size) < max(transport.segment_threshold, transport.segments)
+        ):
+            return None, {}
+        etag = response.headers.get("ETag")
+        validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+        return int(size), {"If-Range": validator} if validator else {}
+
+    @staticmethod
+    def ranges(size: int, segments: int) -> list[tuple[int, int]]:
+        step = -(-size // segments)
+        return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    def download(
+        self,
+        transport: Transport,
+        headers: Optional[dict],
+        size: int,
+        validator: dict[str, str],
+        metadata: ResponseMetadata,
+    ) -> Optional[DownloadedFile]:
+        ranges = self.ranges(size, transport.segments)
+        logger.debug(f"Downloading {self.url} ({size} bytes) in {len(ranges)} segments")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("wb") as file:
+            file.truncate(size)
+        try:
+            with ThreadPoolExecutor(len(ranges), thread_name_prefix="segment") as executor:
+                futures = [
+                    executor.submit(self._fetch_range, transport, {**(headers or {}), **validator}, start, end)
+                    for start, end in ranges
+                ]
+                fetched = all(future.result() for future in futures)
+        except BaseException:
+            self.path.unlink(missing_ok=True)
+            raise
+        if not fetched:
+            logger.debug(f"Server did not return the ranges asked for, downloading {self.url} as one stream")
+            self.path.unlink(missing_ok=True)
+            return None
+        file_hash = new_hash()
+        with self.path.open("rb") as file:
+            while chunk := file.read(Resource.chunk_size):
+                file_hash.update(chunk)
+        return DownloadedFile(self.path, file_hash, metadata)
+
+    def _fetch_range(self, transport: Transport, headers: dict, start: int, end: int) -> bool:
+        if self._failed.is_set():
+            return False
+        try:
+            response = transport.get(self.url, headers={**headers, "Range": f"bytes={start}-{end}"}, stream=True)
+            if response.status_code != 206 or _range_start(response) != start:
+                response.close()
+                self._failed.set()
+                return False
+            position = start
+            with response, self.path.open("r+b") as file:
+                file.seek(start)
+                for chunk in response.iter_content(chunk_size=Resource.chunk_size):
+                    if self._failed.is_set():
+                        return False
+                    file.write(chunk[: end + 1 - position])
+                    position += len(chunk)
+        except BaseException:
+            self._failed.set()
+            raise
+        if position <= end:
+            self._failed.set()
+            raise requests.exceptions.ChunkedEncodingError(f"Range {start}-{end} of {self.url} ended early")
+        return True
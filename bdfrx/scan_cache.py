@@ -0,0 +1,93 @@
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from bdfrx.hashing import get_hash_algorithm
+
+logger = logging.getLogger(__name__)
+
+
+class FileKey(NamedTuple):
+    """Identifies one version of a file, any change to it gives a different key"""
+
+    path: str
+    inode: int
+    size: int
+    mtime_ns: int
+
+    @staticmethod
+    def from_stat(path: Path, stat: os.stat_result) -> "FileKey":
+        return FileKey(str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ScanCache:
+    """Keeps the hashes of scanned files between runs, so only new or changed files are hashed again
+
+    Hashes are written as they are calculated and committed every checkpoint_interval files, so an interrupted
+    scan picks up from the last checkpoint. Hashes made with each algorithm are kept apart
+    """
+
+    def __init__(self, path: Path, checkpoint_interval: int = 1000, algorithm: Optional[str] = None) -> None:
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.algorithm = algorithm or get_hash_algorithm()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        with self._lock:
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(scan_cache);")]
+            if columns and "algorithm" not in columns:
+                # The cache can always be rebuilt, so an old layout is started again rather than migrated
+                self._connection.execute("DROP TABLE scan_cache;")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS scan_cache (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    inode INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                );""",
+            )
+            self._connection.commit()
+
+    def get(self, key: FileKey) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT hash FROM scan_cache WHERE path=? AND algorithm=? AND inode=? AND size=? AND mtime_ns=?;",
+                (key.path, self.algorithm, key.inode, key.size, key.mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: FileKey, file_hash: str) -> None:
+        self.put_many(((key, file_hash),))
+
+    def put_many(self, entries: Iterable[tuple[FileKey, str]]) -> None:
+        rows = [(*key, self.algorithm, file_hash) for key, file_hash in entries]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO scan_cache (path, inode, size, mtime_ns, algorithm, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?);",
+                rows,
+            )
+            self._uncommitted += len(rows)
+            if self._uncommitted >= self.checkpoint_interval:
+                self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        self._connection.commit()
+        logger.log(9, f"Saved {self._uncommitted} file hashes to the scan cache")
+        self._uncommitted = 0
+
+    def commit(self) -> None:
+        with self._lock:
+            self._checkpoint()
+
+    def close(self) -> None:
+        self.commit()
+        self._connection.close()
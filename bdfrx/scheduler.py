@@ -0,0 +1,312 @@
+import asyncio
+import email.utils
+import logging
+import re
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from typing import NamedTuple, Optional
+
+from bdfrx.exceptions import BulkDownloaderException, RetryableDownloadError
+
+logger = logging.getLogger(__name__)
+
+
+# Responses that mean the server is overloaded or limiting requests, and that the request may succeed if retried
+RETRYABLE_STATUS_CODES = frozenset((408, 429))
+# Responses that mean the resource is gone, and that retrying will not bring it back
+PERMANENT_STATUS_CODES = frozenset((404, 410))
+
+
+class HostLimit(NamedTuple):
+    max_in_flight: int
+    rate: float = 0
+
+
+def is_congestion_status(status_code: int) -> bool:
+    return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+
+def _release_nothing() -> None:
+    pass
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _HostState:
+    initial_window = 2
+    latency_smoothing = 0.2
+    latency_tolerance = 1.5
+
+    def __init__(self, host: str, limit: HostLimit, adaptive: bool) -> None:  # noqa: FBT001
+        self.host = host
+        self.limit = limit
+        self.adaptive = adaptive
+        self.lock = threading.Condition()
+        # Coroutines waiting for a slot, with the loop each is running on
+        self.waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self.in_flight = 0
+        self.window = float(min(self.initial_window, limit.max_in_flight) if adaptive else limit.max_in_flight)
+        self.latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.capacity = max(1.0, limit.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def acquire(self) -> None:
+        with self.lock:
+            while self.in_flight >= int(self.window):
+                self.lock.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < int(self.window):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.lock:
+                    try:
+                        self.waiters.remove((loop, waiter))
+                    except ValueError:
+                        # The waiter had already been woken, so pass that on to another
+                        self.notify()
+                raise
+
+    def release(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            self.notify()
+
+    def notify(self) -> None:
+        """Wakes a waiting thread and a waiting coroutine, if there are any, to try for a slot"""
+        self.lock.notify()
+        if self.waiters:
+            loop, waiter = self.waiters.popleft()
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def paused_for(self) -> float:
+        with self.lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def reserve(self) -> float:
+        """Take a token from the bucket and return the time to wait before it can be used"""
+        with self.lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.limit.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.limit.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.limit.rate)
+            return wait
+
+    def increase(self, latency: float) -> None:
+        """Widen the window by one request per window of successful requests while latency stays flat"""
+        with self.lock:
+            previous = self.latency
+            self.latency = latency if previous is None else previous + self.latency_smoothing * (latency - previous)
+            if not self.adaptive or (previous is not None and latency > previous * self.latency_tolerance):
+                return
+            old_window = int(self.window)
+            self.window = min(float(self.limit.max_in_flight), self.window + 1 / self.window)
+            if int(self.window) > old_window:
+                logger.log(9, f"Raised concurrency for {self.host} to {int(self.window)}")
+                self.notify()
+
+    def decrease(self) -> None:
+        """Halve the window, at most once per round trip so that one burst of failures only counts once"""
+        with self.lock:
+            now = time.monotonic()
+            if not self.adaptive or now - self.last_decrease < max(1.0, self.latency or 0):
+                return
+            self.last_decrease = now
+            self.window = max(1.0, self.window / 2)
+            logger.debug(f"Lowered concurrency for {self.host} to {int(self.window)}")
+
+
+class HostScheduler:
+    """Limits the requests in flight and the request rate for each host
+
+    Limits apply to a host and all of its subdomains, with the most specific host taking precedence. Hosts
+    without a limit are only limited by the default number of requests in flight
+
+    When adaptive, the requests in flight for a host start low and grow while responses stay fast, up to the
+    host's limit. The window is halved when the host times out, limits requests, or returns a server error
+
+    A request to a host that has been paused, such as after a rate-limit response, is not held back but fails at
+    once with a RetryableDownloadError, so that the item can be retried later without tying up a worker. Pauses
+    are no longer than max_penalty seconds, whatever the host asks for
+    """
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, HostLimit]] = None,
+        default_limit: HostLimit = HostLimit(10),  # noqa: B008
+        penalty: float = 10,
+        adaptive: bool = True,  # noqa: FBT001,FBT002
+        max_penalty: float = 300,
+    ) -> None:
+        self.limits = {host.lower(): limit for host, limit in (limits or {}).items()}
+        self.default_limit = default_limit
+        self.penalty = penalty
+        self.max_penalty = max_penalty
+        self.adaptive = adaptive
+        self._hosts: dict[str, _HostState] = {}
+        self._lock = threading.Lock()
+
+    def limit_for(self, host: str) -> tuple[str, HostLimit]:
+        host = host.lower()
+        parts = host.split(".")
+        for i in range(len(parts)):
+            key = ".".join(parts[i:])
+            if key in self.limits:
+                return key, self.limits[key]
+        return host, self.default_limit
+
+    def _state(self, host: str) -> _HostState:
+        key, limit = self.limit_for(host)
+        with self._lock:
+            if key not in self._hosts:
+                self._hosts[key] = _HostState(key, limit, self.adaptive)
+            return self._hosts[key]
+
+    @contextmanager
+    def slot(self, host: Optional[str]) -> Iterator[None]:
+        if not host:
+            yield
+            return
+        state = self._state(host)
+        self._check_paused(host, state)
+        state.acquire()
+        try:
+            # The host may have been paused while waiting for a free slot
+            self._check_paused(host, state)
+            wait = state.reserve()
+            if wait > 0:
+                logger.log(9, f"Waiting {wait:.2f} seconds to send request to {host}")
+                time.sleep(wait)
+            yield
+        finally:
+            state.release()
+
+    async def acquire_async(self, host: Optional[str]) -> Callable[[], None]:
+        """Takes a slot as slot does, waiting on the running event loop, and returns the function that frees it"""
+        if not host:
+            return _release_nothing
+        state = self._state(host)
+        self._check_paused(host, state)
+        await state.acquire_async()
+        try:
+            self._check_paused(host, state)
+            wait = state.reserve()
+            if wait > 0:
+                logger.log(9, f"Waiting {wait:.2f} seconds to send request to {host}")
+                await asyncio.sleep(wait)
+        except BaseException:
+            state.release()
+            raise
+        return state.release
+
+    @contextmanager
+    def suspend(self, host: Optional[str]) -> Iterator[None]:
+        """Gives up a slot held for a host while waiting on something else, such as the byte budget
+
+        Waiting with the slot held could block a request that holds what is being waited on. The slot is taken again
+        afterwards, once there is room in the host's window
+        """
+        if not host:
+            yield
+            return
+        state = self._state(host)
+        state.release()
+        try:
+            yield
+        finally:
+            state.acquire()
+
+    @asynccontextmanager
+    async def suspend_async(self, host: Optional[str]) -> AsyncIterator[None]:
+        """As suspend, taking the slot again on the running event loop"""
+        if not host:
+            yield
+            return
+        state = self._state(host)
+        state.release()
+        try:
+            yield
+        finally:
+            await state.acquire_async()
+
+    @staticmethod
+    def _check_paused(host: str, state: _HostState) -> None:
+        if (remaining := state.paused_for()) > 0:
+            raise RetryableDownloadError(
+                f"Requests to {host} are paused for {remaining:.0f} seconds",
+                retry_after=remaining,
+            )
+
+    def record_response(self, host: str, status_code: int, latency: float) -> None:
+        state = self._state(host)
+        if is_congestion_status(status_code):
+            state.decrease()
+        elif status_code < 400:
+            state.increase(latency)
+
+    def record_failure(self, host: str) -> None:
+        """Record a request that timed out or could not connect"""
+        self._state(host).decrease()
+
+    def windows(self) -> dict[str, int]:
+        with self._lock:
+            states = list(self._hosts.values())
+        return {state.host: int(state.window) for state in states}
+
+    def penalise(self, host: str, delay: Optional[float] = None) -> None:
+        """Hold back all further requests to a host, such as after a rate-limit response"""
+        delay = min(self.max_penalty, self.penalty if delay is None else delay)
+        state = self._state(host)
+        with state.lock:
+            state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+        logger.debug(f"Pausing requests to {host} for {delay:.0f} seconds")
+
+    def remaining_delay(self, host: str) -> float:
+        return self._state(host).paused_for()
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            retry_time = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_time.timestamp() - time.time())
+
+    @staticmethod
+    def parse_limits(entries: list[str]) -> dict[str, HostLimit]:
+        """Parse limits given as host=max_in_flight or host=max_in_flight/requests_per_second"""
+        limits = {}
+        for entry in entries:
+            for limit in filter(None, (part.strip() for part in re.split(r"[,;]\s?", entry))):
+                match = re.fullmatch(r"([\w.-]+)\s*=\s*(\d+)(?:\s*/\s*(\d+(?:\.\d+)?))?", limit)
+                if not match or int(match.group(2)) < 1:
+                    raise BulkDownloaderException(f"Invalid host limit {limit!r}")
+                limits[match.group(1).lower()] = HostLimit(int(match.group(2)), float(match.group(3) or 0))
+        return limits
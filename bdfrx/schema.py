@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+from bdfrx.exceptions import BulkDownloaderException
+
+logger = logging.getLogger(__name__)
+
+# The version of the schema below, kept in the database's user_version. Databases from before it was kept are 0
+SCHEMA_VERSION = 3
+
+_TABLES = (
+    # One row for every resource stored, linked or skipped as a duplicate, with the submission it came from, and
+    # one for every file found by --search-existing. The status is downloaded, duplicate, linked, existing, or
+    # migrated for a row carried over from the old separate tables, which only holds what that table did
+    """CREATE TABLE IF NOT EXISTS download (
+        id INTEGER PRIMARY KEY,
+        post_id TEXT,
+        link TEXT,
+        status TEXT NOT NULL,
+        resource_url TEXT,
+        hash TEXT,
+        algorithm TEXT,
+        size INTEGER,
+        path TEXT,
+        module TEXT,
+        created_utc INTEGER,
+        recorded_at INTEGER NOT NULL
+    );""",
+    """CREATE TABLE IF NOT EXISTS content_metadata (
+        url TEXT NOT NULL PRIMARY KEY,
+        host TEXT NOT NULL,
+        etag TEXT,
+        size INTEGER,
+        last_modified TEXT,
+        path TEXT NOT NULL
+    );""",
+    # One row for every submission or resource that failed to download, until it downloads. A permanent failure, or
+    # one that has been tried too many times, has no next attempt and is not tried again
+    """CREATE TABLE IF NOT EXISTS failure (
+        post_id TEXT NOT NULL,
+        url TEXT NOT NULL,
+        module TEXT,
+        error TEXT NOT NULL,
+        message TEXT,
+        permanent INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        first_failed_at INTEGER NOT NULL,
+        last_failed_at INTEGER NOT NULL,
+        next_attempt_at INTEGER,
+        PRIMARY KEY (post_id, url)
+    );""",
+)
+
+_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS download_post_id ON download (post_id);",
+    "CREATE INDEX IF NOT EXISTS download_link ON download (link);",
+    "CREATE INDEX IF NOT EXISTS download_hash ON download (algorithm, hash);",
+    "CREATE INDEX IF NOT EXISTS content_metadata_etag ON content_metadata (host, etag);",
+    "CREATE INDEX IF NOT EXISTS failure_next_attempt_at ON failure (next_attempt_at) "
+    "WHERE next_attempt_at IS NOT NULL;",
+)
+
+_LEGACY_TABLES = ("hash", "post_id", "link")
+
+
+def upgrade_schema(connection: sqlite3.Connection, path: Path) -> None:
+    """Brings a database up to the current schema in one transaction, so an interrupted upgrade changes nothing
+
+    The connection must not be in a transaction. Rows are copied from the old tables by SQLite itself, so they are
+    never read into memory, and the indexes are only built once the rows are in
+    """
+    version = connection.execute("PRAGMA user_version;").fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise BulkDownloaderException(
+            f"The DB at {path} has schema version {version}, made by a newer version of BDFRx than this one",
+        )
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    legacy_tables = [table for table in _LEGACY_TABLES if table in tables]
+    if legacy_tables:
+        logger.info(f"Upgrading the DB at {path} to schema version {SCHEMA_VERSION}, this may take a few minutes")
+    started = time.perf_counter()
+    connection.execute("BEGIN IMMEDIATE;")
+    try:
+        for statement in _TABLES:
+            connection.execute(statement)
+        copied = _copy_legacy_tables(connection, legacy_tables)
+        for statement in _INDEXES:
+            connection.execute(statement)
+        connection.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+        connection.execute("COMMIT;")
+    except BaseException:
+        connection.execute("ROLLBACK;")
+        raise
+    if legacy_tables:
+        logger.info(f"Moved {copied} rows into the download table in {time.perf_counter() - started:.0f}s")
+
+
+def _copy_legacy_tables(connection: sqlite3.Connection, tables: list[str]) -> int:
+    """Moves the rows of the separate hash, post ID and link tables into the download table"""
+    recorded_at = int(time.time())
+    copied = 0
+    if "hash" in tables:
+        # Hashes stored before the algorithm could be chosen are all MD5 hashes
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(hash);")}
+        algorithm = "algorithm" if "algorithm" in columns else "'md5'"
+        copied += connection.execute(
+            "INSERT INTO download (status, hash, algorithm, path, recorded_at) "  # noqa: S608
+            f"SELECT 'migrated', hash, {algorithm}, path, ? FROM hash ORDER BY rowid;",
+            (recorded_at,),
+        ).rowcount
+    for table in ("post_id", "link"):
+        if table in tables:
+            copied += connection.execute(
+                f"INSERT INTO download (status, {table}, recorded_at) "  # noqa: S608
+                f"SELECT 'migrated', {table}, ? FROM {table} ORDER BY rowid;",
+                (recorded_at,),
+            ).rowcount
+    for table in tables:
+        connection.execute(f"DROP TABLE {table};")
+    return copied
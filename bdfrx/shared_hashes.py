@@ -0,0 +1,140 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.hashing import get_hash_algorithm
+
+logger = logging.getLogger(__name__)
+
+# A hash file is this header followed by the digests in ascending order, each of the header's digest size
+_MAGIC = b"BDFRXHS1"
+_HEADER = struct.Struct("<8s16sI4x")
+
+
+def write_hash_file(path: Path, digests: Iterable[bytes], algorithm: str) -> int:
+    """Writes digests given in ascending order to a hash file, returning the number written
+
+    The file is written beside the target and renamed over it, so a process reading the old file never sees a
+    partly written one
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    digest_size = 0
+    previous = b""
+    file_descriptor, temporary_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(bytes(_HEADER.size))
+            for digest in digests:
+                if digest == previous:
+                    continue
+                if digest < previous or (digest_size and len(digest) != digest_size):
+                    raise BulkDownloaderException("Hashes must be exported in order and of the same length")
+                digest_size = len(digest)
+                file.write(digest)
+                previous = digest
+                count += 1
+            file.seek(0)
+            file.write(_HEADER.pack(_MAGIC, algorithm.encode("ascii"), digest_size))
+            file.flush()
+            os.fsync(file.fileno())
+        Path(temporary_name).replace(path)
+    except BaseException:
+        Path(temporary_name).unlink(missing_ok=True)
+        raise
+    return count
+
+
+class _HashFileView(NamedTuple):
+    identity: tuple[int, int, int]
+    data: Optional[mmap.mmap]
+    digest_size: int
+    count: int
+
+
+class SharedHashSet:
+    """The hashes exported by another instance, searched in place in a memory-mapped hash file
+
+    Nothing is loaded into memory, so a file of any size can be used. The file is checked for a replacement every
+    refresh_interval seconds, and a new file is mapped in its place, so a running download picks up a new export
+    without being restarted. A file made with another hash algorithm is ignored with a warning
+    """
+
+    refresh_interval = 30
+
+    def __init__(self, path: Path, algorithm: Optional[str] = None) -> None:
+        self.path = path
+        self.algorithm = algorithm or get_hash_algorithm()
+        self._lock = threading.Lock()
+        self._view: Optional[_HashFileView] = None
+        self._checked = time.monotonic()
+        self._load()
+
+    def __len__(self) -> int:
+        return self._view.count if self._view else 0
+
+    def __contains__(self, file_hash: str) -> bool:
+        if time.monotonic() - self._checked >= self.refresh_interval:
+            self.refresh()
+        view = self._view
+        if view is None or view.data is None:
+            return False
+        try:
+            digest = bytes.fromhex(file_hash)
+        except ValueError:
+            return False
+        if len(digest) != view.digest_size:
+            return False
+        low, high = 0, view.count
+        while low < high:
+            middle = (low + high) // 2
+            start = _HEADER.size + middle * view.digest_size
+            record = view.data[start : start + view.digest_size]
+            if record == digest:
+                return True
+            if record < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._checked = time.monotonic()
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            stat = self.path.stat()
+        except OSError as e:
+            if self._view is None:
+                logger.warning(f"Could not find hash file {self.path}, it will be used once it is there: {e}")
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._view is not None and self._view.identity == identity:
+            return
+        with self.path.open("rb") as file:
+            header = file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise BulkDownloaderException(f"{self.path} is not a hash file")
+            magic, algorithm, digest_size = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                raise BulkDownloaderException(f"{self.path} is not a hash file")
+            algorithm = algorithm.rstrip(b"\0").decode("ascii")
+            count = (stat.st_size - _HEADER.size) // digest_size if digest_size else 0
+            data = None
+            if algorithm != self.algorithm:
+                logger.warning(f"Hash file {self.path} holds {algorithm} hashes, not {self.algorithm}, ignoring it")
+            elif count:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # A search running in another thread keeps the old map alive until it is done with it
+        self._view = _HashFileView(identity, data, digest_size, count)
+        logger.debug(f"Loaded {count} hashes from {self.path}")
@@ -1,18 +1,23 @@
 import logging
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import ClassVar, Optional
 
 import requests
 from praw.models import Submission
 
 from bdfrx.exceptions import ResourceNotFound, SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
+from bdfrx.transport import get_transport
 
 logger = logging.getLogger(__name__)
 
 
 class BaseDownloader(ABC):
+    # Default limits for the hosts each module requests from, as (max requests in flight, requests per second)
+    host_limits: ClassVar[dict[str, HostLimit]] = {}
+
     def __init__(self, post: Submission, typical_extension: Optional[str] = None) -> None:
         self.post = post
         self.typical_extension = typical_extension
@@ -30,7 +35,7 @@ class BaseDownloader(ABC):
         initial: Optional[str] = None,
     ) -> requests.Response:
         try:
-            res = requests.get(url, cookies=cookies, headers=headers, timeout=16)
+            res = get_transport().get(url, cookies=cookies, headers=headers)
         except requests.exceptions.RequestException as e:
             logger.exception(e)
             raise SiteDownloaderError(f"Failed to get page {url}")
@@ -39,7 +44,7 @@ class BaseDownloader(ABC):
             raise SiteDownloaderError(f"Timeout reached attempting to get page {url}")
         if res.status_code != 200:
             url = initial or url
-            raise ResourceNotFound(f"Server responded with {res.status_code} at {url}")
+            raise ResourceNotFound(f"Server responded with {res.status_code} at {url}", res.status_code)
         return res
 
     @staticmethod
@@ -50,7 +55,7 @@ class BaseDownloader(ABC):
         payload: Optional[dict] = None,
     ) -> requests.Response:
         try:
-            res = requests.post(url, cookies=cookies, headers=headers, json=payload, timeout=16)
+            res = get_transport().post(url, cookies=cookies, headers=headers, payload=payload)
         except requests.exceptions.RequestException as e:
             logger.exception(e)
             raise SiteDownloaderError(f"Failed to post to {url}")
@@ -58,13 +63,13 @@ class BaseDownloader(ABC):
             logger.exception(e)
             raise SiteDownloaderError(f"Timeout reached attempting to post to page {url}")
         if res.status_code != 200:
-            raise ResourceNotFound(f"Server responded with {res.status_code} to {url}")
+            raise ResourceNotFound(f"Server responded with {res.status_code} to {url}", res.status_code)
         return res
 
     @staticmethod
     def head_url(url: str, cookies: Optional[dict] = None, headers: Optional[dict] = None) -> requests.Response:
         try:
-            res = requests.head(url, cookies=cookies, headers=headers, timeout=16)
+            res = get_transport().head(url, cookies=cookies, headers=headers)
         except requests.exceptions.RequestException as e:
             logger.exception(e)
             raise SiteDownloaderError(f"Failed to check head at {url}")
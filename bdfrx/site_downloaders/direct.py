@@ -1,13 +1,16 @@
-from typing import Optional
+from typing import ClassVar, Optional
 
 from praw.models import Submission
 
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
 
 class Direct(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"i.redd.it": HostLimit(8)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
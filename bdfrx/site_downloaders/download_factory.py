@@ -2,6 +2,7 @@ import re
 import urllib.parse
 
 from bdfrx.exceptions import NotADownloadableLinkError
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 from bdfrx.site_downloaders.catbox import Catbox
 from bdfrx.site_downloaders.chevereto import Chevereto
@@ -68,6 +69,17 @@ class DownloadFactory:
             return YtdlpFallback
         raise NotADownloadableLinkError(f"No downloader module exists for url {url}")
 
+    @staticmethod
+    def host_limits() -> dict[str, HostLimit]:
+        limits = {}
+        downloaders = [BaseDownloader]
+        while downloaders:
+            downloader = downloaders.pop()
+            for host, limit in downloader.host_limits.items():
+                limits.setdefault(host, limit)
+            downloaders.extend(downloader.__subclasses__())
+        return limits
+
     @staticmethod
     def sanitise_url(url: str) -> str:
         beginning_regex = re.compile(r"\s*(www\.?)?")
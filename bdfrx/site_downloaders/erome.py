@@ -1,13 +1,14 @@
 import logging
 import re
 from collections.abc import Callable
-from typing import Optional
+from typing import ClassVar, Optional
 
 import bs4
 from praw.models import Submission
 
 from bdfrx.exceptions import SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
@@ -15,6 +16,8 @@ logger = logging.getLogger(__name__)
 
 
 class Erome(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"erome.com": HostLimit(2, 1)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
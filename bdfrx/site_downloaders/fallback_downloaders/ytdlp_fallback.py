@@ -17,11 +17,13 @@ class YtdlpFallback(BaseFallbackDownloader, Youtube):
         super().__init__(post)
 
     def find_resources(self, authenticator: Optional[SiteAuthenticator] = None) -> list[Resource]:
+        attributes = super().get_video_attributes(self.post.url)
         out = Resource(
             self.post,
             self.post.url,
             super()._download_video({}),
-            super().get_video_attributes(self.post.url)["ext"],
+            attributes["ext"],
+            self.expected_size(attributes),
         )
         return [out]
 
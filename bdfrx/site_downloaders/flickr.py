@@ -1,6 +1,7 @@
 import json
 import re
-from typing import Optional
+from threading import Lock
+from typing import ClassVar, Optional
 
 from bs4 import BeautifulSoup
 from cachetools import TTLCache, cached
@@ -8,11 +9,14 @@ from praw.models import Submission
 
 from bdfrx.exceptions import ResourceNotFound, SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
 
 class Flickr(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"flickr.com": HostLimit(2, 1), "staticflickr.com": HostLimit(4)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
         self.raw_data = {}
@@ -24,7 +28,7 @@ class Flickr(BaseDownloader):
         return [Resource(self.post, link, Resource.retry_download(link)) for link in links]
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=5, ttl=10260))
+    @cached(cache=TTLCache(maxsize=5, ttl=10260), lock=Lock())
     def _get_api_key() -> str:
         key_regex = re.compile(r".*api_key=(\w*)(&.*)?")
         res = Flickr.retrieve_url("https://www.flickr.com/services/api/response.json.html").text
@@ -1,10 +1,11 @@
 import logging
-from typing import Optional
+from typing import ClassVar, Optional
 
 from praw.models import Submission
 
 from bdfrx.exceptions import SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
@@ -12,6 +13,8 @@ logger = logging.getLogger(__name__)
 
 
 class Gallery(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"i.redd.it": HostLimit(8)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
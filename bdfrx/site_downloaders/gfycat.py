@@ -1,5 +1,6 @@
 import json
 import re
+from threading import Lock
 from typing import Optional
 
 from cachetools import TTLCache, cached
@@ -19,7 +20,7 @@ class Gfycat(Redgifs):
         return super().find_resources(authenticator)
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=5, ttl=3420))
+    @cached(cache=TTLCache(maxsize=5, ttl=3420), lock=Lock())
     def _get_auth_token() -> str:
         headers = {
             "content-type": "text/plain;charset=UTF-8",
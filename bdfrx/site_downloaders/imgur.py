@@ -1,16 +1,19 @@
 import json
 import re
-from typing import Optional
+from typing import ClassVar, Optional
 
 from praw.models import Submission
 
 from bdfrx.exceptions import SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
 
 class Imgur(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"imgur.com": HostLimit(4, 2)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
         self.raw_data = {}
@@ -30,5 +30,6 @@ class PornHub(Youtube):
             self.post.url,
             super()._download_video(ytdl_options),
             extension,
+            self.expected_size(video_attributes),
         )
         return [out]
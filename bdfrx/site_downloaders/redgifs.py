@@ -1,17 +1,21 @@
 import json
 import re
-from typing import Optional
+from threading import Lock
+from typing import ClassVar, Optional
 
 from cachetools import TTLCache, cached
 from praw.models import Submission
 
 from bdfrx.exceptions import SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
 
 
 class Redgifs(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"api.redgifs.com": HostLimit(2, 1), "redgifs.com": HostLimit(4)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
@@ -20,7 +24,7 @@ class Redgifs(BaseDownloader):
         return [Resource(self.post, m, Resource.retry_download(m), None) for m in media_urls]
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=5, ttl=82080))
+    @cached(cache=TTLCache(maxsize=5, ttl=82080), lock=Lock())
     def _get_auth_token() -> str:
         return json.loads(Redgifs.retrieve_url("https://api.redgifs.com/v2/auth/temporary").text)["token"]
 
@@ -1,10 +1,11 @@
 import logging
-from typing import Optional
+from typing import ClassVar, Optional
 
 from praw.models import Submission
 
 from bdfrx.exceptions import NotADownloadableLinkError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostLimit
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.youtube import Youtube
 
@@ -12,6 +13,8 @@ logger = logging.getLogger(__name__)
 
 
 class VReddit(Youtube):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"v.redd.it": HostLimit(4)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
@@ -21,8 +24,14 @@ class VReddit(Youtube):
             "nooverwrites": True,
         }
         download_function = self._download_video(ytdl_options)
-        extension = self.get_video_attributes(self.post.url)["ext"]
-        res = Resource(self.post, self.post.url, download_function, extension)
+        attributes = self.get_video_attributes(self.post.url)
+        res = Resource(
+            self.post,
+            self.post.url,
+            download_function,
+            attributes["ext"],
+            self.expected_size(attributes),
+        )
         return [res]
 
     @staticmethod
@@ -1,21 +1,62 @@
 import logging
 import tempfile
+import time
+import urllib.parse
 from collections.abc import Callable
 from pathlib import Path
-from typing import Optional
+from typing import ClassVar, Optional, Union
 
 import yt_dlp
 from praw.models import Submission
+from yt_dlp.networking.exceptions import network_exceptions
 
-from bdfrx.exceptions import NotADownloadableLinkError, SiteDownloaderError
+from bdfrx.exceptions import NotADownloadableLinkError, RetryableDownloadError, SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import PERMANENT_STATUS_CODES, HostLimit, HostScheduler, is_congestion_status
 from bdfrx.site_authenticator import SiteAuthenticator
 from bdfrx.site_downloaders.base_downloader import BaseDownloader
+from bdfrx.transport import get_transport
 
 logger = logging.getLogger(__name__)
 
 
+def _transient_cause(error: BaseException) -> Optional[BaseException]:
+    """Returns the network error that a yt-dlp error was raised for, unless it was one that will not go away"""
+    seen = set()
+    cause: Optional[BaseException] = error
+    while cause is not None and id(cause) not in seen:
+        seen.add(id(cause))
+        if isinstance(cause, network_exceptions):
+            return None if getattr(cause, "status", None) in PERMANENT_STATUS_CODES else cause
+        exc_info = getattr(cause, "exc_info", None)
+        cause = (exc_info[1] if exc_info else None) or getattr(cause, "cause", None) or cause.__cause__
+    return None
+
+
+def _retryable_error(
+    scheduler: HostScheduler,
+    host: Optional[str],
+    error: Exception,
+    message: str,
+) -> Optional[RetryableDownloadError]:
+    """Records a failed yt-dlp request against its host, and returns the error to retry it with if it may pass"""
+    if not (cause := _transient_cause(error)):
+        return None
+    if not host:
+        return RetryableDownloadError(f"{message}: {cause}")
+    status = getattr(cause, "status", None)
+    if status is None or is_congestion_status(status):
+        scheduler.record_failure(host)
+    if status == 429:
+        response = getattr(cause, "response", None)
+        headers = getattr(response, "headers", None) or getattr(cause, "headers", None) or {}
+        scheduler.penalise(host, HostScheduler.parse_retry_after(headers.get("Retry-After")))
+    return RetryableDownloadError(f"{message}: {cause}", retry_after=scheduler.remaining_delay(host))
+
+
 class Youtube(BaseDownloader):
+    host_limits: ClassVar[dict[str, HostLimit]] = {"youtube.com": HostLimit(2, 1), "youtu.be": HostLimit(2, 1)}
+
     def __init__(self, post: Submission) -> None:
         super().__init__(post)
 
@@ -26,8 +67,14 @@ class Youtube(BaseDownloader):
             "nooverwrites": True,
         }
         download_function = self._download_video(ytdl_options)
-        extension = self.get_video_attributes(self.post.url)["ext"]
-        res = Resource(self.post, self.post.url, download_function, extension)
+        attributes = self.get_video_attributes(self.post.url)
+        res = Resource(
+            self.post,
+            self.post.url,
+            download_function,
+            attributes["ext"],
+            self.expected_size(attributes),
+        )
         return [res]
 
     def _download_video(self, ytdl_options: dict) -> Callable:
@@ -36,21 +83,36 @@ class Youtube(BaseDownloader):
         ytdl_options["quiet"] = True
         ytdl_options["logger"] = yt_logger
 
-        def download(_: dict) -> bytes:
-            with tempfile.TemporaryDirectory() as temp_dir:
+        def download(download_parameters: dict) -> Union[bytes, Path]:
+            # The scratch directory is kept on the same filesystem as the destination so the file can be renamed
+            destination = download_parameters.get("destination")
+            if destination is not None:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+            scratch_parent = destination.parent if destination is not None else None
+            with tempfile.TemporaryDirectory(dir=scratch_parent, prefix=".bdfrx-") as temp_dir:
                 download_path = Path(temp_dir).resolve()
                 ytdl_options["outtmpl"] = str(download_path) + "/" + "test.%(ext)s"
+                host = urllib.parse.urlsplit(self.post.url).hostname
+                scheduler = get_transport().scheduler
+                # Only failures are recorded, the time taken by a whole video is not the latency of a response
                 try:
-                    with yt_dlp.YoutubeDL(ytdl_options) as ydl:
+                    with scheduler.slot(host), yt_dlp.YoutubeDL(ytdl_options) as ydl:
                         ydl.download([self.post.url])
                 except yt_dlp.DownloadError as e:
+                    if retryable := _retryable_error(scheduler, host, e, "Youtube download failed"):
+                        raise retryable
                     raise SiteDownloaderError(f"Youtube download failed: {e}")
 
                 downloaded_files = list(download_path.iterdir())
                 if downloaded_files:
                     downloaded_file = downloaded_files[0]
                 else:
-                    raise NotADownloadableLinkError(f"No media exists in the URL {self.post.url}")
+                    # yt-dlp found the video earlier, so this is not taken to mean that the link is dead
+                    raise SiteDownloaderError(f"No media exists in the URL {self.post.url}")
+                if destination is not None:
+                    part_path = Resource.part_path(destination)
+                    Resource.move_file(downloaded_file, part_path)
+                    return part_path
                 with downloaded_file.open("rb") as file:
                     return file.read()
 
@@ -60,18 +122,32 @@ class Youtube(BaseDownloader):
     def get_video_data(url: str) -> dict:
         yt_logger = logging.getLogger("youtube-dl")
         yt_logger.setLevel(logging.CRITICAL)
+        host = urllib.parse.urlsplit(url).hostname
+        scheduler = get_transport().scheduler
         with yt_dlp.YoutubeDL(
             {
                 "logger": yt_logger,
             },
         ) as ydl:
             try:
-                result = ydl.extract_info(url, download=False)
+                with scheduler.slot(host):
+                    start = time.monotonic()
+                    result = ydl.extract_info(url, download=False)
+            except RetryableDownloadError:
+                raise
             except Exception as e:
+                if retryable := _retryable_error(scheduler, host, e, f"Video info extraction failed for {url}"):
+                    raise retryable
                 logger.exception(e)
                 raise NotADownloadableLinkError(f"Video info extraction failed for {url}")
+        if host:
+            scheduler.record_response(host, 200, time.monotonic() - start)
         return result
 
+    @staticmethod
+    def expected_size(video_attributes: dict) -> Optional[int]:
+        return video_attributes.get("filesize") or video_attributes.get("filesize_approx")
+
     @staticmethod
     def get_video_attributes(url: str) -> dict:
         result = Youtube.get_video_data(url)
@@ -0,0 +1,479 @@
+import asyncio
+import concurrent.futures
+import http.cookiejar
+import io
+import logging
+import threading
+import time
+import urllib.parse
+import weakref
+from abc import ABC, abstractmethod
+from collections import Counter
+from collections.abc import AsyncIterator, Callable, Coroutine, Iterator
+from contextlib import ExitStack, contextmanager
+from typing import Any, Optional
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.scheduler import HostLimit, HostScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections to show how often pooled connections are reused"""
+
+    def __init__(self) -> None:
+        self.requests: Counter[str] = Counter()
+        self.connections: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def record_request(self, host: str) -> None:
+        with self._lock:
+            self.requests[host] += 1
+
+    def record_connection(self, host: str) -> None:
+        with self._lock:
+            self.connections[host] += 1
+
+    @property
+    def reuse_rate(self) -> float:
+        with self._lock:
+            total_requests = sum(self.requests.values())
+            total_connections = sum(self.connections.values())
+        if not total_requests:
+            return 0.0
+        return max(0.0, 1 - total_connections / total_requests)
+
+    def summary(self) -> str:
+        with self._lock:
+            total_requests = sum(self.requests.values())
+            total_connections = sum(self.connections.values())
+        return (
+            f"{total_requests} HTTP requests made over {total_connections} connections"
+            f" ({self.reuse_rate:.1%} reused)"
+        )
+
+
+class Transport(ABC):
+    """Makes HTTP requests on behalf of the site downloaders and resources"""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        pool_size: int = 10,
+        pool_hosts: int = 100,
+        retries: int = 2,
+        timeout: float = 16,
+        scheduler: Optional[HostScheduler] = None,
+        segments: int = 4,
+        segment_threshold: int = 32 * 1024 * 1024,
+    ) -> None:
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.retries = retries
+        self.timeout = timeout
+        # Files of at least segment_threshold bytes are downloaded in this many ranges at once
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.scheduler = scheduler or HostScheduler(default_limit=HostLimit(pool_size))
+        self.stats = ConnectionStats()
+
+    def request(  # noqa: PLR0913
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict] = None,
+        cookies: Optional[dict] = None,
+        payload: Optional[dict] = None,
+        stream: bool = False,  # noqa: FBT001,FBT002
+        timeout: Optional[float] = None,
+    ) -> requests.Response:
+        host = urllib.parse.urlsplit(url).hostname
+        slot = ExitStack()
+        slot.enter_context(self.scheduler.slot(host))
+        try:
+            start = time.monotonic()
+            try:
+                response = self._send(method, url, headers, cookies, payload, stream, timeout or self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if host:
+                    self.scheduler.record_failure(host)
+                raise
+        except BaseException:
+            slot.close()
+            raise
+        if stream:
+            # The slot is held while the body is read, so the limits of a host cover whole transfers
+            _release_on_close(response, slot.close)
+        else:
+            slot.close()
+        self._record_response(host, response, start)
+        return response
+
+    def _record_response(self, host: Optional[str], response: requests.Response, start: float) -> None:
+        if not host:
+            return
+        self.scheduler.record_response(host, response.status_code, time.monotonic() - start)
+        if response.status_code == 429:
+            self.scheduler.penalise(host, HostScheduler.parse_retry_after(response.headers.get("Retry-After")))
+
+    @abstractmethod
+    def _send(  # noqa: PLR0913
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict],
+        cookies: Optional[dict],
+        payload: Optional[dict],
+        stream: bool,  # noqa: FBT001
+        timeout: float,
+    ) -> requests.Response:
+        raise NotImplementedError
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        logger.debug(self.stats.summary())
+        for host, window in sorted(self.scheduler.windows().items()):
+            logger.debug(f"Final concurrency for {host}: {window} requests in flight")
+
+
+def _counting_pool(pool_class: type[HTTPConnectionPool], stats: ConnectionStats) -> type[HTTPConnectionPool]:
+    # Pooled connection objects reconnect in place when the server has closed them, so count each connect call
+    class CountingConnection(pool_class.ConnectionCls):
+        def connect(self) -> None:
+            stats.record_connection(self.host)
+            super().connect()
+
+    class CountingConnectionPool(pool_class):
+        ConnectionCls = CountingConnection
+
+    return CountingConnectionPool
+
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, stats: ConnectionStats, **kwargs: Any) -> None:
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.stats),
+            "https": _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        self.stats.record_request(urllib.parse.urlsplit(request.url).hostname)
+        return super().send(request, **kwargs)
+
+
+def _release_on_close(response: requests.Response, release: Callable[[], None]) -> None:
+    """Calls release once a streamed response is closed, or is let go of without being closed"""
+    close = response.close
+    # A finalizer is only ever called once, however the response is let go of
+    release_once = weakref.finalize(response, release)
+
+    def close_and_release() -> None:
+        try:
+            close()
+        finally:
+            release_once()
+
+    response.close = close_and_release
+
+
+class RequestsTransport(Transport):
+    """Sends every request through one keep-alive session, holding a connection pool for each host"""
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.session = requests.Session()
+        # Cookies are passed in per request, so none are kept between requests as with a fresh connection
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=0,
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+        adapter = _PoolAdapter(
+            self.stats,
+            pool_connections=self.pool_hosts,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _send(  # noqa: PLR0913
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict],
+        cookies: Optional[dict],
+        payload: Optional[dict],
+        stream: bool,  # noqa: FBT001
+        timeout: float,
+    ) -> requests.Response:
+        return self.session.request(
+            method,
+            url,
+            headers=headers,
+            cookies=cookies,
+            json=payload,
+            stream=stream,
+            timeout=timeout,
+            allow_redirects=method != "HEAD",
+        )
+
+    def close(self) -> None:
+        super().close()
+        self.session.close()
+
+
+class _AsyncBody(io.RawIOBase):
+    """Reads a response body held open on the event loop from a synchronous thread"""
+
+    def __init__(self, transport: "AsyncTransport", response: Any, timeout: float) -> None:  # noqa: ANN401
+        super().__init__()
+        self._transport = transport
+        self._response = response
+        self._timeout = timeout
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            return b""
+        if size is None or size < 0:
+            return self._transport.run(self._response.read(), self._timeout)
+        return self._transport.run(self._response.content.read(size), self._timeout)
+
+    def readinto(self, buffer: bytearray) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    async def iter_chunks(self, chunk_size: int) -> AsyncIterator[bytes]:
+        with self._transport.translate_errors():
+            async for chunk in self._response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    def close(self) -> None:
+        if not self.closed:
+            self._transport.loop.call_soon_threadsafe(self._response.release)
+        super().close()
+
+
+class AsyncTransport(Transport):
+    """Runs every request on a single event loop with a shared aiohttp connection pool
+
+    Coroutines, such as the downloads of the fetch stage, are run on the loop with submit and make their requests
+    with get_async, so that up to max_tasks transfers are in flight at once without a thread for each. The
+    synchronous methods are a blocking adapter for the site downloaders, which wait for each request in their own
+    thread as with the requests engine
+    """
+
+    def __init__(self, max_tasks: int = 256, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.max_tasks = max_tasks
+        self._tasks = threading.BoundedSemaphore(max_tasks)
+        try:
+            import aiohttp
+        except ImportError:
+            raise BulkDownloaderException(
+                "The async engine requires aiohttp, install it with 'pip install bdfrx[async]'",
+            )
+        self._aiohttp = aiohttp
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-transport", daemon=True)
+        self._thread.start()
+        self._session = self.run(self._create_session())
+
+    async def _create_session(self) -> Any:  # noqa: ANN401
+        async def on_request_start(_session: Any, _context: Any, params: Any) -> None:  # noqa: ANN401
+            self.stats.record_request(params.url.host)
+
+        async def on_connection_create_end(_session: Any, context: Any, _params: Any) -> None:  # noqa: ANN401
+            self.stats.record_connection(context.trace_request_ctx["host"])
+
+        trace_config = self._aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        # The scheduler limits the requests to each host, and the connector must not wait for a connection as well:
+        # responses held open while waiting for the byte budget could take every connection a request needs
+        connector = self._aiohttp.TCPConnector(limit=0)
+        # Cookies are passed in per request, so none set by a response are kept as with the requests engine
+        return self._aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=self._aiohttp.DummyCookieJar(),
+            trace_configs=[trace_config],
+        )
+
+    @contextmanager
+    def translate_errors(self) -> Iterator[None]:
+        """Raises the errors of aiohttp as those of requests, which the resources and site downloaders handle"""
+        try:
+            yield
+        except (concurrent.futures.TimeoutError, asyncio.TimeoutError) as e:
+            raise requests.exceptions.Timeout(e)
+        except self._aiohttp.ClientPayloadError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except self._aiohttp.ClientConnectionError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except self._aiohttp.ClientError as e:
+            raise requests.exceptions.RequestException(e)
+
+    def run(self, coroutine: Coroutine, timeout: Optional[float] = None) -> Any:  # noqa: ANN401
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        with self.translate_errors():
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise
+
+    def submit(self, coroutine: Coroutine) -> concurrent.futures.Future:
+        """Runs a coroutine on the loop without waiting for it, once fewer than max_tasks are running"""
+        self._tasks.acquire()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(lambda _: self._tasks.release())
+        return future
+
+    async def get_async(
+        self,
+        url: str,
+        headers: Optional[dict] = None,
+        timeout: Optional[float] = None,
+    ) -> requests.Response:
+        """Sends a GET request from a coroutine on the loop and returns the response once its headers are in
+
+        The body is read with iter_content_async. As with a streamed request, the slot for the host is held until
+        the response is closed
+        """
+        host = urllib.parse.urlsplit(url).hostname
+        timeout = timeout or self.timeout
+        release = await self.scheduler.acquire_async(host)
+        try:
+            start = time.monotonic()
+            with self.translate_errors():
+                try:
+                    async_response = await self._request("GET", url, headers, None, None, timeout)
+                except (self._aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if host:
+                        self.scheduler.record_failure(host)
+                    raise
+        except BaseException:
+            release()
+            raise
+        response = self._wrap(async_response, timeout)
+        _release_on_close(response, release)
+        self._record_response(host, response, start)
+        return response
+
+    @staticmethod
+    def iter_content_async(response: requests.Response, chunk_size: int) -> AsyncIterator[bytes]:
+        return response.raw.iter_chunks(chunk_size)
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict],
+        cookies: Optional[dict],
+        payload: Optional[dict],
+        timeout: float,
+    ) -> Any:  # noqa: ANN401
+        attempt = 0
+        while True:
+            try:
+                return await self._session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    cookies=cookies,
+                    json=payload,
+                    allow_redirects=method != "HEAD",
+                    timeout=self._aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout),
+                    trace_request_ctx={"host": urllib.parse.urlsplit(url).hostname},
+                )
+            except (self._aiohttp.ClientConnectionError, asyncio.TimeoutError):  # noqa: PERF203
+                if attempt >= self.retries:
+                    raise
+                await asyncio.sleep(0.5 * 2**attempt)
+                attempt += 1
+
+    def _send(  # noqa: PLR0913
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict],
+        cookies: Optional[dict],
+        payload: Optional[dict],
+        stream: bool,  # noqa: FBT001
+        timeout: float,
+    ) -> requests.Response:
+        response = self._wrap(self.run(self._request(method, url, headers, cookies, payload, timeout)), timeout)
+        if not stream:
+            # Reading the content here releases the connection back to the pool straight away
+            _ = response.content
+            response.raw.close()
+        return response
+
+    def _wrap(self, async_response: Any, timeout: float) -> requests.Response:  # noqa: ANN401
+        response = requests.Response()
+        response.status_code = async_response.status
+        response.reason = async_response.reason
+        response.url = str(async_response.url)
+        response.headers = requests.structures.CaseInsensitiveDict(async_response.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = _AsyncBody(self, async_response, timeout)
+        return response
+
+    def close(self) -> None:
+        super().close()
+        if self.loop.is_running():
+            self.run(self._session.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+
+_transport: Transport = RequestsTransport()
+
+
+def get_transport() -> Transport:
+    return _transport
+
+
+def set_transport(transport: Transport) -> None:
+    global _transport  # noqa: PLW0603
+    _transport = transport
+
+
+def create_transport(engine: str, **kwargs: Any) -> Transport:
+    engines = {
+        "async": AsyncTransport,
+        "requests": RequestsTransport,
+    }
+    try:
+        transport_class = engines[engine.lower()]
+    except KeyError:
+        raise BulkDownloaderException(f"Unknown download engine {engine!r}")
+    return transport_class(**kwargs)
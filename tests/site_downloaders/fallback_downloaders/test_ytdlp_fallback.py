@@ -1,10 +1,12 @@
-from unittest.mock import MagicMock
+from typing import Optional
+from unittest.mock import MagicMock, patch
 
 import pytest
 
 from bdfrx.exceptions import NotADownloadableLinkError
 from bdfrx.resource import Resource
 from bdfrx.site_downloaders.fallback_downloaders.ytdlp_fallback import YtdlpFallback
+from bdfrx.site_downloaders.youtube import Youtube
 
 
 @pytest.mark.online
@@ -54,3 +56,19 @@ def test_find_resources(test_url: str, expected_hash: str):
     for res in resources:
         res.download()
     assert resources[0].hash.hexdigest() == expected_hash
+
+
+@pytest.mark.parametrize(
+    ("test_attributes", "expected"),
+    (
+        ({"ext": "mp4", "filesize": 1000}, 1000),
+        ({"ext": "mp4", "filesize": None, "filesize_approx": 900}, 900),
+        ({"ext": "mp4"}, None),
+    ),
+)
+def test_find_resources_expected_size(test_attributes: dict, expected: Optional[int]):
+    test_submission = MagicMock()
+    test_submission.url = "https://www.example.com/video"
+    with patch.object(Youtube, "get_video_attributes", return_value=test_attributes):
+        resources = YtdlpFallback(test_submission).find_resources()
+    assert resources[0].expected_size == expected
@@ -57,6 +57,7 @@ def test_factory_lever_good(test_submission_url: str, expected_class: BaseDownlo
     assert result is expected_class
 
 
+@pytest.mark.online
 @pytest.mark.parametrize(
     "test_url",
     (
@@ -102,3 +103,10 @@ def test_sanitise_url(test_url: str, expected: str):
 def test_is_web_resource(test_url: str, expected: bool):
     result = DownloadFactory.is_web_resource(test_url)
     assert result == expected
+
+
+def test_host_limits():
+    limits = DownloadFactory.host_limits()
+    assert limits["imgur.com"] == Imgur.host_limits["imgur.com"]
+    assert limits["api.redgifs.com"] == Redgifs.host_limits["api.redgifs.com"]
+    assert "v.redd.it" in limits
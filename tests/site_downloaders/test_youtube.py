@@ -1,9 +1,19 @@
-from unittest.mock import MagicMock
+import hashlib
+import io
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Optional
+from unittest.mock import MagicMock, patch
 
 import pytest
+import yt_dlp
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import ExtractorError, UnsupportedError
 
-from bdfrx.exceptions import NotADownloadableLinkError
+from bdfrx.exceptions import NotADownloadableLinkError, RetryableDownloadError, SiteDownloaderError
 from bdfrx.resource import Resource
+from bdfrx.scheduler import HostScheduler
 from bdfrx.site_downloaders.youtube import Youtube
 
 
@@ -43,3 +53,173 @@ def test_find_resources_bad(test_url: str):
     downloader = Youtube(test_submission)
     with pytest.raises(NotADownloadableLinkError):
         downloader.find_resources()
+
+
+class _FakeYoutubeDL:
+    def __init__(self, options: dict) -> None:
+        self.options = options
+
+    def __enter__(self) -> "_FakeYoutubeDL":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+    def download(self, _: list[str]) -> None:
+        Path(self.options["outtmpl"].replace("%(ext)s", "mp4")).write_bytes(b"test video")
+
+
+@pytest.fixture()
+def scheduler() -> Iterator[HostScheduler]:
+    scheduler = HostScheduler()
+    with patch("bdfrx.site_downloaders.youtube.get_transport", return_value=MagicMock(scheduler=scheduler)):
+        yield scheduler
+
+
+@pytest.fixture()
+def _fake_ytdl():
+    with patch("bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL", _FakeYoutubeDL):
+        yield
+
+
+@pytest.mark.usefixtures("_fake_ytdl")
+def test_download_video_to_destination(tmp_path: Path):
+    test_submission = MagicMock()
+    test_submission.url = "https://www.youtube.com/watch?v=test"
+    download = Youtube(test_submission)._download_video({})
+    destination = Path(tmp_path, "folder", "test.mp4")
+    result = download({"destination": destination})
+    assert result == Path(tmp_path, "folder", "test.mp4.part")
+    assert result.read_bytes() == b"test video"
+    # The scratch directory is removed once the file has been moved out of it
+    assert list(Path(tmp_path, "folder").iterdir()) == [result]
+
+
+@pytest.mark.usefixtures("_fake_ytdl")
+def test_download_video_in_memory():
+    test_submission = MagicMock()
+    test_submission.url = "https://www.youtube.com/watch?v=test"
+    download = Youtube(test_submission)._download_video({})
+    assert download({}) == b"test video"
+
+
+@pytest.mark.usefixtures("_fake_ytdl")
+def test_resource_hashes_video_from_disk(tmp_path: Path):
+    test_submission = MagicMock()
+    test_submission.url = "https://www.youtube.com/watch?v=test"
+    resource = Resource(test_submission, test_submission.url, Youtube(test_submission)._download_video({}), ".mp4")
+    resource.download({"destination": Path(tmp_path, "test.mp4")})
+    assert resource.content is None
+    assert resource.path == Path(tmp_path, "test.mp4.part")
+    assert resource.hash.hexdigest() == hashlib.md5(b"test video", usedforsecurity=False).hexdigest()
+
+
+def _download_error(error: Exception) -> yt_dlp.DownloadError:
+    # yt-dlp wraps the error it was raised for, as it does when extracting
+    try:
+        try:
+            raise error
+        except type(error) as e:
+            raise ExtractorError("Unable to download webpage", cause=e) from None
+    except ExtractorError as e:
+        return yt_dlp.DownloadError(f"ERROR: {e}", e.exc_info)
+
+
+def _http_error(status: int, headers: Optional[dict] = None) -> HTTPError:
+    return HTTPError(Response(io.BytesIO(), "https://www.youtube.com/watch?v=test", headers or {}, status=status))
+
+
+@pytest.mark.parametrize(
+    ("test_error", "expected"),
+    (
+        (_download_error(TransportError("timed out")), RetryableDownloadError),
+        (_download_error(_http_error(429)), RetryableDownloadError),
+        (_download_error(_http_error(503)), RetryableDownloadError),
+        (_download_error(_http_error(404)), NotADownloadableLinkError),
+        (_download_error(_http_error(410)), NotADownloadableLinkError),
+        (_download_error(UnsupportedError("https://example.com")), NotADownloadableLinkError),
+        (yt_dlp.DownloadError("ERROR: Private video"), NotADownloadableLinkError),
+    ),
+)
+@pytest.mark.usefixtures("scheduler")
+def test_get_video_data_failure(test_error: Exception, expected: type[Exception]):
+    with patch("bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL") as mock_ytdl:
+        mock_ytdl.return_value.__enter__.return_value.extract_info.side_effect = test_error
+        with pytest.raises(expected) as exc_info:
+            Youtube.get_video_data("https://www.youtube.com/watch?v=test")
+    assert type(exc_info.value) is expected
+
+
+@pytest.mark.usefixtures("scheduler")
+def test_download_video_no_media():
+    test_submission = MagicMock()
+    test_submission.url = "https://www.youtube.com/watch?v=test"
+    download = Youtube(test_submission)._download_video({})
+    with (
+        patch.object(_FakeYoutubeDL, "download"),
+        patch(
+            "bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL",
+            _FakeYoutubeDL,
+        ),
+        pytest.raises(SiteDownloaderError) as exc_info,
+    ):
+        download({})
+    # Not a dead link, as the video was found when the submission was resolved
+    assert not isinstance(exc_info.value, NotADownloadableLinkError)
+
+
+def test_get_video_data_rate_limited(scheduler: HostScheduler):
+    with patch("bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL") as mock_ytdl:
+        mock_ytdl.return_value.__enter__.return_value.extract_info.side_effect = _download_error(
+            _http_error(429, {"Retry-After": "30"}),
+        )
+        with pytest.raises(RetryableDownloadError) as exc_info:
+            Youtube.get_video_data("https://www.youtube.com/watch?v=test")
+    assert exc_info.value.retry_after == pytest.approx(30, abs=1)
+    assert scheduler.remaining_delay("www.youtube.com") == pytest.approx(30, abs=1)
+    assert scheduler.windows()["www.youtube.com"] == 1
+
+
+def test_get_video_data_records_response():
+    mock_scheduler = MagicMock()
+    with (
+        patch(
+            "bdfrx.site_downloaders.youtube.get_transport",
+            return_value=MagicMock(scheduler=mock_scheduler),
+        ),
+        patch("bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL") as mock_ytdl,
+    ):
+        mock_ytdl.return_value.__enter__.return_value.extract_info.return_value = {"ext": "mp4"}
+        assert Youtube.get_video_data("https://www.youtube.com/watch?v=test") == {"ext": "mp4"}
+    mock_scheduler.record_response.assert_called_once()
+    assert mock_scheduler.record_response.call_args.args[:2] == ("www.youtube.com", 200)
+
+
+@pytest.mark.parametrize(
+    ("test_error", "expected", "expected_window"),
+    (
+        (_download_error(TransportError("timed out")), RetryableDownloadError, 1),
+        (_download_error(_http_error(503)), RetryableDownloadError, 1),
+        (yt_dlp.DownloadError("ERROR: Private video"), SiteDownloaderError, 2),
+    ),
+)
+def test_download_video_failure_recorded(
+    test_error: Exception,
+    expected: type[Exception],
+    expected_window: int,
+    scheduler: HostScheduler,
+):
+    test_submission = MagicMock()
+    test_submission.url = "https://www.youtube.com/watch?v=test"
+    download = Youtube(test_submission)._download_video({})
+    with (
+        patch.object(_FakeYoutubeDL, "download", side_effect=test_error),
+        patch(
+            "bdfrx.site_downloaders.youtube.yt_dlp.YoutubeDL",
+            _FakeYoutubeDL,
+        ),
+        pytest.raises(expected) as exc_info,
+    ):
+        download({})
+    assert type(exc_info.value) is expected
+    assert scheduler.windows()["www.youtube.com"] == expected_window
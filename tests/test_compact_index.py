@@ -0,0 +1,87 @@
+import hashlib
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from bdfrx.compact_index import DigestTable, PathTable
+from bdfrx.existing_files import ExistingFileIndex
+
+
+@pytest.mark.parametrize(
+    "test_path",
+    (
+        Path("/downloads/subreddit/file.jpg"),
+        Path("relative.txt"),
+        Path("/root.txt"),
+        Path("/downloads/ünïcode/名前.png"),
+        Path("/downloads/\udcff invalid utf-8.png"),
+    ),
+)
+def test_path_table_round_trip(test_path: Path):
+    paths = PathTable()
+    paths.add(Path("/other/file.txt"))
+    path_id = paths.add(test_path)
+    assert paths[path_id] == test_path
+    assert paths[0] == Path("/other/file.txt")
+    assert len(paths) == 2
+
+
+def test_path_table_shares_directories():
+    paths = PathTable()
+    for i in range(100):
+        paths.add(Path("/downloads/subreddit", f"{i}.jpg"))
+    assert paths.nbytes < 100 * 20 + len("/downloads/subreddit")
+
+
+def test_digest_table():
+    table = DigestTable(16, capacity=4)
+    digests = [hashlib.md5(str(i).encode(), usedforsecurity=False).digest() for i in range(1000)]
+    for i, digest in enumerate(digests):
+        table[digest] = i
+    assert len(table) == 1000
+    assert all(table.get(digest) == i for i, digest in enumerate(digests))
+    assert table.get(bytes(16)) is None
+    assert table.get(b"short") is None
+    assert table.setdefault(digests[0], 5000) == 0
+    assert table.setdefault(bytes(16), 5000) == 5000
+    table[digests[1]] = 7
+    assert table.get(digests[1]) == 7
+    assert len(table) == 1001
+
+
+def test_digest_table_wrong_size():
+    with pytest.raises(ValueError, match="Key of 5 bytes"):
+        DigestTable(16)[b"short"] = 1
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("test_entries", (1_000_000, 10_000_000, 50_000_000))
+def test_benchmark_existing_file_index_memory(test_entries: int):
+    def entry(i: int) -> tuple[str, Path]:
+        file_hash = hashlib.md5(i.to_bytes(8, "little"), usedforsecurity=False).hexdigest()
+        return file_hash, Path(f"/downloads/subreddit_{i // 1000}/{i:08x}_image.jpg")
+
+    # A dict of Path objects is only measured on a sample, as it would not fit in memory at the larger sizes
+    sample_size = 100_000
+    tracemalloc.start()
+    baseline = dict(entry(i) for i in range(sample_size))
+    dict_bytes = tracemalloc.get_traced_memory()[0] / sample_size
+    tracemalloc.stop()
+    del baseline
+
+    started = time.perf_counter()
+    index = ExistingFileIndex()
+    for i in range(test_entries):
+        file_hash, path = entry(i)
+        index[file_hash] = path
+    build_time = time.perf_counter() - started
+    assert index[entry(test_entries // 2)[0]] == entry(test_entries // 2)[1]
+
+    compact_bytes = index.nbytes / test_entries
+    print(
+        f"\n{test_entries} entries: {compact_bytes:.0f} bytes each ({index.nbytes / 2**20:.0f} MiB) against "
+        f"{dict_bytes:.0f} bytes each for a dict of Paths, built in {build_time:.0f}s",
+    )
+    assert compact_bytes * 4 < dict_bytes
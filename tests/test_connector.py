@@ -1,3 +1,4 @@
+import sqlite3
 from collections.abc import Iterator
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -9,9 +10,11 @@ import pytest
 
 from bdfrx.configuration import Configuration
 from bdfrx.connector import RedditConnector, RedditTypes
+from bdfrx.database import Database
 from bdfrx.download_filter import DownloadFilter
 from bdfrx.exceptions import BulkDownloaderException
 from bdfrx.file_name_formatter import FileNameFormatter
+from bdfrx.hashing import set_hash_algorithm
 from bdfrx.site_authenticator import SiteAuthenticator
 
 
@@ -524,3 +527,33 @@ def test_check_subreddit_status_bad(test_subreddit_name: str, expected_message:
 def test_check_subreddit_status_good(test_subreddit_name: str, reddit_instance: praw.Reddit):
     test_subreddit = reddit_instance.subreddit(test_subreddit_name)
     RedditConnector.check_subreddit_status(test_subreddit)
+
+
+def test_warn_outdated_hashes(downloader_mock: MagicMock, caplog: pytest.LogCaptureFixture, tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    legacy_db = sqlite3.connect(db_path)
+    legacy_db.execute("CREATE TABLE hash (hash TEXT PRIMARY KEY, path TEXT);")
+    legacy_db.execute("INSERT INTO hash (hash, path) VALUES ('test', 'test.txt');")
+    legacy_db.commit()
+    legacy_db.close()
+    downloader_mock.db = Database(db_path)
+    set_hash_algorithm("sha256")
+    try:
+        RedditConnector.warn_outdated_hashes(downloader_mock)
+    finally:
+        set_hash_algorithm("md5")
+    assert downloader_mock.db.query("SELECT hash, algorithm FROM download;").fetchall() == [("test", "md5")]
+    assert "1 hashes in the DB were not made with sha256" in caplog.text
+    downloader_mock.db.close()
+
+
+def test_warn_outdated_hashes_none(downloader_mock: MagicMock, caplog: pytest.LogCaptureFixture, tmp_path: Path):
+    downloader_mock.db = Database(Path(tmp_path, "test.db"))
+    downloader_mock.db.write(
+        "INSERT INTO download (status, hash, algorithm, recorded_at) VALUES ('downloaded', 'test', 'md5', 0);",
+    )
+    downloader_mock.db.write("INSERT INTO download (status, link, recorded_at) VALUES ('downloaded', 'test', 0);")
+    downloader_mock.db.commit()
+    RedditConnector.warn_outdated_hashes(downloader_mock)
+    assert "hashes in the DB were not made" not in caplog.text
+    downloader_mock.db.close()
@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import pytest
+
+from bdfrx.content_index import ContentIndex, ResponseMetadata
+from bdfrx.database import Database
+
+
+@pytest.fixture()
+def existing_file(tmp_path: Path) -> Path:
+    path = Path(tmp_path, "existing.png")
+    path.write_bytes(b"content")
+    return path
+
+
+@pytest.mark.parametrize(
+    ("test_recorded", "test_response", "expected"),
+    (
+        (
+            ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None),
+            ResponseMetadata("https://i.example.com/b.png", '"abc"', 7, None),
+            True,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None),
+            ResponseMetadata("https://I.EXAMPLE.COM/b.png", '"abc"', None, None),
+            True,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None),
+            ResponseMetadata("https://other.example.com/a.png", '"abc"', 7, None),
+            False,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", 'W/"abc"', 7, None),
+            ResponseMetadata("https://i.example.com/b.png", 'W/"abc"', 7, None),
+            False,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", None, 7, "Mon, 01 Jan 2024 00:00:00 GMT"),
+            ResponseMetadata("https://i.example.com/a.png", None, 7, "Mon, 01 Jan 2024 00:00:00 GMT"),
+            True,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", None, 7, "Mon, 01 Jan 2024 00:00:00 GMT"),
+            ResponseMetadata("https://i.example.com/a.png", None, 7, "Tue, 02 Jan 2024 00:00:00 GMT"),
+            False,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", None, 7, None),
+            ResponseMetadata("https://i.example.com/a.png", None, 7, None),
+            False,
+        ),
+        (
+            ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None),
+            ResponseMetadata("https://i.example.com/b.png", '"abc"', 8, None),
+            False,
+        ),
+    ),
+)
+def test_find(test_recorded: ResponseMetadata, test_response: ResponseMetadata, expected: bool, existing_file: Path):
+    index = ContentIndex()
+    index.add(test_recorded, existing_file)
+    assert index.find(test_response) == (existing_file if expected else None)
+
+
+def test_find_moved_file(existing_file: Path):
+    index = ContentIndex()
+    metadata = ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None)
+    index.add(metadata, existing_file)
+    existing_file.unlink()
+    assert index.find(metadata) is None
+
+
+def test_find_from_db(existing_file: Path, tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    db = Database(db_path)
+    ContentIndex(db).add(ResponseMetadata("https://i.example.com/a.png", '"abc"', 7, None), existing_file)
+    db.close()
+
+    db = Database(db_path)
+    index = ContentIndex(db)
+    assert index.find(ResponseMetadata("https://i.example.com/b.png", '"abc"', 7, None)) == existing_file
+    assert index.find(ResponseMetadata("https://i.example.com/b.png", '"def"', 7, None)) is None
+    db.close()
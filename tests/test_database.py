@@ -0,0 +1,142 @@
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from pathlib import Path
+
+import pytest
+
+from bdfrx.database import Database
+
+# Writes numbered rows one at a time, printing each number once its write has returned
+_WRITER_SCRIPT = """
+import sys
+from bdfrx.database import Database
+
+db = Database(sys.argv[1], batch_size=int(sys.argv[2]), batch_interval=60)
+db.write("CREATE TABLE row (number INTEGER PRIMARY KEY);")
+db.commit()
+for number in range(1_000_000):
+    db.write("INSERT INTO row (number) VALUES (?);", (number,))
+    print(number, flush=True)
+"""
+
+
+@pytest.fixture()
+def db(tmp_path: Path) -> Iterator[Database]:
+    db = Database(Path(tmp_path, "test.db"), batch_size=3, batch_interval=60)
+    db.write("CREATE TABLE test (value TEXT PRIMARY KEY);")
+    db.commit()
+    yield db
+    db.close()
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _count(db: Database) -> int:
+    return db.query("SELECT COUNT(*) FROM test;").fetchone()[0]
+
+
+def test_wal_mode(db: Database):
+    assert db.query("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+
+def test_commit(db: Database):
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    db.write_many("INSERT INTO test (value) VALUES (?);", [("b",)])
+    db.commit()
+    assert db.query("SELECT value FROM test ORDER BY value;").fetchall() == [("a",), ("b",)]
+
+
+def test_commit_by_count(db: Database):
+    db.write_many("INSERT INTO test (value) VALUES (?);", [("a",), ("b",)])
+    time.sleep(0.1)
+    assert _count(db) == 0
+    db.write("INSERT INTO test (value) VALUES (?);", ("c",))
+    assert _wait_for(lambda: _count(db) == 3)
+
+
+def test_commit_by_time(tmp_path: Path):
+    db = Database(Path(tmp_path, "test.db"), batch_interval=0.05)
+    db.write("CREATE TABLE test (value TEXT PRIMARY KEY);")
+    db.commit()
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    assert _wait_for(lambda: _count(db) == 1)
+    db.close()
+
+
+def test_close_commits(db: Database, tmp_path: Path):
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    db.close()
+    connection = sqlite3.connect(Path(tmp_path, "test.db"))
+    assert connection.execute("SELECT value FROM test;").fetchall() == [("a",)]
+    connection.close()
+
+
+def test_failed_write(db: Database, caplog: pytest.LogCaptureFixture):
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    db.write("INSERT INTO test (value) VALUES (?);", ("b",))
+    db.commit()
+    assert _count(db) == 2
+    assert "Failed to write to the DB" in caplog.text
+
+
+def test_readers_per_thread(db: Database):
+    db.write("INSERT INTO test (value) VALUES (?);", ("a",))
+    db.commit()
+    db.write("INSERT INTO test (value) VALUES (?);", ("b",))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(_count(db))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Uncommitted writes are not seen, and the writer's open transaction does not hold the readers up
+    assert results == [1] * 4
+    assert len(db._readers) == 4
+
+
+def test_writes_wait_for_commit(tmp_path: Path):
+    db = Database(Path(tmp_path, "test.db"), batch_size=2, batch_interval=0.2)
+    db.write("CREATE TABLE test (value TEXT PRIMARY KEY);")
+    started = time.monotonic()
+    # Only one more write fits in the batch, so a write of two waits for it to be committed by time
+    db.write_many("INSERT INTO test (value) VALUES (?);", [("a",), ("b",)])
+    assert time.monotonic() - started >= db.batch_interval / 2
+    db.close()
+
+
+@pytest.mark.parametrize("test_batch_size", (1, 10, 100))
+def test_crash_loses_at_most_one_batch(test_batch_size: int, tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    writer = subprocess.Popen(
+        [sys.executable, "-c", _WRITER_SCRIPT, str(db_path), str(test_batch_size)],  # noqa: S603
+        cwd=Path(__file__).parents[1],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    written = [writer.stdout.readline() for _ in range(test_batch_size * 5 + 7)]
+    writer.send_signal(signal.SIGKILL)
+    # Writes that returned before the process died are still in the pipe
+    written.extend(writer.stdout.read().split())
+    writer.wait()
+    last_written = int(written[-1])
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("PRAGMA integrity_check;").fetchone()[0] == "ok"
+    numbers = [row[0] for row in connection.execute("SELECT number FROM row ORDER BY number;")]
+    connection.close()
+    # Whole batches are committed in order, and no more than one is lost
+    assert numbers == list(range(len(numbers)))
+    assert last_written + 1 - len(numbers) <= test_batch_size
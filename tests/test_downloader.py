@@ -1,15 +1,46 @@
+import asyncio
+import hashlib
 import logging
+import os
 import re
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Callable, Coroutine
+from concurrent.futures import Future
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
+from typing import Optional, Union
 from unittest.mock import MagicMock, patch
 
 import praw.models
+import prawcore
 import pytest
 
 from bdfrx.__main__ import make_console_logging_handler
 from bdfrx.configuration import Configuration
 from bdfrx.connector import RedditConnector
-from bdfrx.downloader import RedditDownloader
+from bdfrx.content_index import ContentIndex, ResponseMetadata
+from bdfrx.database import Database
+from bdfrx.downloader import RedditDownloader, ResolveTask, ResourceTask
+from bdfrx.exceptions import (
+    BulkDownloaderException,
+    NotADownloadableLinkError,
+    ResourceNotFound,
+    RetryableDownloadError,
+    SiteDownloaderError,
+)
+from bdfrx.existing_files import ExistingFileIndex
+from bdfrx.failure_ledger import FailureLedger
+from bdfrx.known_submissions import DownloadRecord, KnownSubmissions
+from bdfrx.negative_cache import NO_RESOURCES, NegativeCache
+from bdfrx.pipeline import ByteBudget, RetryLater
+from bdfrx.resource import DownloadedFile, KnownContent, Resource
+from bdfrx.scan_cache import FileKey, ScanCache
+from bdfrx.shared_hashes import SharedHashSet, write_hash_file
+from bdfrx.transport import AsyncTransport
 
 
 def add_console_handler():
@@ -29,10 +60,656 @@ def downloader_mock(args: Configuration):
     downloader_mock.args = args
     downloader_mock._sanitise_subreddit_name = RedditConnector.sanitise_subreddit_name
     downloader_mock._split_args_input = RedditConnector.split_args_input
-    downloader_mock.master_hash_list = {}
+    downloader_mock.master_hash_list = ExistingFileIndex()
+    downloader_mock.state_lock = threading.RLock()
+    downloader_mock.byte_budget = ByteBudget()
+    downloader_mock.content_index = ContentIndex()
+    downloader_mock.shared_hashes = []
+    downloader_mock.failure_ledger.given_up.return_value = False
+    downloader_mock.negative_cache = None
+    for method in (
+        "_check_submission",
+        "_fetch_failed",
+        "_fetch_resource",
+        "_fetch_resource_async",
+        "_find_existing_file",
+        "_find_known_content",
+        "_filter_page",
+        "_filter_submission",
+        "_find_known_submissions",
+        "_remember_metadata",
+        "_resolve_submission",
+        "_retry_resolve",
+        "_release_bytes",
+        "_reserve_bytes",
+        "_reserve_bytes_async",
+        "_store_resource",
+        "_write_resource",
+        "retry_delay",
+    ):
+        setattr(downloader_mock, method, partial(getattr(RedditDownloader, method), downloader_mock))
+    downloader_mock._log_submission_complete = RedditDownloader._log_submission_complete
+    downloader_mock._until_done = RedditDownloader._until_done
+    downloader_mock._hard_link = RedditDownloader._hard_link
+    downloader_mock._log_fetch_failure = RedditDownloader._log_fetch_failure
+    return downloader_mock
+
+
+@pytest.mark.parametrize(
+    ("test_entries", "expected"),
+    (
+        ((), {"listing": 1, "filter": 1, "resolve": 4, "fetch": 4, "write": 1}),
+        (("resolve=2",), {"listing": 1, "filter": 1, "resolve": 2, "fetch": 4, "write": 1}),
+        (("listing=3, fetch=16", "write=2"), {"listing": 3, "filter": 1, "resolve": 4, "fetch": 16, "write": 2}),
+        (("",), {"listing": 1, "filter": 1, "resolve": 4, "fetch": 4, "write": 1}),
+    ),
+)
+def test_determine_stage_threads(test_entries: tuple[str], expected: dict, downloader_mock: MagicMock):
+    downloader_mock.args.threads = 4
+    downloader_mock.args.stage_threads = test_entries
+    downloader_mock.pipeline_stages = RedditDownloader.pipeline_stages
+    assert RedditDownloader.determine_stage_threads(downloader_mock) == expected
+
+
+@pytest.mark.parametrize("test_entry", ("unknown=2", "fetch=none", "fetch=0"))
+def test_determine_stage_threads_bad(test_entry: str, downloader_mock: MagicMock):
+    downloader_mock.args.threads = 1
+    downloader_mock.args.stage_threads = [test_entry]
+    downloader_mock.pipeline_stages = RedditDownloader.pipeline_stages
+    with pytest.raises(BulkDownloaderException):
+        RedditDownloader.determine_stage_threads(downloader_mock)
+
+
+@pytest.fixture()
+def pipeline_mock(downloader_mock: MagicMock, tmp_path: Path) -> MagicMock:
+    downloader_mock.download_directory = tmp_path
+    downloader_mock.args.disable_module = set()
+    downloader_mock.args.skip_subreddit = set()
+    downloader_mock.args.max_retries = 2
+    downloader_mock.args.max_wait_time = 1
+    downloader_mock.retry_base_delay = 0.01
+    downloader_mock.excluded_submission_ids = set()
+    downloader_mock.stage_threads = {"listing": 1, "filter": 2, "resolve": 2, "fetch": 4, "write": 1}
+    downloader_mock.pipeline_stages = RedditDownloader.pipeline_stages
+    downloader_mock.listing_page_size = 4
+    downloader_mock._list_submissions = partial(RedditDownloader._list_submissions, downloader_mock)
+    downloader_mock.args.queue_size = 2
+    downloader_mock.file_name_formatter.format_resource_paths.side_effect = lambda resources, directory: [
+        (Path(directory, f"{res.source_submission.id}_{i}.txt"), res) for i, res in enumerate(resources)
+    ]
     return downloader_mock
 
 
+def _make_pipeline_submissions(count: int) -> list[MagicMock]:
+    test_submissions = []
+    for i in range(count):
+        submission = MagicMock()
+        submission.__class__ = praw.models.Submission
+        submission.id = f"test{i:02}"
+        submission.score = 1
+        submission.created_utc = 1621204841.0
+        test_submissions.append(submission)
+    return test_submissions
+
+
+def _run_pipeline(pipeline_mock: MagicMock, sources: list, find_resources: Callable) -> None:
+    with patch("bdfrx.downloader.DownloadFactory.pull_lever") as mock_function:
+        mock_function.return_value.side_effect = lambda submission: MagicMock(
+            find_resources=lambda _: find_resources(submission),
+        )
+        mock_function.return_value.__name__ = "test"
+        RedditDownloader.create_pipeline(pipeline_mock).run(sources)
+
+
+@pytest.mark.parametrize("test_resource_count", (1, 3))
+def test_pipeline_downloads_all_resources(test_resource_count: int, pipeline_mock: MagicMock, tmp_path: Path):
+    test_submissions = _make_pipeline_submissions(10)
+
+    def find_resources(submission: MagicMock) -> list[Resource]:
+        return [
+            Resource(submission, f"https://example.com/{i}.txt", lambda _, i=i: f"{submission.id} {i}".encode())
+            for i in range(test_resource_count)
+        ]
+
+    _run_pipeline(pipeline_mock, [test_submissions[:4], test_submissions[4:]], find_resources)
+    assert len(list(tmp_path.iterdir())) == 10 * test_resource_count
+    assert len(pipeline_mock.master_hash_list) == 10 * test_resource_count
+
+
+@pytest.mark.parametrize(("test_failures", "expected_files"), ((1, 10), (2, 10), (3, 0)))
+def test_pipeline_retries_failed_resources(
+    test_failures: int,
+    expected_files: int,
+    pipeline_mock: MagicMock,
+    tmp_path: Path,
+):
+    attempts = Counter()
+    lock = threading.Lock()
+
+    def flaky_download(submission: MagicMock) -> Callable:
+        def download(_: dict) -> bytes:
+            with lock:
+                attempts[submission.id] += 1
+                if attempts[submission.id] <= test_failures:
+                    raise RetryableDownloadError("Response code 503")
+            return submission.id.encode()
+
+        return download
+
+    _run_pipeline(
+        pipeline_mock,
+        [_make_pipeline_submissions(10)],
+        lambda submission: [Resource(submission, "https://example.com/test.txt", flaky_download(submission))],
+    )
+    assert len(list(tmp_path.iterdir())) == expected_files
+    assert set(attempts.values()) == {min(test_failures + 1, 3)}
+
+
+@pytest.mark.parametrize(("test_no_dupes", "expected_files"), ((False, 4), (True, 2)))
+def test_pipeline_moves_streamed_files(
+    test_no_dupes: bool,
+    expected_files: int,
+    pipeline_mock: MagicMock,
+    tmp_path: Path,
+):
+    pipeline_mock.args.no_dupes = test_no_dupes
+
+    def stream_download(submission: MagicMock) -> Callable:
+        def download(parameters: dict) -> DownloadedFile:
+            part_path = Resource.part_path(parameters["destination"])
+            content = f"content {int(submission.id[-2:]) % 2}".encode()
+            part_path.write_bytes(content)
+            return DownloadedFile(part_path, hashlib.md5(content, usedforsecurity=False))
+
+        return download
+
+    _run_pipeline(
+        pipeline_mock,
+        [_make_pipeline_submissions(4)],
+        lambda submission: [Resource(submission, "https://example.com/test.txt", stream_download(submission))],
+    )
+    files = sorted(tmp_path.iterdir())
+    assert len(files) == expected_files
+    assert not [file for file in files if file.suffix == ".part"]
+
+
+@pytest.mark.parametrize(
+    ("test_make_hard_links", "test_no_dupes", "expected_downloads"),
+    (
+        (True, False, 1),
+        (False, True, 1),
+        (False, False, 3),
+    ),
+)
+def test_known_content_not_downloaded(
+    test_make_hard_links: bool,
+    test_no_dupes: bool,
+    expected_downloads: int,
+    pipeline_mock: MagicMock,
+    tmp_path: Path,
+):
+    pipeline_mock.args.make_hard_links = test_make_hard_links
+    pipeline_mock.args.no_dupes = test_no_dupes
+    bodies_read = []
+
+    def download(parameters: dict) -> Union[DownloadedFile, KnownContent]:
+        # Each submission links to the same content under another URL, as a repost would
+        metadata = ResponseMetadata(f"https://i.example.com/{len(bodies_read)}.txt", '"same"', 7, None)
+        if existing := parameters["find_known_content"](metadata):
+            return KnownContent(existing)
+        bodies_read.append(metadata.url)
+        part_path = Resource.part_path(parameters["destination"])
+        part_path.write_bytes(b"content")
+        return DownloadedFile(part_path, hashlib.md5(b"content", usedforsecurity=False), metadata)
+
+    with patch("bdfrx.downloader.DownloadFactory.pull_lever") as mock_function:
+        mock_function.return_value.side_effect = lambda submission: MagicMock(
+            find_resources=lambda _: [Resource(submission, "https://example.com/test.txt", download)],
+        )
+        mock_function.return_value.__name__ = "test"
+        for submission in _make_pipeline_submissions(3):
+            RedditDownloader._download_submission(pipeline_mock, submission)
+    assert len(bodies_read) == expected_downloads
+    files = sorted(tmp_path.iterdir())
+    assert len(files) == (3 if test_make_hard_links or not test_no_dupes else 1)
+    if test_make_hard_links:
+        assert {file.stat().st_ino for file in files} == {files[0].stat().st_ino}
+
+
+def test_imported_hashes_skipped(pipeline_mock: MagicMock, tmp_path: Path):
+    hash_file = Path(tmp_path, "other", "hashes.bin")
+    write_hash_file(hash_file, [hashlib.md5(b"shared", usedforsecurity=False).digest()], "md5")
+    pipeline_mock.shared_hashes = [SharedHashSet(hash_file, "md5")]
+    _run_pipeline(
+        pipeline_mock,
+        [_make_pipeline_submissions(3)],
+        lambda submission: [
+            Resource(
+                submission,
+                "https://example.com/test.txt",
+                lambda _: b"shared" if submission.id == "test01" else submission.id.encode(),
+            ),
+        ],
+    )
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["other", "test00_0.txt", "test02_0.txt"]
+
+
+def _use_db(pipeline_mock: MagicMock, tmp_path: Path) -> Database:
+    Path(tmp_path, "db").mkdir()
+    db = Database(Path(tmp_path, "db", "test.db"))
+    pipeline_mock.args.db = True
+    pipeline_mock.db = db
+    pipeline_mock.known_submissions = KnownSubmissions(db)
+    pipeline_mock.stored_hashes = {}
+    pipeline_mock.failure_ledger = FailureLedger(db)
+    for method in ("_clear_failures", "_find_stored_hash", "_record_download", "_record_failure"):
+        setattr(pipeline_mock, method, partial(getattr(RedditDownloader, method), pipeline_mock))
+    pipeline_mock._payload_size = RedditDownloader._payload_size
+    return db
+
+
+def test_pipeline_records_downloads_in_db(pipeline_mock: MagicMock, tmp_path: Path):
+    db = _use_db(pipeline_mock, tmp_path)
+    test_submissions = _make_pipeline_submissions(3)
+    for submission in test_submissions:
+        submission.url = f"https://example.com/{submission.id}"
+
+    def find_resources(submission: MagicMock) -> list[Resource]:
+        content = b"same" if submission.id in ("test00", "test01") else submission.id.encode()
+        return [Resource(submission, f"https://example.com/{submission.id}.txt", lambda _: content)]
+
+    # The second submission is a duplicate of the first, found before the first is committed, and the first is
+    # skipped when it is listed again
+    _run_pipeline(pipeline_mock, [test_submissions[:1]], find_resources)
+    _run_pipeline(pipeline_mock, [test_submissions], find_resources)
+    db.commit()
+    rows = db.query("SELECT post_id, status, path, size, module, created_utc FROM download ORDER BY post_id;")
+    assert rows.fetchall() == [
+        ("test00", "downloaded", str(Path(tmp_path, "test00_0.txt")), 4, "test", 1621204841),
+        ("test01", "duplicate", str(Path(tmp_path, "test00_0.txt")), 4, "test", 1621204841),
+        ("test02", "downloaded", str(Path(tmp_path, "test02_0.txt")), 6, "test", 1621204841),
+    ]
+    db.close()
+
+
+def test_pipeline_records_failures_in_db(pipeline_mock: MagicMock, tmp_path: Path):
+    db = _use_db(pipeline_mock, tmp_path)
+    test_submissions = _make_pipeline_submissions(3)
+    for submission in test_submissions:
+        submission.url = f"https://example.com/{submission.id}"
+    failing = {"test00": ResourceNotFound("HTTP Code 404", 404), "test01": BulkDownloaderException("HTTP Code 500")}
+
+    def find_resources(submission: MagicMock) -> list[Resource]:
+        def download(_: dict) -> bytes:
+            if error := failing.get(submission.id):
+                raise error
+            return submission.id.encode()
+
+        return [Resource(submission, f"https://example.com/{submission.id}.txt", download)]
+
+    _run_pipeline(pipeline_mock, [test_submissions], find_resources)
+    db.commit()
+    rows = db.query("SELECT post_id, url, module, error, permanent, attempts FROM failure ORDER BY post_id;")
+    assert rows.fetchall() == [
+        ("test00", "https://example.com/test00.txt", "test", "ResourceNotFound", 1, 1),
+        ("test01", "https://example.com/test01.txt", "test", "BulkDownloaderException", 0, 1),
+    ]
+    # On the next run the permanent failure is skipped, and a failure that then downloads is removed
+    del failing["test01"]
+    pipeline_mock.failure_ledger = FailureLedger(db)
+    _run_pipeline(pipeline_mock, [test_submissions[:2]], find_resources)
+    db.commit()
+    assert db.query("SELECT post_id, attempts FROM failure;").fetchall() == [("test00", 1)]
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["db", "test01_0.txt", "test02_0.txt"]
+    db.close()
+
+
+@pytest.mark.parametrize("test_make_hard_links", (False, True))
+def test_retried_duplicate_clears_failures(test_make_hard_links: bool, pipeline_mock: MagicMock, tmp_path: Path):
+    db = _use_db(pipeline_mock, tmp_path)
+    pipeline_mock.args.make_hard_links = test_make_hard_links
+    stored = Path(tmp_path, "db", "stored.txt")
+    stored.write_bytes(b"test00")
+    pipeline_mock.stored_hashes[hashlib.md5(b"test00", usedforsecurity=False).hexdigest()] = str(stored)
+    pipeline_mock.failure_ledger.record(
+        "test00",
+        "https://example.com/test00.txt",
+        "test",
+        BulkDownloaderException("x"),
+    )
+    test_submissions = _make_pipeline_submissions(1)
+    test_submissions[0].url = "https://example.com/test00"
+    # The content turns out to be stored already when the failed submission is retried
+    _run_pipeline(
+        pipeline_mock,
+        [test_submissions],
+        lambda submission: [Resource(submission, "https://example.com/test00.txt", lambda _: b"test00")],
+    )
+    db.commit()
+    assert db.query("SELECT COUNT(*) FROM failure;").fetchone()[0] == 0
+    db.close()
+
+
+@pytest.mark.parametrize("test_has_hardlink_to", (True, False))
+def test_hard_link_to_stored_hash(test_has_hardlink_to: bool, pipeline_mock: MagicMock, tmp_path: Path):
+    db = _use_db(pipeline_mock, tmp_path)
+    pipeline_mock.args.make_hard_links = True
+    stored = Path(tmp_path, "db", "stored.txt")
+    stored.write_bytes(b"test00")
+    # Paths from the DB are strings
+    pipeline_mock.stored_hashes[hashlib.md5(b"test00", usedforsecurity=False).hexdigest()] = str(stored)
+    test_submissions = _make_pipeline_submissions(1)
+    test_submissions[0].url = "https://example.com/test00"
+    # Python 3.9 has no Path.hardlink_to
+    with nullcontext() if test_has_hardlink_to else patch.object(Path, "hardlink_to", side_effect=AttributeError):
+        _run_pipeline(
+            pipeline_mock,
+            [test_submissions],
+            lambda submission: [Resource(submission, "https://example.com/test00.txt", lambda _: b"test00")],
+        )
+    assert Path(tmp_path, "test00_0.txt").stat().st_ino == stored.stat().st_ino
+    db.close()
+
+
+@patch("bdfrx.downloader.DownloadFactory.pull_lever")
+def test_resolve_deferred_for_paused_host(mock_function: MagicMock, downloader_mock: MagicMock):
+    downloader_mock.args.disable_module = set()
+    downloader_mock.args.max_retries = 1
+    downloader_mock.args.max_wait_time = 1
+    downloader_mock.retry_base_delay = 0.01
+    error = RetryableDownloadError("Requests to api.redgifs.com are paused for 30 seconds", retry_after=30)
+    mock_function.return_value.__name__ = "Redgifs"
+    mock_function.return_value.return_value.find_resources.side_effect = error
+    submission = _make_pipeline_submissions(1)[0]
+    with pytest.raises(RetryLater) as exc_info:
+        RedditDownloader._resolve_submission(downloader_mock, submission)
+    assert exc_info.value.delay >= 30
+    assert exc_info.value.item == ResolveTask(submission, 1)
+    downloader_mock._record_failure.assert_not_called()
+    # Once out of retries the failure is recorded
+    assert RedditDownloader._resolve_submission(downloader_mock, exc_info.value.item) == []
+    downloader_mock._record_failure.assert_called_once_with("test00", submission.url, "Redgifs", error)
+
+
+@patch("bdfrx.downloader.DownloadFactory.pull_lever")
+def test_resolve_failure_recorded(mock_function: MagicMock, downloader_mock: MagicMock):
+    error = NotADownloadableLinkError("No downloader module exists")
+    mock_function.side_effect = error
+    submission = _make_pipeline_submissions(1)[0]
+    assert RedditDownloader._resolve_submission(downloader_mock, submission) == []
+    downloader_mock._record_failure.assert_called_once_with("test00", submission.url, None, error)
+
+
+@pytest.mark.parametrize(
+    ("test_lever_error", "test_error", "expected"),
+    (
+        (NotADownloadableLinkError("No downloader module exists"), None, "NotADownloadableLinkError"),
+        (None, ResourceNotFound("Server responded with 404", 404), "ResourceNotFound"),
+        (None, ResourceNotFound("Server responded with 410", 410), "ResourceNotFound"),
+        (None, ResourceNotFound("Server responded with 500", 500), None),
+        (None, SiteDownloaderError("Timeout"), None),
+        # A module failing to extract the link, such as yt-dlp, is not taken to mean that the link is dead
+        (None, NotADownloadableLinkError("Video info extraction failed"), None),
+        (None, None, NO_RESOURCES),
+    ),
+)
+@patch("bdfrx.downloader.DownloadFactory.pull_lever")
+def test_dead_links_cached(
+    mock_function: MagicMock,
+    test_lever_error: Optional[Exception],
+    test_error: Optional[Exception],
+    expected: Optional[str],
+    downloader_mock: MagicMock,
+    tmp_path: Path,
+):
+    downloader_mock.negative_cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    downloader_mock._cache_dead_link = partial(RedditDownloader._cache_dead_link, downloader_mock)
+    downloader_mock.args.disable_module = set()
+    mock_function.return_value.__name__ = "test"
+    if test_lever_error:
+        mock_function.side_effect = test_lever_error
+    else:
+        mock_function.return_value.return_value.find_resources.side_effect = test_error
+        mock_function.return_value.return_value.find_resources.return_value = []
+    submission = _make_pipeline_submissions(1)[0]
+    submission.url = "https://example.com/test"
+    assert RedditDownloader._resolve_submission(downloader_mock, submission) == []
+    cached = downloader_mock.negative_cache.get(submission.url)
+    assert (cached.error if cached else None) == expected
+    if expected:
+        # The link is not resolved again
+        mock_function.reset_mock()
+        assert RedditDownloader._resolve_submission(downloader_mock, submission) == []
+        mock_function.assert_not_called()
+    downloader_mock.negative_cache.close()
+
+
+@pytest.mark.parametrize("test_expected_size", (None, 40))
+def test_pipeline_limits_bytes_in_flight(test_expected_size: int, pipeline_mock: MagicMock, tmp_path: Path):
+    pipeline_mock.byte_budget = ByteBudget(100)
+    peak = 0
+    lock = threading.Lock()
+
+    def sized_download(submission: MagicMock) -> Callable:
+        def download(parameters: dict) -> bytes:
+            nonlocal peak
+            parameters["reserve_bytes"](40)
+            with lock:
+                peak = max(peak, pipeline_mock.byte_budget.used)
+            time.sleep(0.01)
+            return submission.id.encode()
+
+        return download
+
+    _run_pipeline(
+        pipeline_mock,
+        [_make_pipeline_submissions(10)],
+        lambda submission: [
+            Resource(
+                submission,
+                "https://example.com/test.txt",
+                sized_download(submission),
+                expected_size=test_expected_size,
+            ),
+        ],
+    )
+    assert len(list(tmp_path.iterdir())) == 10
+    assert 0 < peak <= 100
+    assert pipeline_mock.byte_budget.used == 0
+
+
+def test_fetch_failure_releases_bytes(downloader_mock: MagicMock, tmp_path: Path):
+    downloader_mock.byte_budget = ByteBudget(100)
+    downloader_mock.args.max_retries = 0
+
+    def failing_download(parameters: dict) -> None:
+        parameters["reserve_bytes"](40)
+        raise RetryableDownloadError("Response code 503")
+
+    res = Resource(MagicMock(), "https://example.com/test.txt", failing_download, expected_size=20)
+    task = ResourceTask(MagicMock(stopped=False), Path(tmp_path, "test.txt"), res)
+    assert downloader_mock._fetch_resource(task) == []
+    assert downloader_mock.byte_budget.used == 0
+    assert res.reserved_bytes == 0
+
+
+def _run_now(coroutine: Coroutine) -> Future:
+    future = Future()
+    try:
+        future.set_result(asyncio.run(coroutine))
+    except BaseException as e:  # noqa: BLE001
+        future.set_exception(e)
+    return future
+
+
+@pytest.mark.parametrize(
+    ("test_download_function", "expected_async"),
+    (
+        (Resource.retry_download("https://example.com/test.txt"), True),
+        (lambda _: b"test", False),
+    ),
+)
+def test_fetch_resource_async_engine(
+    test_download_function: Callable,
+    expected_async: bool,
+    downloader_mock: MagicMock,
+    tmp_path: Path,
+):
+    downloader_mock.transport = MagicMock(spec=AsyncTransport)
+    downloader_mock.transport.submit.side_effect = _run_now
+    res = Resource(MagicMock(), "https://example.com/test.txt", test_download_function)
+    task = ResourceTask(MagicMock(stopped=False), Path(tmp_path, "test.txt"), res)
+
+    async def download_async(_transport: AsyncTransport, parameters: dict) -> None:
+        await parameters["reserve_bytes"](4)
+        res.content = b"test"
+
+    with patch.object(Resource, "download_async", side_effect=download_async):
+        results = downloader_mock._until_done(downloader_mock._fetch_resource, task)
+    assert results == [task]
+    assert res.content == b"test"
+    assert downloader_mock.transport.submit.called == expected_async
+
+
+def test_fetch_resource_async_retries(downloader_mock: MagicMock, tmp_path: Path):
+    downloader_mock.transport = MagicMock(spec=AsyncTransport)
+    downloader_mock.transport.submit.side_effect = _run_now
+    downloader_mock.byte_budget = ByteBudget(100)
+    downloader_mock.args.max_retries = 1
+    downloader_mock.args.max_wait_time = 1
+    downloader_mock.retry_base_delay = 0.01
+    res = Resource(MagicMock(), "https://example.com/test.txt", Resource.retry_download("https://example.com/a.txt"))
+    task = ResourceTask(MagicMock(stopped=False), Path(tmp_path, "test.txt"), res)
+
+    async def failing_download(_transport: AsyncTransport, parameters: dict) -> None:
+        await parameters["reserve_bytes"](40)
+        raise RetryableDownloadError("Response code 503")
+
+    with patch.object(Resource, "download_async", side_effect=failing_download), pytest.raises(RetryLater):
+        downloader_mock._fetch_resource(task).result()
+    assert downloader_mock.byte_budget.used == 0
+
+
+def test_write_hashes_existing_files_outside_lock(downloader_mock: MagicMock, tmp_path: Path):
+    downloader_mock.args.no_dupes = True
+    downloader_mock.state_lock = threading.Lock()
+    downloader_mock._payload_size = RedditDownloader._payload_size
+    existing = Path(tmp_path, "existing.txt")
+    existing.write_bytes(b"test")
+    downloader_mock.master_hash_list.add_unhashed(existing, 4)
+    lock_held = []
+
+    def hash_file(path: Path) -> str:
+        lock_held.append(downloader_mock.state_lock.locked())
+        return hashlib.md5(path.read_bytes(), usedforsecurity=False).hexdigest()
+
+    res = Resource(MagicMock(), "https://example.com/test.txt", lambda _: b"test")
+    res.download()
+    task = ResourceTask(MagicMock(stopped=False), Path(tmp_path, "test.txt"), res)
+    with patch("bdfrx.existing_files.hash_file", side_effect=hash_file):
+        downloader_mock._write_resource(task)
+    assert lock_held == [False]
+    assert not Path(tmp_path, "test.txt").exists()
+    task.job.stop.assert_called_once()
+
+
+def _album_peak_memory(pipeline_mock: MagicMock, album_size: int) -> int:
+    submission = _make_pipeline_submissions(1)[0]
+    resources = [
+        Resource(submission, f"https://example.com/{i}.bin", lambda _: os.urandom(256 * 1024))
+        for i in range(album_size)
+    ]
+    with patch("bdfrx.downloader.DownloadFactory.pull_lever") as mock_function:
+        mock_function.return_value.return_value.find_resources.return_value = resources
+        mock_function.return_value.__name__ = "test"
+        pipeline_mock.file_name_formatter.format_resource_paths.side_effect = lambda resources, directory: [
+            (Path(directory, f"{album_size}_{i}.bin"), res) for i, res in enumerate(resources)
+        ]
+        tracemalloc.start()
+        try:
+            RedditDownloader._download_submission(pipeline_mock, submission)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    assert all(res.content is None and res.source_submission is None for res in resources)
+    return peak
+
+
+def test_album_memory_does_not_grow(pipeline_mock: MagicMock, tmp_path: Path):
+    small_album_peak = _album_peak_memory(pipeline_mock, 4)
+    large_album_peak = _album_peak_memory(pipeline_mock, 40)
+    assert len(list(tmp_path.iterdir())) == 44
+    # Holding on to every payload would add 9 MiB for the larger album
+    assert large_album_peak < small_album_peak + 1024 * 1024
+
+
+def test_pipeline_resumes_failed_listing(pipeline_mock: MagicMock, tmp_path: Path):
+    test_submissions = _make_pipeline_submissions(6)
+
+    class FlakyListing:
+        def __init__(self) -> None:
+            self.position = 0
+            self.failed = False
+
+        def __iter__(self) -> "FlakyListing":
+            return self
+
+        def __next__(self) -> MagicMock:
+            if self.position == 3 and not self.failed:
+                self.failed = True
+                raise prawcore.ServerError(MagicMock())
+            if self.position == len(test_submissions):
+                raise StopIteration
+            self.position += 1
+            return test_submissions[self.position - 1]
+
+    _run_pipeline(
+        pipeline_mock,
+        [FlakyListing()],
+        lambda submission: [Resource(submission, "https://example.com/test.txt", lambda _: submission.id.encode())],
+    )
+    assert len(list(tmp_path.iterdir())) == 6
+
+
+@pytest.mark.parametrize(
+    ("test_attempt", "test_minimum", "expected_range"),
+    ((0, 0, (5, 10)), (1, 0, (10, 20)), (5, 0, (15, 30)), (0, 25, (25, 25))),
+)
+def test_retry_delay(
+    test_attempt: int,
+    test_minimum: float,
+    expected_range: tuple[float, float],
+    downloader_mock: MagicMock,
+):
+    downloader_mock.retry_base_delay = 10
+    downloader_mock.args.max_wait_time = 30
+    for _ in range(20):
+        assert expected_range[0] <= downloader_mock.retry_delay(test_attempt, test_minimum) <= expected_range[1]
+
+
+def test_filter_page_known_in_db(downloader_mock: MagicMock, tmp_path: Path):
+    db = Database(Path(tmp_path, "test.db"))
+    db.write("INSERT INTO download (status, post_id, recorded_at) VALUES ('migrated', 'aaaaaa', 0);")
+    db.write("INSERT INTO download (status, link, recorded_at) VALUES ('migrated', 'https://example.com/b.png', 0);")
+    db.commit()
+    downloader_mock.args.db = True
+    downloader_mock.db = db
+    downloader_mock.excluded_submission_ids = set()
+    downloader_mock.known_submissions = KnownSubmissions(db)
+    downloader_mock.known_submissions.add(DownloadRecord("dddddd", "https://example.com/x.png", "downloaded"))
+    test_submissions = []
+    for test_id in ("aaaaaa", "bbbbbb", "cccccc", "dddddd"):
+        submission = MagicMock()
+        submission.__class__ = praw.models.Submission
+        submission.id = test_id
+        submission.url = f"https://example.com/{test_id[0]}.png"
+        submission.score = 1
+        test_submissions.append(submission)
+    accepted = RedditDownloader._filter_page(downloader_mock, test_submissions)
+    db.close()
+    assert [submission.id for submission in accepted] == ["cccccc"]
+
+
 @pytest.mark.parametrize(
     ("test_ids", "test_excluded", "expected_len"),
     (
@@ -124,7 +801,30 @@ def test_file_creation_date(
 
 def test_search_existing_files():
     results = RedditDownloader.scan_existing_files(Path())
-    assert len(results.keys()) != 0
+    assert len(results) != 0
+
+
+def test_search_existing_files_cached(tmp_path: Path):
+    for name in ("unchanged", "changed"):
+        Path(tmp_path, "files").mkdir(exist_ok=True)
+        Path(tmp_path, "files", f"{name}.txt").write_text(name)
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"))
+    db = Database(Path(tmp_path, "test.db"))
+    RedditDownloader.scan_existing_files(Path(tmp_path, "files"), db=db, cache=cache)
+    # Files already in the DB are not added again
+    RedditDownloader.scan_existing_files(Path(tmp_path, "files"), db=db, cache=cache)
+    assert db.query("SELECT COUNT(*) FROM download WHERE status = 'existing';").fetchone()[0] == 2
+    db.close()
+
+    # A hash that does not match the contents is only returned if the cached entry was used
+    unchanged = Path(tmp_path, "files", "unchanged.txt")
+    cache.put(FileKey.from_stat(unchanged, unchanged.stat()), "0123456789abcdef0123456789abcdef")
+    Path(tmp_path, "files", "changed.txt").write_text("changed again")
+    index = RedditDownloader.scan_existing_files(Path(tmp_path, "files"), cache=cache)
+    cache.close()
+    assert index["0123456789abcdef0123456789abcdef"] == unchanged
+    changed_hash = hashlib.md5(b"changed again", usedforsecurity=False).hexdigest()
+    assert index.find(changed_hash, 13, lambda: b"changed again").name == "changed.txt"
 
 
 @pytest.mark.online
@@ -145,7 +845,7 @@ def test_download_submission_hash_exists(
     downloader_mock.args.no_dupes = True
     downloader_mock.file_name_formatter = RedditConnector.create_file_name_formatter(downloader_mock)
     downloader_mock.download_directory = tmp_path
-    downloader_mock.master_hash_list = {test_hash: None}
+    downloader_mock.master_hash_list[test_hash] = Path("test")
     submission = downloader_mock.reddit_instance.submission(id=test_submission_id)
     RedditDownloader._download_submission(downloader_mock, submission)
     folder_contents = list(tmp_path.iterdir())
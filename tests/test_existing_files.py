@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from bdfrx.existing_files import (
+    SAMPLE_SIZE,
+    ExistingFileIndex,
+    FileHasher,
+    hash_file,
+    sample_bytes,
+    sample_file,
+    walk_files,
+)
+from bdfrx.scan_cache import FileKey, ScanCache
+
+
+def _md5(content: bytes) -> str:
+    return hashlib.md5(content, usedforsecurity=False).hexdigest()
+
+
+@pytest.mark.parametrize(
+    "test_content",
+    (
+        b"",
+        b"test",
+        bytes(2 * SAMPLE_SIZE),
+        bytes(range(256)) * 1024,
+    ),
+)
+def test_sample_file_matches_bytes(test_content: bytes, tmp_path: Path):
+    test_file = Path(tmp_path, "test")
+    test_file.write_bytes(test_content)
+    assert sample_file(test_file) == sample_bytes(test_content)
+    assert len(sample_bytes(test_content)) <= 2 * SAMPLE_SIZE
+
+
+@pytest.fixture()
+def index(tmp_path: Path) -> ExistingFileIndex:
+    index = ExistingFileIndex()
+    for name, content in (("a", b"aaaa"), ("b", b"bbbb"), ("c", b"ccccc")):
+        Path(tmp_path, name).write_bytes(content)
+        index.add_unhashed(Path(tmp_path, name), len(content))
+    return index
+
+
+def test_find_unique_size(index: ExistingFileIndex):
+    sample = MagicMock()
+    assert index.find(_md5(b"dddddd"), 6, sample) is None
+    sample.assert_not_called()
+
+
+def test_find_only_hashes_matching_samples(index: ExistingFileIndex, tmp_path: Path):
+    with patch("bdfrx.existing_files.hash_file", return_value=_md5(b"bbbb")) as mock_hash:
+        assert index.find(_md5(b"bbbb"), 4, lambda: b"bbbb") == Path(tmp_path, "b")
+    mock_hash.assert_called_once_with(Path(tmp_path, "b"))
+    assert _md5(b"bbbb") in index
+    assert len(index) == 3
+
+
+def test_find_different_content_same_size(index: ExistingFileIndex):
+    assert index.find(_md5(b"dddd"), 4, lambda: b"dddd") is None
+    assert _md5(b"aaaa") not in index
+
+
+def test_find_hashed_file(index: ExistingFileIndex, tmp_path: Path):
+    index[_md5(b"new")] = Path(tmp_path, "new")
+    sample = MagicMock()
+    assert index.find(_md5(b"new"), 3, sample) == Path(tmp_path, "new")
+    sample.assert_not_called()
+    assert len(index) == 4
+
+
+def test_find_concurrent_lookups(index: ExistingFileIndex, tmp_path: Path):
+    started = threading.Barrier(2)
+
+    def slow_hash(path: Path) -> str:
+        started.wait(timeout=5)
+        return _md5(path.read_bytes())
+
+    with patch("bdfrx.existing_files.hash_file", side_effect=slow_hash), ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(lambda _: index.find(_md5(b"bbbb"), 4, lambda: b"bbbb"), range(2)))
+    # Both lookups hashed the file without waiting on each other, and it is only counted once
+    assert results == [Path(tmp_path, "b")] * 2
+    assert len(index) == 3
+    assert index.find(_md5(b"aaaa"), 4, lambda: b"aaaa") == Path(tmp_path, "a")
+    assert len(index) == 3
+
+
+def test_find_missing_file(index: ExistingFileIndex, tmp_path: Path):
+    Path(tmp_path, "c").unlink()
+    assert index.find(_md5(b"ccccc"), 5, lambda: b"ccccc") is None
+    assert len(index) == 2
+
+
+@pytest.fixture()
+def test_tree(tmp_path: Path) -> Path:
+    root = Path(tmp_path, "root")
+    Path(root, "a", "b").mkdir(parents=True)
+    for i, file in enumerate((Path(root, "1.txt"), Path(root, "a", "2.txt"), Path(root, "a", "b", "3.txt"))):
+        file.write_text(f"test {i}")
+    Path(root, "a", "b", "link.txt").hardlink_to(Path(root, "1.txt"))
+    return root
+
+
+def test_walk_files(test_tree: Path):
+    results = {file.relative_to(test_tree).as_posix(): stat.st_size for file, stat in walk_files(test_tree)}
+    assert results == {"1.txt": 6, "a/2.txt": 6, "a/b/3.txt": 6, "a/b/link.txt": 6}
+
+
+def test_walk_files_skips_scratch_directories(test_tree: Path):
+    Path(test_tree, ".bdfrx-test").mkdir()
+    Path(test_tree, ".bdfrx-test", "test.mp4").write_text("test")
+    results = {file.relative_to(test_tree).as_posix() for file, _ in walk_files(test_tree)}
+    assert results == {"1.txt", "a/2.txt", "a/b/3.txt", "a/b/link.txt"}
+
+
+def test_walk_files_skips_partial_downloads(test_tree: Path):
+    Path(test_tree, "a", "4.mp4.part").write_text("test")
+    Path(test_tree, "a", "4.mp4.part.json").write_text("{}")
+    results = {file.relative_to(test_tree).as_posix() for file, _ in walk_files(test_tree)}
+    assert results == {"1.txt", "a/2.txt", "a/b/3.txt", "a/b/link.txt"}
+
+
+def test_walk_files_skips_directory_links(test_tree: Path):
+    Path(test_tree, "loop").symlink_to(test_tree, target_is_directory=True)
+    assert len(list(walk_files(test_tree))) == 4
+
+
+def test_walk_files_missing_directory(tmp_path: Path):
+    assert list(walk_files(Path(tmp_path, "missing"))) == []
+
+
+@pytest.mark.parametrize("test_workers", (1, 4))
+def test_hash_files(test_workers: int, test_tree: Path):
+    with patch("bdfrx.existing_files.hash_file", wraps=hash_file) as mock_hash:
+        results = dict(FileHasher(test_workers).hash_files(walk_files(test_tree)))
+    assert {file.name: file_hash for file, file_hash in results.items()} == {
+        "1.txt": _md5(b"test 0"),
+        "2.txt": _md5(b"test 1"),
+        "3.txt": _md5(b"test 2"),
+        "link.txt": _md5(b"test 0"),
+    }
+    # The two links to the same file are only read once
+    assert mock_hash.call_count == 3
+
+
+def test_hash_files_uses_cache(test_tree: Path, tmp_path: Path):
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"))
+    first = Path(test_tree, "a", "2.txt")
+    cache.put(FileKey.from_stat(first, first.stat()), "cached_hash")
+    hasher = FileHasher(2, cache)
+    with patch("bdfrx.existing_files.hash_file", wraps=hash_file) as mock_hash:
+        results = dict(hasher.hash_files(walk_files(test_tree)))
+    assert results[first] == "cached_hash"
+    assert mock_hash.call_count == 2
+    assert hasher.files_cached == 1
+    third = Path(test_tree, "a", "b", "3.txt")
+    assert cache.get(FileKey.from_stat(third, third.stat())) == _md5(b"test 2")
+    cache.close()
+
+
+def test_hash_files_skips_unreadable(test_tree: Path):
+    missing = Path(test_tree, "missing.txt")
+    files = [*walk_files(test_tree), (missing, Path(test_tree, "a", "2.txt").stat())]
+    results = dict(FileHasher(2).hash_files(files))
+    assert len(results) == 4
+    assert missing not in results
+
+
+def test_hash_files_reports_progress(test_tree: Path, caplog: pytest.LogCaptureFixture):
+    caplog.set_level(logging.INFO)
+    hasher = FileHasher(2, report_interval=0)
+    list(hasher.hash_files(walk_files(test_tree)))
+    assert hasher.files_hashed == 3
+    assert hasher.bytes_hashed == 18
+    assert "Hashed 3 files" in caplog.text
@@ -0,0 +1,116 @@
+from collections.abc import Iterator
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import prawcore
+import pytest
+
+from bdfrx.database import Database
+from bdfrx.exceptions import BulkDownloaderException, NotADownloadableLinkError, ResourceNotFound, SiteDownloaderError
+from bdfrx.failure_ledger import FailureLedger, is_permanent
+
+
+@pytest.fixture()
+def db(tmp_path: Path) -> Iterator[Database]:
+    db = Database(Path(tmp_path, "test.db"))
+    yield db
+    db.close()
+
+
+def _rows(db: Database) -> list[tuple]:
+    db.commit()
+    return db.query(
+        "SELECT post_id, url, module, error, permanent, attempts, last_failed_at, next_attempt_at FROM failure "
+        "ORDER BY post_id, url;",
+    ).fetchall()
+
+
+@pytest.mark.parametrize(
+    ("test_error", "expected"),
+    (
+        (NotADownloadableLinkError("test"), True),
+        (ResourceNotFound("test", 404), True),
+        (ResourceNotFound("test", 410), True),
+        (ResourceNotFound("test", 500), False),
+        (ResourceNotFound("test"), False),
+        (SiteDownloaderError("test"), False),
+        (BulkDownloaderException("test"), False),
+        (OSError("test"), False),
+        (prawcore.NotFound(MagicMock(status_code=404)), True),
+        (prawcore.ServerError(MagicMock(status_code=500)), False),
+    ),
+)
+def test_is_permanent(test_error: Exception, expected: bool):
+    assert is_permanent(test_error) == expected
+
+
+def test_record_backoff(db: Database):
+    ledger = FailureLedger(db)
+    with patch("bdfrx.failure_ledger.time.time", return_value=1000):
+        ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+    assert _rows(db) == [("aaaaaa", "https://example.com/a.jpg", "Direct", "BulkDownloaderException", 0, 1, 1000, 4600)]
+    for attempt in range(2, ledger.max_attempts):
+        with patch("bdfrx.failure_ledger.time.time", return_value=2000):
+            ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+        expected_delay = min(ledger.max_retry_delay, ledger.retry_base_delay * 2 ** (attempt - 1))
+        assert _rows(db)[0][5:] == (attempt, 2000, 2000 + expected_delay)
+    ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+    assert _rows(db)[0][5] == ledger.max_attempts
+    assert _rows(db)[0][7] is None
+
+
+def test_record_permanent(db: Database):
+    ledger = FailureLedger(db)
+    ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+    ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", ResourceNotFound("test", 404))
+    ledger.record("bbbbbb", "https://example.com/b", None, NotADownloadableLinkError("test"))
+    rows = _rows(db)
+    assert [row[3:6] for row in rows] == [("ResourceNotFound", 1, 2), ("NotADownloadableLinkError", 1, 1)]
+    assert [row[7] for row in rows] == [None, None]
+
+
+def test_due(db: Database):
+    ledger = FailureLedger(db)
+    with patch("bdfrx.failure_ledger.time.time", return_value=1000):
+        ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+        ledger.record("aaaaaa", "https://example.com/b.jpg", "Direct", BulkDownloaderException("test"))
+        ledger.record("bbbbbb", "https://example.com/c.jpg", "Direct", ResourceNotFound("test", 404))
+    with patch("bdfrx.failure_ledger.time.time", return_value=3000):
+        ledger.record("cccccc", "https://example.com/d.jpg", "Direct", BulkDownloaderException("test"))
+    db.commit()
+    assert ledger.due(1000) == []
+    assert ledger.due(4600) == ["aaaaaa"]
+    assert ledger.due(10_000) == ["aaaaaa", "cccccc"]
+
+
+def test_given_up(db: Database):
+    ledger = FailureLedger(db)
+    ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", ResourceNotFound("test", 404))
+    ledger.record("bbbbbb", "https://example.com/b.jpg", "Direct", ResourceNotFound("test", 404))
+    ledger.record("bbbbbb", "https://example.com/c.jpg", "Direct", BulkDownloaderException("test"))
+    db.commit()
+    # Only read when the ledger is made, at the start of a run
+    assert not ledger.given_up("aaaaaa")
+    ledger = FailureLedger(db)
+    assert ledger.given_up("aaaaaa")
+    assert not ledger.given_up("bbbbbb")
+
+
+def test_clear(db: Database):
+    ledger = FailureLedger(db)
+    ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", ResourceNotFound("test", 404))
+    ledger.record("bbbbbb", "https://example.com/c.jpg", "Direct", BulkDownloaderException("test"))
+    db.commit()
+    ledger = FailureLedger(db)
+    assert ledger.given_up("aaaaaa")
+    ledger.clear("aaaaaa")
+    ledger.clear("cccccc")
+    assert [row[0] for row in _rows(db)] == ["bbbbbb"]
+    assert not ledger.given_up("aaaaaa")
+
+
+def test_clear_without_failures(db: Database):
+    db.write = MagicMock()
+    ledger = FailureLedger(db)
+    ledger.clear("aaaaaa")
+    db.write.assert_not_called()
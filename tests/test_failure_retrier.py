@@ -0,0 +1,48 @@
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from bdfrx.configuration import Configuration
+from bdfrx.database import Database
+from bdfrx.downloader import RedditDownloader
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.failure_ledger import FailureLedger
+from bdfrx.failure_retrier import FailureRetrier
+
+
+def test_needs_db():
+    args = Configuration()
+    args.directory = "."
+    with pytest.raises(BulkDownloaderException, match="DB"):
+        FailureRetrier(args)
+
+
+def test_lists_due_failures(tmp_path: Path):
+    db = Database(Path(tmp_path, "test.db"))
+    ledger = FailureLedger(db)
+    with patch("bdfrx.failure_ledger.time.time", return_value=1000):
+        ledger.record("aaaaaa", "https://example.com/a.jpg", "Direct", BulkDownloaderException("test"))
+        ledger.record("bbbbbb", "https://example.com/b.jpg", "Direct", BulkDownloaderException("test"))
+    ledger.record("cccccc", "https://example.com/c.jpg", "Direct", BulkDownloaderException("test"))
+    db.commit()
+    args = Configuration()
+    args.db = True
+
+    def downloader_init(retrier: FailureRetrier, *_) -> None:
+        retrier.failure_ledger = FailureLedger(db)
+        retrier.reddit_instance = MagicMock()
+        retrier.reddit_instance.submission.side_effect = lambda id: id  # noqa: A002
+
+    with patch.object(RedditDownloader, "__init__", downloader_init):
+        retrier = FailureRetrier(args)
+    db.close()
+    assert retrier.reddit_lists == [["aaaaaa", "bbbbbb"]]
+    assert retrier.retrieve_reddit_lists() == []
+
+
+def test_known_submissions_retried():
+    retrier = FailureRetrier.__new__(FailureRetrier)
+    known = retrier._find_known_submissions([MagicMock(id="aaaaaa")])
+    assert not known.post_ids
+    assert not known.links
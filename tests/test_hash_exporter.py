@@ -0,0 +1,54 @@
+import configparser
+import hashlib
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from bdfrx.configuration import Configuration
+from bdfrx.database import Database
+from bdfrx.hash_exporter import HashExporter
+from bdfrx.shared_hashes import SharedHashSet
+
+
+@pytest.fixture()
+def exporter(tmp_path: Path) -> Iterator[HashExporter]:
+    exporter = HashExporter.__new__(HashExporter)
+    exporter.args = Configuration()
+    exporter.args.output_file = str(Path(tmp_path, "export", "hashes.bin"))
+    exporter.cfg_parser = configparser.ConfigParser()
+    exporter.config_directory = tmp_path
+    exporter.db = Database(Path(tmp_path, "test.db"))
+    yield exporter
+    exporter.db.close()
+
+
+def test_export_db(exporter: HashExporter):
+    hashes = [hashlib.md5(str(i).encode(), usedforsecurity=False).hexdigest() for i in range(20)]
+    # A hash stored twice, for a file and a duplicate of it, is exported once
+    exporter.db.write_many(
+        "INSERT INTO download (status, hash, path, algorithm, recorded_at) VALUES ('downloaded', ?, 'test', 'md5', 0);",
+        [(h,) for h in [*hashes, hashes[0]]],
+    )
+    exporter.db.write(
+        "INSERT INTO download (status, hash, path, algorithm, recorded_at) "
+        "VALUES ('downloaded', ?, 'test', 'sha1', 0);",
+        ("ab" * 20,),
+    )
+    exporter.db.write("INSERT INTO download (status, post_id, recorded_at) VALUES ('migrated', 'aaaaaa', 0);")
+    exporter.db.commit()
+    assert exporter.export() == 20
+    shared = SharedHashSet(Path(exporter.args.output_file), "md5")
+    assert all(file_hash in shared for file_hash in hashes)
+
+
+def test_export_directory(exporter: HashExporter, tmp_path: Path):
+    directory = Path(tmp_path, "files")
+    directory.mkdir()
+    for i in range(5):
+        Path(directory, f"{i}.txt").write_text(f"test {i}")
+    Path(directory, "copy.txt").write_text("test 0")
+    exporter.args.from_directory = str(directory)
+    assert exporter.export() == 5
+    shared = SharedHashSet(Path(exporter.args.output_file), "md5")
+    assert hashlib.md5(b"test 3", usedforsecurity=False).hexdigest() in shared
@@ -0,0 +1,34 @@
+import hashlib
+from collections.abc import Iterator
+
+import pytest
+
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.hashing import HASH_ALGORITHMS, get_hash_algorithm, new_hash, set_hash_algorithm
+
+
+@pytest.fixture()
+def _restore_algorithm() -> Iterator[None]:
+    yield
+    set_hash_algorithm("md5")
+
+
+def test_default_algorithm():
+    assert get_hash_algorithm() == "md5"
+    assert new_hash(b"test").hexdigest() == hashlib.md5(b"test", usedforsecurity=False).hexdigest()
+
+
+@pytest.mark.parametrize("test_algorithm", HASH_ALGORITHMS)
+@pytest.mark.usefixtures("_restore_algorithm")
+def test_new_hash(test_algorithm: str):
+    set_hash_algorithm(test_algorithm.upper())
+    assert get_hash_algorithm() == test_algorithm
+    assert new_hash(b"test").hexdigest() == hashlib.new(test_algorithm, b"test").hexdigest()
+
+
+@pytest.mark.parametrize("test_algorithm", ("", "crc32", "sha3"))
+@pytest.mark.usefixtures("_restore_algorithm")
+def test_unknown_algorithm(test_algorithm: str):
+    with pytest.raises(BulkDownloaderException, match="Unknown hash algorithm"):
+        set_hash_algorithm(test_algorithm)
+    assert get_hash_algorithm() == "md5"
@@ -0,0 +1,91 @@
+import sqlite3
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from bdfrx.database import Database
+from bdfrx.known_submissions import DownloadRecord, KnownSubmissions
+
+
+def _create_db(path: Path, post_ids: Iterator[tuple[str]], links: Iterator[tuple[str]]) -> Database:
+    Database(path).close()
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO download (status, post_id, recorded_at) VALUES ('downloaded', ?, 0);", post_ids)
+    db.executemany("INSERT INTO download (status, link, recorded_at) VALUES ('downloaded', ?, 0);", links)
+    db.commit()
+    db.close()
+    return Database(path)
+
+
+def test_find(tmp_path: Path):
+    db = _create_db(
+        Path(tmp_path, "test.db"),
+        ((f"id{i}",) for i in range(1_200)),
+        ((f"https://example.com/{i}",) for i in range(10)),
+    )
+    known = KnownSubmissions(db)
+    result = known.find(
+        [f"id{i}" for i in range(0, 2_000, 2)],
+        ["https://example.com/1", "https://example.com/other"],
+    )
+    assert result.post_ids == {f"id{i}" for i in range(0, 1_200, 2)}
+    assert result.links == {"https://example.com/1"}
+    db.close()
+
+
+def test_add(tmp_path: Path):
+    db = _create_db(Path(tmp_path, "test.db"), iter(()), iter(()))
+    known = KnownSubmissions(db)
+    known.add(DownloadRecord("aaaaaa", "https://example.com/a", "downloaded", path="a.png", module="Direct"))
+    # The link of a hard link does not stop later submissions
+    known.add(DownloadRecord("bbbbbb", "https://example.com/b", "linked", path="b.png", module="Direct"))
+    links = ["https://example.com/a", "https://example.com/b"]
+    # Found before the writes are committed
+    expected = ({"aaaaaa", "bbbbbb"}, {"https://example.com/a"})
+    assert known.find(["aaaaaa", "bbbbbb", "cccccc"], links) == expected
+    db.commit()
+    assert KnownSubmissions(db).find(["aaaaaa", "bbbbbb", "cccccc"], links) == expected
+    assert db.query("SELECT post_id, path, module FROM download ORDER BY id;").fetchall() == [
+        ("aaaaaa", "a.png", "Direct"),
+        ("bbbbbb", "b.png", "Direct"),
+    ]
+    db.close()
+
+
+@pytest.mark.slow
+def test_benchmark_known_submissions(tmp_path: Path):
+    row_count = 5_000_000
+    db = _create_db(
+        Path(tmp_path, "test.db"),
+        ((f"{i:07x}",) for i in range(row_count)),
+        ((f"https://i.redd.it/{i:013x}.jpg",) for i in range(row_count)),
+    )
+    known = KnownSubmissions(db)
+
+    # An incremental run, where most of each page of 100 has been seen before
+    pages = [
+        [(f"{i:07x}", f"https://i.redd.it/{i:013x}.jpg") for i in range(start, start + 90)]
+        + [(f"new{i}", f"https://i.redd.it/new{i}.jpg") for i in range(start, start + 10)]
+        for start in range(0, row_count, row_count // 100)
+    ]
+    started = time.perf_counter()
+    for page in pages:
+        result = known.find((post_id for post_id, _ in page), (link for _, link in page))
+        assert len(result.post_ids) == len(result.links) == 90
+    batched_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for page in pages:
+        for post_id, link in page:
+            if not db.query("SELECT post_id FROM download WHERE post_id=?;", (post_id,)).fetchone():
+                db.query("SELECT link FROM download WHERE link=?;", (link,)).fetchone()
+    point_time = time.perf_counter() - started
+
+    print(
+        f"\nChecked {len(pages)} pages against {2 * row_count} rows in {batched_time * 1000:.0f}ms batched and "
+        f"{point_time * 1000:.0f}ms one by one",
+    )
+    db.close()
+    assert batched_time < point_time
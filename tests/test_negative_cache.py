@@ -0,0 +1,120 @@
+import sqlite3
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from bdfrx.exceptions import BulkDownloaderException, NotADownloadableLinkError, ResourceNotFound, SiteDownloaderError
+from bdfrx.negative_cache import DEFAULT_TTLS, NO_RESOURCES, CachedFailure, NegativeCache, is_dead_link
+
+
+def test_cache_hit(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    cache.add("https://example.com/a", "ResourceNotFound", "Server responded with 404")
+    cache.add("https://example.com/b", NO_RESOURCES, "Imgur found nothing")
+    assert cache.get("https://example.com/a") == CachedFailure("ResourceNotFound", "Server responded with 404")
+    assert cache.get("https://example.com/b") == CachedFailure(NO_RESOURCES, "Imgur found nothing")
+    assert cache.get("https://example.com/b")
+    assert cache.get("https://example.com/c") is None
+    assert cache.hits == {"ResourceNotFound": 1, NO_RESOURCES: 2}
+    cache.close()
+
+
+def test_kept_between_runs(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    cache.add("https://example.com/a", "NotADownloadableLinkError", "No downloader module exists")
+    cache.close()
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    assert cache.get("https://example.com/a").error == "NotADownloadableLinkError"
+    cache.close()
+
+
+def test_errors_without_ttl_not_kept(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"), {"ResourceNotFound": 0})
+    cache.add("https://example.com/a", "ResourceNotFound", "Server responded with 404")
+    cache.add("https://example.com/b", "SiteDownloaderError", "Timeout")
+    cache.add("", "NotADownloadableLinkError", "No url provided by the reddit API")
+    assert cache.get("https://example.com/a") is None
+    assert cache.get("https://example.com/b") is None
+    assert cache.get("") is None
+    cache.close()
+
+
+def test_expired(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"), {"ResourceNotFound": 1})
+    with patch("bdfrx.negative_cache.time.time", return_value=1000):
+        cache.add("https://example.com/a", "ResourceNotFound", "Server responded with 404")
+        assert cache.get("https://example.com/a")
+    with patch("bdfrx.negative_cache.time.time", return_value=1000 + 3600):
+        assert cache.get("https://example.com/a") is None
+    cache.close()
+    # Expired entries are removed when the cache is next opened
+    NegativeCache(Path(tmp_path, "negative_cache.db")).close()
+    connection = sqlite3.connect(Path(tmp_path, "negative_cache.db"))
+    assert connection.execute("SELECT COUNT(*) FROM negative_cache;").fetchone()[0] == 0
+    connection.close()
+
+
+def test_dropped_on_upgrade(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    cache.add("https://example.com/a", "NotADownloadableLinkError", "No downloader module exists")
+    cache.close()
+    with patch("bdfrx.negative_cache.__version__", "99.0.0"):
+        cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+        assert cache.get("https://example.com/a") is None
+    cache.close()
+
+
+def test_dropped_on_ytdlp_upgrade(tmp_path: Path):
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    cache.add("https://example.com/a", "NotADownloadableLinkError", "No downloader module exists")
+    cache.close()
+    with patch("bdfrx.negative_cache.yt_dlp.version.__version__", "2099.01.01"):
+        cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+        assert cache.get("https://example.com/a") is None
+    cache.close()
+
+
+@pytest.mark.parametrize(
+    ("test_error", "expected"),
+    (
+        (ResourceNotFound("test", 404), True),
+        (ResourceNotFound("test", 410), True),
+        (ResourceNotFound("test", 500), False),
+        (ResourceNotFound("test"), False),
+        (NotADownloadableLinkError("Video info extraction failed"), False),
+        (SiteDownloaderError("test"), False),
+    ),
+)
+def test_is_dead_link(test_error: Exception, expected: bool):
+    assert is_dead_link(test_error) == expected
+
+
+def test_hits_logged(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    caplog.set_level(0)
+    cache = NegativeCache(Path(tmp_path, "negative_cache.db"))
+    cache.add("https://example.com/a", "ResourceNotFound", "Server responded with 404")
+    cache.get("https://example.com/a")
+    cache.close()
+    assert "Skipped 1 links that failed in earlier runs (ResourceNotFound 1)" in caplog.text
+
+
+@pytest.mark.parametrize(
+    ("test_entries", "expected"),
+    (
+        ([""], DEFAULT_TTLS),
+        (["ResourceNotFound=1"], {**DEFAULT_TTLS, "ResourceNotFound": 1}),
+        (
+            ["NoResources = 0.5, SiteDownloaderError=2", "ResourceNotFound=0"],
+            {**DEFAULT_TTLS, NO_RESOURCES: 0.5, "SiteDownloaderError": 2, "ResourceNotFound": 0},
+        ),
+    ),
+)
+def test_parse_ttls(test_entries: list[str], expected: dict):
+    assert NegativeCache.parse_ttls(test_entries) == expected
+
+
+@pytest.mark.parametrize("test_entry", ("ResourceNotFound", "ResourceNotFound=a", "=1"))
+def test_parse_ttls_bad(test_entry: str):
+    with pytest.raises(BulkDownloaderException):
+        NegativeCache.parse_ttls([test_entry])
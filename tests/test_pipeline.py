@@ -0,0 +1,285 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union
+
+import pytest
+
+from bdfrx.pipeline import ByteBudget, Pipeline, RetryLater, Stage
+
+
+@pytest.mark.parametrize(("test_workers", "test_queue_size"), ((1, 1), (2, 1), (4, 10)))
+def test_pipeline_processes_all_items(test_workers: int, test_queue_size: int):
+    results = []
+    lock = threading.Lock()
+
+    def collect(item: int) -> None:
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline(
+        [
+            Stage("split", lambda item: [item * 10, item * 10 + 1], test_workers),
+            Stage("double", lambda item: [item * 2], test_workers),
+            Stage("collect", collect, test_workers),
+        ],
+        queue_size=test_queue_size,
+    )
+    pipeline.run(range(20))
+    assert sorted(results) == sorted(2 * x for i in range(20) for x in (i * 10, i * 10 + 1))
+    assert [stage.processed for stage in pipeline.stages] == [20, 40, 40]
+
+
+def test_pipeline_filters_items():
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("filter", lambda item: [item] if item % 2 else None),
+            Stage("collect", results.append),
+        ],
+    )
+    pipeline.run(range(10))
+    assert results == [1, 3, 5, 7, 9]
+
+
+def test_pipeline_generator_stage():
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("listing", iter),
+            Stage("collect", results.append),
+        ],
+        queue_size=1,
+    )
+    pipeline.run([range(3), range(3, 5)])
+    assert results == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("test_failing_stage", (0, 1, 2))
+def test_pipeline_raises_stage_error(test_failing_stage: int):
+    def fail(_: int) -> None:
+        raise RuntimeError("test")
+
+    stages = [Stage(f"stage_{i}", lambda item: [item], 2) for i in range(3)]
+    stages[test_failing_stage].function = fail
+    pipeline = Pipeline(stages, queue_size=1)
+    with pytest.raises(RuntimeError):
+        pipeline.run(range(100))
+
+
+def test_pipeline_queue_depths():
+    release = threading.Event()
+    pipeline = Pipeline(
+        [
+            Stage("first", lambda item: [item]),
+            Stage("blocked", lambda _: release.wait() and None),
+        ],
+        queue_size=5,
+        report_interval=0.01,
+    )
+    runner = threading.Thread(target=pipeline.run, args=(range(10),))
+    runner.start()
+    while pipeline.queue_depths()["blocked"] < 5:
+        time.sleep(0.01)
+    assert set(pipeline.queue_depths()) == {"first", "blocked"}
+    release.set()
+    runner.join()
+    assert pipeline.queue_depths() == {"first": 0, "blocked": 0}
+
+
+def test_stage_requires_worker():
+    with pytest.raises(ValueError, match="at least one worker"):
+        Stage("test", print, 0)
+
+
+def test_pipeline_retries_deferred_items():
+    attempts = {}
+    results = []
+    lock = threading.Lock()
+
+    def flaky(item: int) -> list[int]:
+        with lock:
+            attempts[item] = attempts.get(item, 0) + 1
+            if attempts[item] <= item % 3:
+                raise RetryLater(item, 0.01 * (item % 3))
+        return [item]
+
+    def collect(item: int) -> None:
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline([Stage("flaky", flaky, 2), Stage("collect", collect)], queue_size=2)
+    pipeline.run(range(20))
+    assert sorted(results) == list(range(20))
+    assert attempts == {i: i % 3 + 1 for i in range(20)}
+    assert pipeline.deferred_count() == 0
+
+
+def test_pipeline_retry_does_not_block_workers():
+    order = []
+    first_attempt = threading.Event()
+
+    def slow_first(item: int) -> list[int]:
+        if item == 0 and not first_attempt.is_set():
+            first_attempt.set()
+            raise RetryLater(item, 0.2)
+        return [item]
+
+    pipeline = Pipeline([Stage("fetch", slow_first), Stage("collect", order.append)])
+    pipeline.run(range(5))
+    assert order == [1, 2, 3, 4, 0]
+
+
+def test_pipeline_retry_in_middle_stage():
+    retried = set()
+    results = []
+
+    def retry_once(item: int) -> list[int]:
+        if item not in retried:
+            retried.add(item)
+            raise RetryLater(item, 0.01)
+        return [item * 2]
+
+    pipeline = Pipeline(
+        [
+            Stage("first", lambda item: [item]),
+            Stage("retry", retry_once),
+            Stage("collect", results.append),
+        ],
+        queue_size=1,
+    )
+    pipeline.run(range(10))
+    assert sorted(results) == [i * 2 for i in range(10)]
+
+
+def test_pipeline_error_discards_retries():
+    def fail(item: int) -> None:
+        if item == 5:
+            raise RuntimeError("test")
+        raise RetryLater(item, 60)
+
+    pipeline = Pipeline([Stage("fail", fail)])
+    with pytest.raises(RuntimeError):
+        pipeline.run(range(10))
+    assert pipeline.deferred_count() == 0
+
+
+def test_pipeline_future_stage():
+    results = []
+    retried = set()
+    lock = threading.Lock()
+
+    def fetch(item: int) -> list[int]:
+        time.sleep(0.01 * (item % 3))
+        if item % 4 == 0 and item not in retried:
+            retried.add(item)
+            raise RetryLater(item, 0.01)
+        return [item * 2]
+
+    def collect(item: int) -> None:
+        with lock:
+            results.append(item)
+
+    with ThreadPoolExecutor(8) as executor:
+        pipeline = Pipeline(
+            [Stage("fetch", lambda item: executor.submit(fetch, item)), Stage("collect", collect)],
+            queue_size=1,
+        )
+        pipeline.run(range(20))
+    assert sorted(results) == [i * 2 for i in range(20)]
+    assert [stage.processed for stage in pipeline.stages] == [20, 20]
+    assert retried == {0, 4, 8, 12, 16}
+
+
+def test_pipeline_future_error():
+    def fail() -> None:
+        raise RuntimeError("test")
+
+    with ThreadPoolExecutor(1) as executor:
+        pipeline = Pipeline([Stage("fail", lambda _: executor.submit(fail)), Stage("collect", lambda _: None)])
+        with pytest.raises(RuntimeError):
+            pipeline.run(range(5))
+
+
+def test_pipeline_future_does_not_block_worker():
+    pending: Future = Future()
+    results = []
+
+    def start(item: int) -> Union[Future, list[int]]:
+        if item == 0:
+            return pending
+        if item == 4:
+            pending.set_result([0])
+        return [item]
+
+    pipeline = Pipeline([Stage("fetch", start), Stage("collect", results.append)])
+    pipeline.run(range(5))
+    assert results[:3] == [1, 2, 3]
+    assert sorted(results) == [0, 1, 2, 3, 4]
+
+
+def test_byte_budget_unlimited():
+    budget = ByteBudget()
+    assert budget.reserve(10**12) == 0
+    assert budget.used == 0
+
+
+def test_byte_budget_blocks_until_released():
+    budget = ByteBudget(100)
+    assert budget.reserve(60) == 60
+    reserved = threading.Event()
+
+    def reserve() -> None:
+        budget.reserve(60)
+        reserved.set()
+
+    thread = threading.Thread(target=reserve)
+    thread.start()
+    assert not reserved.wait(0.1)
+    budget.release(60)
+    assert reserved.wait(1)
+    thread.join()
+    assert budget.used == 60
+
+
+def test_byte_budget_oversized_item_goes_alone():
+    budget = ByteBudget(100)
+    assert budget.reserve(500) == 100
+    budget.release(100)
+    assert budget.used == 0
+
+
+def test_byte_budget_without_waiting():
+    budget = ByteBudget(100)
+    budget.reserve(100)
+    assert budget.reserve(50, wait=False) == 50
+    assert budget.used == 150
+
+
+def test_byte_budget_reserve_async():
+    budget = ByteBudget(100)
+    assert budget.reserve(60) == 60
+
+    async def reserve() -> int:
+        task = asyncio.ensure_future(budget.reserve_async(60))
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        threading.Thread(target=budget.release, args=(60,)).start()
+        return await asyncio.wait_for(task, 1)
+
+    assert asyncio.run(reserve()) == 60
+    assert budget.used == 60
+
+
+def test_byte_budget_reserve_async_cancelled():
+    budget = ByteBudget(100)
+    budget.reserve(100)
+
+    async def reserve() -> None:
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(budget.reserve_async(10), 0.05)
+
+    asyncio.run(reserve())
+    budget.release(100)
+    assert budget.used == 0
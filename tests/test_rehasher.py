@@ -0,0 +1,56 @@
+import configparser
+import hashlib
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from bdfrx.database import Database
+from bdfrx.hashing import set_hash_algorithm
+from bdfrx.rehasher import Rehasher
+
+
+@pytest.fixture()
+def rehasher(tmp_path: Path) -> Iterator[Rehasher]:
+    rehasher = Rehasher.__new__(Rehasher)
+    rehasher.cfg_parser = configparser.ConfigParser()
+    rehasher.config_directory = tmp_path
+    rehasher.db = Database(Path(tmp_path, "test.db"))
+    rehasher.batch_size = 2
+    set_hash_algorithm("sha256")
+    yield rehasher
+    set_hash_algorithm("md5")
+    rehasher.db.close()
+
+
+def test_rehash(rehasher: Rehasher, tmp_path: Path):
+    files = []
+    for i in range(5):
+        file = Path(tmp_path, f"{i}.txt")
+        file.write_text(f"test {i}")
+        files.append(file)
+        rehasher.db.write(
+            "INSERT INTO download (status, hash, path, algorithm, recorded_at) VALUES ('downloaded', ?, ?, 'md5', 0);",
+            (hashlib.md5(file.read_bytes(), usedforsecurity=False).hexdigest(), str(file)),
+        )
+    rehasher.db.write(
+        "INSERT INTO download (status, hash, path, algorithm, recorded_at) "
+        "VALUES ('downloaded', 'missing', 'missing.txt', 'md5', 0);",
+    )
+    # A post ID without a file is not rehashed
+    rehasher.db.write("INSERT INTO download (status, post_id, recorded_at) VALUES ('migrated', 'aaaaaa', 0);")
+    rehasher.db.commit()
+    rehasher.rehash()
+    rows = rehasher.db.query("SELECT path, hash FROM download WHERE algorithm = 'sha256' ORDER BY id;").fetchall()
+    assert rows == [(str(file), hashlib.sha256(file.read_bytes()).hexdigest()) for file in files]
+    assert rehasher.db.query("SELECT hash FROM download WHERE algorithm = 'md5';").fetchall() == [("missing",)]
+
+
+def test_rehash_nothing_outdated(rehasher: Rehasher, tmp_path: Path):
+    rehasher.db.write(
+        "INSERT INTO download (status, hash, path, algorithm, recorded_at) "
+        "VALUES ('downloaded', 'test', 'test.txt', 'sha256', 0);",
+    )
+    rehasher.db.commit()
+    rehasher.rehash()
+    assert rehasher.db.query("SELECT hash, algorithm FROM download;").fetchall() == [("test", "sha256")]
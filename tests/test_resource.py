@@ -1,8 +1,21 @@
-from unittest.mock import MagicMock
+import errno
+import hashlib
+import json
+import re
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, ClassVar
+from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
-from bdfrx.resource import Resource
+from bdfrx.content_index import ResponseMetadata
+from bdfrx.exceptions import BulkDownloaderException, ResourceNotFound, RetryableDownloadError
+from bdfrx.resource import KnownContent, Resource, SegmentedDownload
+from bdfrx.transport import AsyncTransport, RequestsTransport
 
 
 @pytest.mark.parametrize(
@@ -35,3 +48,426 @@ def test_download_online_resource(test_url: str, expected_hash: str):
     test_resource = Resource(MagicMock(), test_url, Resource.retry_download(test_url))
     test_resource.download()
     assert test_resource.hash.hexdigest() == expected_hash
+
+
+@pytest.mark.parametrize(
+    ("test_status", "expected"),
+    (
+        (408, RetryableDownloadError),
+        (429, RetryableDownloadError),
+        (404, ResourceNotFound),
+        (410, ResourceNotFound),
+        (500, BulkDownloaderException),
+    ),
+)
+def test_http_download_error_status(test_status: int, expected: type[Exception]):
+    transport = MagicMock()
+    transport.get.return_value.status_code = test_status
+    transport.scheduler.remaining_delay.return_value = 30
+    with patch("bdfrx.resource.get_transport", return_value=transport), pytest.raises(expected) as exc_info:
+        Resource.http_download("https://example.com/test.png", {})
+    assert isinstance(exc_info.value, RetryableDownloadError) == (expected is RetryableDownloadError)
+    if expected is RetryableDownloadError:
+        assert exc_info.value.retry_after == 30
+
+
+@pytest.mark.parametrize(
+    "test_error",
+    (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.Timeout,
+    ),
+)
+def test_http_download_connection_error(test_error: type[Exception]):
+    transport = MagicMock()
+    transport.get.side_effect = test_error
+    with patch("bdfrx.resource.get_transport", return_value=transport), pytest.raises(RetryableDownloadError):
+        Resource.http_download("https://example.com/test.png", {})
+    transport.get.assert_called_once()
+
+
+@pytest.fixture()
+def streaming_transport() -> MagicMock:
+    transport = MagicMock()
+    transport.get.return_value.status_code = 200
+    transport.get.return_value.headers = {}
+    transport.get.return_value.iter_content.return_value = [b"test ", b"data"]
+    transport.segments = 1
+    return transport
+
+
+def test_http_download_streams_to_file(streaming_transport: MagicMock, tmp_path: Path):
+    destination = Path(tmp_path, "folder", "test.png")
+    with patch("bdfrx.resource.get_transport", return_value=streaming_transport):
+        result = Resource.http_download("https://example.com/test.png", {"destination": destination})
+    assert result.path == Path(tmp_path, "folder", "test.png.part")
+    assert result.path.read_bytes() == b"test data"
+    assert result.file_hash.hexdigest() == hashlib.md5(b"test data", usedforsecurity=False).hexdigest()
+    streaming_transport.get.assert_called_once_with("https://example.com/test.png", headers=None, stream=True)
+
+
+def test_http_download_stream_interrupted(streaming_transport: MagicMock, tmp_path: Path):
+    def interrupted_body(**_) -> Iterator[bytes]:
+        yield b"test "
+        raise requests.exceptions.ChunkedEncodingError
+
+    streaming_transport.get.return_value.iter_content.side_effect = interrupted_body
+    with (
+        patch("bdfrx.resource.get_transport", return_value=streaming_transport),
+        pytest.raises(
+            RetryableDownloadError,
+        ),
+    ):
+        Resource.http_download("https://example.com/test.png", {"destination": Path(tmp_path, "test.png")})
+    assert not list(tmp_path.iterdir())
+
+
+def test_http_download_stream_empty(streaming_transport: MagicMock, tmp_path: Path):
+    streaming_transport.get.return_value.iter_content.return_value = []
+    with (
+        patch("bdfrx.resource.get_transport", return_value=streaming_transport),
+        pytest.raises(
+            BulkDownloaderException,
+            match="HTTP Code 200",
+        ),
+    ):
+        Resource.http_download("https://example.com/test.png", {"destination": Path(tmp_path, "test.png")})
+    assert not list(tmp_path.iterdir())
+
+
+def test_resource_download_to_file(streaming_transport: MagicMock, tmp_path: Path):
+    test_resource = Resource(
+        MagicMock(),
+        "https://example.com/test.png",
+        Resource.retry_download("https://example.com/test.png"),
+    )
+    with patch("bdfrx.resource.get_transport", return_value=streaming_transport):
+        test_resource.download({"destination": Path(tmp_path, "test.png")})
+    assert test_resource.content is None
+    assert test_resource.path == Path(tmp_path, "test.png.part")
+    assert test_resource.hash.hexdigest() == hashlib.md5(b"test data", usedforsecurity=False).hexdigest()
+    test_resource.discard_download()
+    assert test_resource.path is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_create_hash_from_file(tmp_path: Path):
+    test_file = Path(tmp_path, "test.part")
+    test_file.write_bytes(b"a" * 3_000_000)
+    test_resource = Resource(MagicMock(), "https://example.com/test.png", lambda _: None)
+    test_resource.path = test_file
+    test_resource.create_hash()
+    assert test_resource.hash.hexdigest() == hashlib.md5(b"a" * 3_000_000, usedforsecurity=False).hexdigest()
+
+
+def test_move_file_across_filesystems(tmp_path: Path):
+    source = Path(tmp_path, "source")
+    source.write_bytes(b"test")
+    target = Path(tmp_path, "target")
+    with patch.object(Path, "replace", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+        Resource.move_file(source, target)
+    assert target.read_bytes() == b"test"
+    assert not source.exists()
+
+
+def test_move_file_error(tmp_path: Path):
+    with pytest.raises(FileNotFoundError):
+        Resource.move_file(Path(tmp_path, "missing"), Path(tmp_path, "target"))
+
+
+# Several chunks long, so that an interrupted download has written part of the file
+TEST_BODY = bytes(range(256)) * 16384
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_seen: ClassVar[list[dict]] = []
+
+    def log_message(self, *_) -> None:
+        pass
+
+    def do_HEAD(self) -> None:  # noqa: N802
+        _RangeHandler.requests_seen.append({**self.headers, "Method": "HEAD"})
+        self._respond(send_body=False)
+
+    def do_GET(self) -> None:  # noqa: N802
+        _RangeHandler.requests_seen.append(dict(self.headers))
+        self._respond(send_body=True)
+
+    def _respond(self, send_body: bool) -> None:
+        etag = '"changed"' if self.path == "/changed" else '"test"'
+        supports_ranges = self.path != "/plain"
+        start, end = 0, len(TEST_BODY) - 1
+        range_match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        ranged = bool(supports_ranges and range_match and if_range in (None, etag) and self.path != "/no-segments")
+        if ranged:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2) or end)
+        body = TEST_BODY[start : end + 1]
+        self.send_response(206 if ranged else 200)
+        if ranged:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(TEST_BODY)}")
+        if supports_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if self.path.startswith("/interrupt") and not ranged:
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def range_server() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture()
+def segmenting_transport() -> Iterator[RequestsTransport]:
+    transport = RequestsTransport(segments=4, segment_threshold=1024)
+    with patch("bdfrx.resource.get_transport", return_value=transport):
+        yield transport
+    transport.close()
+
+
+def _write_partial(destination: Path, url: str, etag: str = '"test"') -> None:
+    part_path = Resource.part_path(destination)
+    part_path.write_bytes(TEST_BODY[:1000])
+    Resource.validator_path(part_path).write_text(json.dumps({"url": url, "etag": etag, "last_modified": None}))
+
+
+@pytest.mark.parametrize("test_path", ("/file", "/changed", "/plain"))
+def test_http_download_resume(test_path: str, range_server: str, tmp_path: Path):
+    destination = Path(tmp_path, "test.bin")
+    url = range_server + test_path
+    _write_partial(destination, url)
+    _RangeHandler.requests_seen.clear()
+    result = Resource.http_download(url, {"destination": destination})
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+    assert _RangeHandler.requests_seen[0]["Range"] == "bytes=1000-"
+    assert len(_RangeHandler.requests_seen) == 1
+    assert not Resource.validator_path(result.path).exists()
+
+
+def test_http_download_resume_other_url(range_server: str, tmp_path: Path):
+    destination = Path(tmp_path, "test.bin")
+    _write_partial(destination, range_server + "/other")
+    _RangeHandler.requests_seen.clear()
+    result = Resource.http_download(range_server + "/file", {"destination": destination})
+    assert result.path.read_bytes() == TEST_BODY
+    assert "Range" not in _RangeHandler.requests_seen[0]
+
+
+def test_http_download_interrupted_then_resumed(range_server: str, tmp_path: Path):
+    destination = Path(tmp_path, "test.bin")
+    url = range_server + "/interrupt"
+    with pytest.raises(RetryableDownloadError):
+        Resource.http_download(url, {"destination": destination})
+    part_path = Resource.part_path(destination)
+    assert 0 < part_path.stat().st_size < len(TEST_BODY)
+    assert json.loads(Resource.validator_path(part_path).read_text())["content_length"] == len(TEST_BODY)
+    result = Resource.http_download(url, {"destination": destination})
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+
+
+@pytest.mark.parametrize(
+    ("test_size", "test_segments", "expected"),
+    (
+        (10, 3, [(0, 3), (4, 7), (8, 9)]),
+        (8, 4, [(0, 1), (2, 3), (4, 5), (6, 7)]),
+        (5, 1, [(0, 4)]),
+    ),
+)
+def test_segment_ranges(test_size: int, test_segments: int, expected: list[tuple[int, int]]):
+    assert SegmentedDownload.ranges(test_size, test_segments) == expected
+
+
+@pytest.mark.usefixtures("segmenting_transport")
+def test_http_download_segmented(range_server: str, tmp_path: Path):
+    _RangeHandler.requests_seen.clear()
+    result = Resource.http_download(range_server + "/file", {"destination": Path(tmp_path, "test.bin")})
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+    # The headers of the first request decide on segmenting, and its body is not read
+    first_request, *range_requests = _RangeHandler.requests_seen
+    assert "Method" not in first_request
+    assert "Range" not in first_request
+    assert sorted(request["Range"] for request in range_requests) == [
+        f"bytes={start}-{end}" for start, end in SegmentedDownload.ranges(len(TEST_BODY), 4)
+    ]
+    assert all(request["If-Range"] == '"test"' for request in range_requests)
+    assert result.metadata == ResponseMetadata(range_server + "/file", '"test"', len(TEST_BODY), None)
+
+
+@pytest.mark.parametrize("test_path", ("/plain", "/no-segments"))
+@pytest.mark.usefixtures("segmenting_transport")
+def test_http_download_segments_unsupported(test_path: str, range_server: str, tmp_path: Path):
+    _RangeHandler.requests_seen.clear()
+    result = Resource.http_download(range_server + test_path, {"destination": Path(tmp_path, "test.bin")})
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+    assert "Range" not in _RangeHandler.requests_seen[-1]
+
+
+def test_http_download_below_segment_threshold(
+    segmenting_transport: RequestsTransport,
+    range_server: str,
+    tmp_path: Path,
+):
+    segmenting_transport.segment_threshold = len(TEST_BODY) + 1
+    _RangeHandler.requests_seen.clear()
+    result = Resource.http_download(range_server + "/file", {"destination": Path(tmp_path, "test.bin")})
+    assert result.path.read_bytes() == TEST_BODY
+    assert len(_RangeHandler.requests_seen) == 1
+    assert "Range" not in _RangeHandler.requests_seen[0]
+
+
+@pytest.mark.parametrize("test_segments", (1, 4))
+def test_http_download_known_content(test_segments: int, range_server: str, tmp_path: Path):
+    existing = Path(tmp_path, "existing.bin")
+    existing.write_bytes(TEST_BODY)
+    destination = Path(tmp_path, "test.bin")
+    seen = []
+
+    def find_known(metadata: ResponseMetadata) -> Path:
+        seen.append(metadata)
+        return existing
+
+    transport = RequestsTransport(segments=test_segments, segment_threshold=1024)
+    _RangeHandler.requests_seen.clear()
+    with patch("bdfrx.resource.get_transport", return_value=transport):
+        result = Resource.http_download(
+            range_server + "/file",
+            {"destination": destination, "find_known_content": find_known},
+        )
+    transport.close()
+    assert result == KnownContent(existing)
+    assert seen == [ResponseMetadata(range_server + "/file", '"test"', len(TEST_BODY), None)]
+    assert len(_RangeHandler.requests_seen) == 1
+    assert "Method" not in _RangeHandler.requests_seen[0]
+    assert sorted(tmp_path.iterdir()) == [existing]
+
+
+def test_resource_download_known_content(tmp_path: Path):
+    existing = Path(tmp_path, "existing.bin")
+    resource = Resource(MagicMock(), "https://example.com/test.bin", lambda _: KnownContent(existing))
+    resource.download()
+    assert resource.known_file == existing
+    assert resource.hash is None
+    assert resource.path is None
+
+
+@pytest.fixture()
+def async_transport() -> Iterator[AsyncTransport]:
+    pytest.importorskip("aiohttp")
+    transport = AsyncTransport(segments=4, segment_threshold=len(TEST_BODY) + 1)
+    yield transport
+    transport.close()
+
+
+def _download_async(transport: AsyncTransport, url: str, download_parameters: dict) -> Any:
+    return transport.run(Resource.http_download_async(url, transport, download_parameters))
+
+
+def test_http_url():
+    assert (
+        Resource(
+            MagicMock(),
+            "https://example.com/a.jpg",
+            Resource.retry_download("https://example.com/b.jpg"),
+        ).http_url
+        == "https://example.com/b.jpg"
+    )
+    assert Resource(MagicMock(), "https://example.com/a.jpg", lambda _: None).http_url is None
+
+
+def test_http_download_async(async_transport: AsyncTransport, range_server: str, tmp_path: Path):
+    reserved = []
+
+    async def reserve(size: int) -> None:
+        reserved.append(size)
+
+    result = _download_async(
+        async_transport,
+        range_server + "/file",
+        {"destination": Path(tmp_path, "test.bin"), "reserve_bytes": reserve},
+    )
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+    assert result.metadata == ResponseMetadata(range_server + "/file", '"test"', len(TEST_BODY), None)
+    assert reserved == [len(TEST_BODY)]
+
+
+def test_http_download_async_to_memory(async_transport: AsyncTransport, range_server: str):
+    assert _download_async(async_transport, range_server + "/file", {}) == TEST_BODY
+
+
+@pytest.mark.parametrize("test_path", ("/file", "/changed", "/plain"))
+def test_http_download_async_resume(
+    test_path: str,
+    async_transport: AsyncTransport,
+    range_server: str,
+    tmp_path: Path,
+):
+    destination = Path(tmp_path, "test.bin")
+    url = range_server + test_path
+    _write_partial(destination, url)
+    _RangeHandler.requests_seen.clear()
+    result = _download_async(async_transport, url, {"destination": destination})
+    assert result.path.read_bytes() == TEST_BODY
+    assert result.file_hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
+    assert _RangeHandler.requests_seen[0]["Range"] == "bytes=1000-"
+    assert not Resource.validator_path(result.path).exists()
+
+
+def test_http_download_async_interrupted(async_transport: AsyncTransport, range_server: str, tmp_path: Path):
+    destination = Path(tmp_path, "test.bin")
+    with pytest.raises(RetryableDownloadError):
+        _download_async(async_transport, range_server + "/interrupt", {"destination": destination})
+    assert 0 < Resource.part_path(destination).stat().st_size < len(TEST_BODY)
+
+
+def test_http_download_async_connection_error(async_transport: AsyncTransport, tmp_path: Path):
+    with pytest.raises(RetryableDownloadError):
+        _download_async(async_transport, "http://127.0.0.1:1/test.bin", {"destination": Path(tmp_path, "test.bin")})
+
+
+def test_http_download_async_segmented(async_transport: AsyncTransport, range_server: str, tmp_path: Path):
+    async_transport.segment_threshold = 1024
+    _RangeHandler.requests_seen.clear()
+    result = _download_async(async_transport, range_server + "/file", {"destination": Path(tmp_path, "test.bin")})
+    assert result.path.read_bytes() == TEST_BODY
+    first_request, *range_requests = _RangeHandler.requests_seen
+    assert "Range" not in first_request
+    assert len(range_requests) == 4
+
+
+def test_http_download_async_known_content(async_transport: AsyncTransport, range_server: str, tmp_path: Path):
+    existing = Path(tmp_path, "existing.bin")
+    existing.write_bytes(TEST_BODY)
+    result = _download_async(
+        async_transport,
+        range_server + "/file",
+        {"destination": Path(tmp_path, "test.bin"), "find_known_content": lambda _: existing},
+    )
+    assert result == KnownContent(existing)
+    assert sorted(tmp_path.iterdir()) == [existing]
+
+
+def test_resource_download_async(async_transport: AsyncTransport, range_server: str, tmp_path: Path):
+    resource = Resource(MagicMock(), range_server + "/file.bin", Resource.retry_download(range_server + "/file.bin"))
+    async_transport.run(resource.download_async(async_transport, {"destination": Path(tmp_path, "test.bin")}))
+    assert resource.path.read_bytes() == TEST_BODY
+    assert resource.hash.hexdigest() == hashlib.md5(TEST_BODY, usedforsecurity=False).hexdigest()
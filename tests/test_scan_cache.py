@@ -0,0 +1,102 @@
+import os
+import sqlite3
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from bdfrx.scan_cache import FileKey, ScanCache
+
+
+@pytest.fixture()
+def test_file(tmp_path: Path) -> Path:
+    file = Path(tmp_path, "test.txt")
+    file.write_text("test")
+    return file
+
+
+@pytest.fixture()
+def scan_cache(tmp_path: Path) -> Iterator[ScanCache]:
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"), checkpoint_interval=2)
+    yield cache
+    cache.close()
+
+
+def test_file_key(test_file: Path):
+    stat = test_file.stat()
+    key = FileKey.from_stat(test_file, stat)
+    assert key == FileKey(str(test_file), stat.st_ino, 4, stat.st_mtime_ns)
+
+
+def test_cache_hit(test_file: Path, scan_cache: ScanCache):
+    key = FileKey.from_stat(test_file, test_file.stat())
+    scan_cache.put(key, "test_hash")
+    assert scan_cache.get(key) == "test_hash"
+
+
+@pytest.mark.parametrize(
+    "test_change",
+    (
+        {"inode": 1},
+        {"size": 5},
+        {"mtime_ns": 1},
+        {"path": "other.txt"},
+    ),
+)
+def test_cache_miss_on_change(test_change: dict, test_file: Path, scan_cache: ScanCache):
+    key = FileKey.from_stat(test_file, test_file.stat())
+    scan_cache.put(key, "test_hash")
+    assert scan_cache.get(key._replace(**test_change)) is None
+
+
+def test_cache_replaces_changed_file(test_file: Path, scan_cache: ScanCache):
+    scan_cache.put(FileKey.from_stat(test_file, test_file.stat()), "old_hash")
+    os.utime(test_file, ns=(0, 0))
+    key = FileKey.from_stat(test_file, test_file.stat())
+    scan_cache.put(key, "new_hash")
+    assert scan_cache.get(key) == "new_hash"
+
+
+def test_cache_checkpoints(test_file: Path, scan_cache: ScanCache):
+    key = FileKey.from_stat(test_file, test_file.stat())
+    scan_cache.put(key, "test_hash")
+    with sqlite3.connect(scan_cache.path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM scan_cache;").fetchone()[0] == 0
+    scan_cache.put(key._replace(path="other.txt"), "other_hash")
+    with sqlite3.connect(scan_cache.path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM scan_cache;").fetchone()[0] == 2
+
+
+def test_cache_persists(test_file: Path, tmp_path: Path):
+    key = FileKey.from_stat(test_file, test_file.stat())
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"))
+    cache.put(key, "test_hash")
+    cache.close()
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"))
+    assert cache.get(key) == "test_hash"
+    cache.close()
+
+
+def test_cache_algorithms_kept_apart(test_file: Path, tmp_path: Path):
+    key = FileKey.from_stat(test_file, test_file.stat())
+    md5_cache = ScanCache(Path(tmp_path, "scan_cache.db"), algorithm="md5")
+    md5_cache.put(key, "md5_hash")
+    md5_cache.close()
+    sha256_cache = ScanCache(Path(tmp_path, "scan_cache.db"), algorithm="sha256")
+    assert sha256_cache.get(key) is None
+    sha256_cache.put(key, "sha256_hash")
+    assert sha256_cache.get(key) == "sha256_hash"
+    sha256_cache.close()
+    md5_cache = ScanCache(Path(tmp_path, "scan_cache.db"), algorithm="md5")
+    assert md5_cache.get(key) == "md5_hash"
+    md5_cache.close()
+
+
+def test_cache_old_layout_replaced(test_file: Path, tmp_path: Path):
+    with sqlite3.connect(Path(tmp_path, "scan_cache.db")) as connection:
+        connection.execute("CREATE TABLE scan_cache (path TEXT PRIMARY KEY, hash TEXT NOT NULL);")
+    cache = ScanCache(Path(tmp_path, "scan_cache.db"))
+    key = FileKey.from_stat(test_file, test_file.stat())
+    cache.put(key, "test_hash")
+    assert cache.get(key) == "test_hash"
+    cache.close()
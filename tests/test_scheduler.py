@@ -0,0 +1,315 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from bdfrx.exceptions import BulkDownloaderException, RetryableDownloadError
+from bdfrx.scheduler import HostLimit, HostScheduler
+
+
+@pytest.fixture()
+def scheduler() -> HostScheduler:
+    return HostScheduler(
+        {
+            "imgur.com": HostLimit(2, 5),
+            "api.redgifs.com": HostLimit(1, 1),
+            "redgifs.com": HostLimit(4),
+        },
+        default_limit=HostLimit(3),
+        adaptive=False,
+    )
+
+
+@pytest.mark.parametrize(
+    ("test_host", "expected"),
+    (
+        ("i.imgur.com", ("imgur.com", HostLimit(2, 5))),
+        ("IMGUR.com", ("imgur.com", HostLimit(2, 5))),
+        ("api.redgifs.com", ("api.redgifs.com", HostLimit(1, 1))),
+        ("thumbs2.redgifs.com", ("redgifs.com", HostLimit(4))),
+        ("i.redd.it", ("i.redd.it", HostLimit(3))),
+        ("notimgur.com", ("notimgur.com", HostLimit(3))),
+    ),
+)
+def test_limit_for(test_host: str, expected: tuple[str, HostLimit], scheduler: HostScheduler):
+    assert scheduler.limit_for(test_host) == expected
+
+
+@pytest.mark.parametrize(
+    ("test_entries", "expected"),
+    (
+        ([""], {}),
+        (["i.imgur.com=4"], {"i.imgur.com": HostLimit(4, 0)}),
+        (
+            ["i.imgur.com=4/2, api.redgifs.com=1/0.5"],
+            {"i.imgur.com": HostLimit(4, 2), "api.redgifs.com": HostLimit(1, 0.5)},
+        ),
+        (["I.Imgur.com = 4 / 2;erome.com=2"], {"i.imgur.com": HostLimit(4, 2), "erome.com": HostLimit(2, 0)}),
+    ),
+)
+def test_parse_limits(test_entries: list[str], expected: dict):
+    assert HostScheduler.parse_limits(test_entries) == expected
+
+
+@pytest.mark.parametrize("test_entry", ("i.imgur.com", "i.imgur.com=0", "i.imgur.com=a/2", "=4/2"))
+def test_parse_limits_bad(test_entry: str):
+    with pytest.raises(BulkDownloaderException):
+        HostScheduler.parse_limits([test_entry])
+
+
+@pytest.mark.parametrize(
+    ("test_value", "expected"),
+    (
+        (None, None),
+        ("", None),
+        ("30", 30),
+        ("not a date", None),
+    ),
+)
+def test_parse_retry_after(test_value: str, expected: float):
+    assert HostScheduler.parse_retry_after(test_value) == expected
+
+
+def test_parse_retry_after_date():
+    result = HostScheduler.parse_retry_after(formatdate(time.time() + 120, usegmt=True))
+    assert 110 < result <= 120
+
+
+def test_max_in_flight(scheduler: HostScheduler):
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def request() -> None:
+        nonlocal in_flight, peak
+        with scheduler.slot("thumbs.redgifs.com"):
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 4
+
+
+def test_rate_limit():
+    scheduler = HostScheduler({"imgur.com": HostLimit(10, 20)})
+    start = time.monotonic()
+    for _ in range(21):
+        with scheduler.slot("i.imgur.com"):
+            pass
+    # The bucket starts full, so only the requests past the first burst of 20 are delayed
+    assert time.monotonic() - start == pytest.approx(0.05, abs=0.04)
+
+
+def test_hosts_limited_separately(scheduler: HostScheduler):
+    scheduler.penalise("api.redgifs.com", 10)
+    start = time.monotonic()
+    with scheduler.slot("i.imgur.com"):
+        pass
+    assert time.monotonic() - start < 1
+    assert scheduler.remaining_delay("api.redgifs.com") > 9
+    assert scheduler.remaining_delay("i.imgur.com") == 0
+
+
+def test_penalise_defers_requests(scheduler: HostScheduler):
+    scheduler.penalise("i.imgur.com", 0.2)
+    start = time.monotonic()
+    with pytest.raises(RetryableDownloadError) as exc_info, scheduler.slot("imgur.com"):
+        pass
+    # The request is not held back in place, it fails with the time left to wait
+    assert time.monotonic() - start == pytest.approx(0, abs=0.1)
+    assert exc_info.value.retry_after == pytest.approx(0.2, abs=0.05)
+    time.sleep(0.2)
+    with scheduler.slot("imgur.com"):
+        pass
+
+
+def test_penalise_while_waiting_for_slot(scheduler: HostScheduler):
+    failures = []
+
+    def request() -> None:
+        try:
+            with scheduler.slot("i.imgur.com"):
+                pass
+        except RetryableDownloadError as e:
+            failures.append(e)
+
+    with scheduler.slot("i.imgur.com"), scheduler.slot("i.imgur.com"):
+        waiting = threading.Thread(target=request)
+        waiting.start()
+        time.sleep(0.05)
+        scheduler.penalise("i.imgur.com", 10)
+    waiting.join()
+    assert len(failures) == 1
+
+
+def test_penalise_capped():
+    scheduler = HostScheduler(max_penalty=5)
+    scheduler.penalise("i.imgur.com", 3600)
+    assert scheduler.remaining_delay("i.imgur.com") == pytest.approx(5, abs=0.1)
+
+
+def test_no_host(scheduler: HostScheduler):
+    with scheduler.slot(None), scheduler.suspend(None):
+        pass
+
+
+def test_suspend_gives_up_slot():
+    scheduler = HostScheduler({"imgur.com": HostLimit(1)}, adaptive=False)
+    acquired = threading.Event()
+
+    def request() -> None:
+        with scheduler.slot("imgur.com"):
+            acquired.set()
+
+    with scheduler.slot("imgur.com"):
+        thread = threading.Thread(target=request)
+        thread.start()
+        assert not acquired.wait(timeout=0.2)
+        with scheduler.suspend("imgur.com"):
+            assert acquired.wait(timeout=5)
+            thread.join()
+
+
+def test_acquire_async_waits_for_slot():
+    scheduler = HostScheduler({"imgur.com": HostLimit(1)}, adaptive=False)
+
+    async def acquire() -> None:
+        release = await scheduler.acquire_async("imgur.com")
+        task = asyncio.ensure_future(scheduler.acquire_async("imgur.com"))
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        threading.Thread(target=release).start()
+        (await asyncio.wait_for(task, 5))()
+
+    asyncio.run(acquire())
+    with scheduler.slot("imgur.com"):
+        pass
+
+
+def test_acquire_async_shares_slots_with_threads():
+    scheduler = HostScheduler({"imgur.com": HostLimit(1)}, adaptive=False)
+    acquired = threading.Event()
+
+    def request() -> None:
+        with scheduler.slot("imgur.com"):
+            acquired.set()
+
+    async def acquire() -> None:
+        release = await scheduler.acquire_async("imgur.com")
+        thread = threading.Thread(target=request)
+        thread.start()
+        assert not acquired.wait(timeout=0.2)
+        release()
+        assert acquired.wait(timeout=5)
+        thread.join()
+
+    asyncio.run(acquire())
+
+
+def test_acquire_async_cancelled():
+    scheduler = HostScheduler({"imgur.com": HostLimit(1)}, adaptive=False)
+
+    async def acquire() -> None:
+        release = await scheduler.acquire_async("imgur.com")
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire_async("imgur.com"), 0.05)
+        release()
+        (await asyncio.wait_for(scheduler.acquire_async("imgur.com"), 1))()
+
+    asyncio.run(acquire())
+
+
+def test_acquire_async_paused(scheduler: HostScheduler):
+    scheduler.penalise("imgur.com", 30)
+    with pytest.raises(RetryableDownloadError):
+        asyncio.run(scheduler.acquire_async("i.imgur.com"))
+
+
+def test_suspend_async_gives_up_slot():
+    scheduler = HostScheduler({"imgur.com": HostLimit(1)}, adaptive=False)
+
+    async def suspend() -> None:
+        release = await scheduler.acquire_async("imgur.com")
+        async with scheduler.suspend_async("imgur.com"):
+            (await asyncio.wait_for(scheduler.acquire_async("imgur.com"), 1))()
+        release()
+
+    asyncio.run(suspend())
+
+
+@pytest.fixture()
+def adaptive_scheduler() -> HostScheduler:
+    return HostScheduler({"i.redd.it": HostLimit(8)})
+
+
+def test_adaptive_window_starts_low(adaptive_scheduler: HostScheduler):
+    with adaptive_scheduler.slot("i.redd.it"):
+        pass
+    assert adaptive_scheduler.windows() == {"i.redd.it": 2}
+
+
+def test_adaptive_window_grows(adaptive_scheduler: HostScheduler):
+    for _ in range(100):
+        adaptive_scheduler.record_response("i.redd.it", 200, 0.1)
+    assert adaptive_scheduler.windows() == {"i.redd.it": 8}
+
+
+def test_adaptive_window_holds_on_rising_latency(adaptive_scheduler: HostScheduler):
+    adaptive_scheduler.record_response("i.redd.it", 200, 0.1)
+    for i in range(20):
+        adaptive_scheduler.record_response("i.redd.it", 200, 2**i)
+    assert adaptive_scheduler.windows() == {"i.redd.it": 2}
+
+
+@pytest.mark.parametrize("test_status", (408, 429, 500, 503))
+def test_adaptive_window_backs_off(test_status: int, adaptive_scheduler: HostScheduler):
+    for _ in range(100):
+        adaptive_scheduler.record_response("i.redd.it", 200, 0.1)
+    adaptive_scheduler.record_response("i.redd.it", test_status, 0.1)
+    assert adaptive_scheduler.windows() == {"i.redd.it": 4}
+    # Failures within the same round trip are taken as one congestion event
+    adaptive_scheduler.record_response("i.redd.it", test_status, 0.1)
+    assert adaptive_scheduler.windows() == {"i.redd.it": 4}
+
+
+def test_adaptive_window_ignores_client_errors(adaptive_scheduler: HostScheduler):
+    adaptive_scheduler.record_response("i.redd.it", 404, 0.1)
+    assert adaptive_scheduler.windows() == {"i.redd.it": 2}
+
+
+def test_adaptive_window_minimum(adaptive_scheduler: HostScheduler):
+    adaptive_scheduler.record_failure("i.redd.it")
+    assert adaptive_scheduler.windows() == {"i.redd.it": 1}
+
+
+def test_adaptive_window_limits_in_flight(adaptive_scheduler: HostScheduler):
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def request() -> None:
+        nonlocal in_flight, peak
+        with adaptive_scheduler.slot("i.redd.it"):
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 2
@@ -0,0 +1,120 @@
+import sqlite3
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from bdfrx import schema
+from bdfrx.database import Database
+from bdfrx.exceptions import BulkDownloaderException
+
+
+def _create_legacy_db(path: Path, hash_count: int, post_count: int, link_count: int, algorithm: bool = True) -> None:
+    db = sqlite3.connect(path)
+    algorithm_column = ", algorithm TEXT NOT NULL DEFAULT 'md5'" if algorithm else ""
+    db.execute(f"CREATE TABLE hash (hash TEXT NOT NULL UNIQUE, path TEXT{algorithm_column}, PRIMARY KEY(hash));")
+    db.execute("CREATE TABLE post_id (post_id TEXT NOT NULL UNIQUE, PRIMARY KEY(post_id));")
+    db.execute("CREATE TABLE link (link TEXT NOT NULL UNIQUE, PRIMARY KEY(link));")
+    db.executemany(
+        "INSERT INTO hash (hash, path) VALUES (?, ?);",
+        ((f"{i:032x}", f"/d/{i}.jpg") for i in range(hash_count)),
+    )
+    db.executemany("INSERT INTO post_id (post_id) VALUES (?);", ((f"{i:07x}",) for i in range(post_count)))
+    db.executemany(
+        "INSERT INTO link (link) VALUES (?);",
+        ((f"https://i.redd.it/{i:013x}.jpg",) for i in range(link_count)),
+    )
+    db.commit()
+    db.close()
+
+
+def _tables(db: Database) -> set[str]:
+    return {row[0] for row in db.query("SELECT name FROM sqlite_master WHERE type IN ('table', 'index');")}
+
+
+def test_new_db(tmp_path: Path):
+    db = Database(Path(tmp_path, "test.db"))
+    assert db.query("PRAGMA user_version;").fetchone()[0] == schema.SCHEMA_VERSION
+    assert {"download", "download_post_id", "download_link", "download_hash", "content_metadata"} <= _tables(db)
+    assert {"failure", "failure_next_attempt_at"} <= _tables(db)
+    db.close()
+
+
+def test_upgrade_from_version_2(tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    db = Database(db_path)
+    db.write("INSERT INTO download (status, post_id, recorded_at) VALUES ('downloaded', 'aaaaaa', 0);")
+    db.close()
+    db = sqlite3.connect(db_path)
+    db.execute("DROP TABLE failure;")
+    db.execute("PRAGMA user_version=2;")
+    db.commit()
+    db.close()
+    db = Database(db_path)
+    assert db.query("PRAGMA user_version;").fetchone()[0] == schema.SCHEMA_VERSION
+    assert "failure" in _tables(db)
+    assert db.query("SELECT post_id FROM download;").fetchall() == [("aaaaaa",)]
+    db.close()
+
+
+@pytest.mark.parametrize("test_algorithm_column", (True, False))
+def test_migrate_legacy_db(test_algorithm_column: bool, tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    _create_legacy_db(db_path, 3, 2, 1, test_algorithm_column)
+    db = Database(db_path)
+    assert db.query("PRAGMA user_version;").fetchone()[0] == schema.SCHEMA_VERSION
+    assert not {"hash", "post_id", "link"} & _tables(db)
+    rows = db.query("SELECT status, post_id, link, hash, algorithm, path FROM download ORDER BY id;").fetchall()
+    assert rows == [
+        ("migrated", None, None, f"{0:032x}", "md5", "/d/0.jpg"),
+        ("migrated", None, None, f"{1:032x}", "md5", "/d/1.jpg"),
+        ("migrated", None, None, f"{2:032x}", "md5", "/d/2.jpg"),
+        ("migrated", "0000000", None, None, None, None),
+        ("migrated", "0000001", None, None, None, None),
+        ("migrated", None, "https://i.redd.it/0000000000000.jpg", None, None, None),
+    ]
+    db.close()
+    # Opening it again leaves it as it is
+    db = Database(db_path)
+    assert db.query("SELECT COUNT(*) FROM download;").fetchone()[0] == len(rows)
+    db.close()
+
+
+def test_interrupted_migration(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    db_path = Path(tmp_path, "test.db")
+    _create_legacy_db(db_path, 3, 2, 1)
+    monkeypatch.setattr(schema, "_INDEXES", ("CREATE INDEX broken ON missing (column);",))
+    with pytest.raises(sqlite3.OperationalError):
+        Database(db_path)
+    db = sqlite3.connect(db_path)
+    assert db.execute("PRAGMA user_version;").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM hash;").fetchone()[0] == 3
+    assert not db.execute("SELECT name FROM sqlite_master WHERE name='download';").fetchall()
+    db.close()
+
+
+def test_newer_db(tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    db = sqlite3.connect(db_path)
+    db.execute(f"PRAGMA user_version={schema.SCHEMA_VERSION + 1};")
+    db.close()
+    with pytest.raises(BulkDownloaderException, match="newer version"):
+        Database(db_path)
+
+
+@pytest.mark.slow
+def test_benchmark_migration(tmp_path: Path):
+    db_path = Path(tmp_path, "test.db")
+    _create_legacy_db(db_path, 4_000_000, 3_000_000, 3_000_000)
+    tracemalloc.start()
+    started = time.perf_counter()
+    db = Database(db_path)
+    migration_time = time.perf_counter() - started
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert db.query("SELECT COUNT(*) FROM download;").fetchone()[0] == 10_000_000
+    db.close()
+    print(f"\nMigrated 10000000 rows in {migration_time:.0f}s, with {peak_memory / 2**20:.1f} MiB allocated in Python")
+    assert migration_time < 300
+    assert peak_memory < 2**20
@@ -0,0 +1,74 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.shared_hashes import SharedHashSet, write_hash_file
+
+
+def _md5(content: bytes) -> bytes:
+    return hashlib.md5(content, usedforsecurity=False).digest()
+
+
+@pytest.fixture()
+def digests() -> list[bytes]:
+    return sorted(_md5(str(i).encode()) for i in range(1000))
+
+
+def test_write_and_search(digests: list[bytes], tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    assert write_hash_file(path, digests, "md5") == 1000
+    shared = SharedHashSet(path, "md5")
+    assert len(shared) == 1000
+    assert all(digest.hex() in shared for digest in digests)
+    assert _md5(b"other").hex() not in shared
+    assert "not hex" not in shared
+    assert hashlib.sha256(b"0").hexdigest() not in shared
+    assert [file.name for file in tmp_path.iterdir()] == ["hashes.bin"]
+
+
+def test_write_drops_repeats(digests: list[bytes], tmp_path: Path):
+    assert write_hash_file(Path(tmp_path, "hashes.bin"), [digests[0], digests[0], digests[1]], "md5") == 2
+
+
+def test_write_out_of_order(digests: list[bytes], tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    with pytest.raises(BulkDownloaderException, match="in order"):
+        write_hash_file(path, reversed(digests), "md5")
+    assert not list(tmp_path.iterdir())
+
+
+def test_empty_file(tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    write_hash_file(path, [], "md5")
+    shared = SharedHashSet(path, "md5")
+    assert len(shared) == 0
+    assert _md5(b"0").hex() not in shared
+
+
+def test_other_algorithm_ignored(digests: list[bytes], tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    write_hash_file(path, digests, "md5")
+    assert digests[0].hex() not in SharedHashSet(path, "sha1")
+
+
+def test_not_a_hash_file(tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    path.write_bytes(b"something else entirely, longer than a header")
+    with pytest.raises(BulkDownloaderException, match="not a hash file"):
+        SharedHashSet(path, "md5")
+
+
+def test_replaced_file_picked_up(digests: list[bytes], tmp_path: Path):
+    path = Path(tmp_path, "hashes.bin")
+    shared = SharedHashSet(path, "md5")
+    shared.refresh_interval = 0
+    assert digests[0].hex() not in shared
+    write_hash_file(path, digests[:10], "md5")
+    assert digests[0].hex() in shared
+    assert digests[10].hex() not in shared
+    write_hash_file(path, digests[10:], "md5")
+    assert digests[0].hex() not in shared
+    assert digests[10].hex() in shared
+    assert len(shared) == 990
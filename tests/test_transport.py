@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from bdfrx.exceptions import BulkDownloaderException
+from bdfrx.scheduler import HostLimit, HostScheduler
+from bdfrx.transport import AsyncTransport, ConnectionStats, RequestsTransport, Transport, create_transport
+
+TEST_BODY = bytes(range(256)) * 1024
+
+
+class _TestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *_) -> None:
+        pass
+
+    def _send(self, code: int, body: bytes) -> None:
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path == "/missing":
+            self._send(404, b"not found")
+        elif self.path == "/unavailable":
+            self._send(503, b"unavailable")
+        elif self.path == "/limited":
+            self.send_response(429)
+            self.send_header("Retry-After", "30")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/set-cookie":
+            self.send_response(200)
+            self.send_header("Set-Cookie", "session=value; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/headers":
+            self._send(200, json.dumps(dict(self.headers)).encode())
+        else:
+            self._send(200, TEST_BODY)
+
+    def do_HEAD(self) -> None:  # noqa: N802
+        self.do_GET()
+
+    def do_POST(self) -> None:  # noqa: N802
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self._send(200, body)
+
+
+@pytest.fixture(scope="module")
+def server_url() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _TestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(params=("requests", "async"))
+def transport(request: pytest.FixtureRequest) -> Iterator[Transport]:
+    if request.param == "async":
+        pytest.importorskip("aiohttp")
+        out = AsyncTransport()
+    else:
+        out = RequestsTransport()
+    yield out
+    out.close()
+
+
+def test_get(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/file")
+    assert response.status_code == 200
+    assert response.content == TEST_BODY
+    assert response.headers["content-length"] == str(len(TEST_BODY))
+
+
+def test_get_stream(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/file", stream=True)
+    assert b"".join(response.iter_content(chunk_size=1000)) == TEST_BODY
+    response.close()
+
+
+def test_get_follows_redirect(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/redirect")
+    assert response.url == f"{server_url}/file"
+    assert response.content == TEST_BODY
+
+
+def test_get_headers(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/headers", headers={"X-Test": "value"})
+    assert response.json()["X-Test"] == "value"
+
+
+def test_get_missing(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/missing")
+    assert response.status_code == 404
+    assert response.text == "not found"
+
+
+def test_head(transport: Transport, server_url: str):
+    response = transport.head(f"{server_url}/redirect")
+    assert response.status_code == 302
+    assert not response.content
+
+
+def test_post(transport: Transport, server_url: str):
+    response = transport.post(f"{server_url}/echo", payload={"test": 1})
+    assert response.json() == {"test": 1}
+
+
+def test_connection_error(transport: Transport):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        transport.get("http://127.0.0.1:1/", timeout=2)
+
+
+def test_connection_reuse(transport: Transport, server_url: str):
+    for _ in range(5):
+        transport.get(f"{server_url}/file")
+    assert sum(transport.stats.requests.values()) == 5
+    assert sum(transport.stats.connections.values()) == 1
+    assert transport.stats.reuse_rate == pytest.approx(0.8)
+
+
+def test_cookies_not_kept(transport: Transport, server_url: str):
+    # Cookies are not kept for IP addresses in any case, so they are set for a host name
+    server_url = server_url.replace("127.0.0.1", "localhost")
+    response = transport.get(f"{server_url}/headers", cookies={"test": "value"})
+    assert response.json()["Cookie"] == "test=value"
+    transport.get(f"{server_url}/set-cookie")
+    response = transport.get(f"{server_url}/headers")
+    assert "Cookie" not in response.json()
+
+
+@pytest.mark.parametrize(
+    ("test_requests", "test_connections", "expected"),
+    (
+        ({}, {}, 0.0),
+        ({"a": 4}, {"a": 1}, 0.75),
+        ({"a": 2, "b": 2}, {"a": 1, "b": 1}, 0.5),
+        ({"a": 1}, {"a": 3}, 0.0),
+    ),
+)
+def test_connection_stats_reuse_rate(test_requests: dict, test_connections: dict, expected: float):
+    stats = ConnectionStats()
+    for host, count in test_requests.items():
+        for _ in range(count):
+            stats.record_request(host)
+    for host, count in test_connections.items():
+        for _ in range(count):
+            stats.record_connection(host)
+    assert stats.reuse_rate == pytest.approx(expected)
+
+
+def test_rate_limit_penalises_host(transport: Transport, server_url: str):
+    response = transport.get(f"{server_url}/limited")
+    assert response.status_code == 429
+    assert 25 < transport.scheduler.remaining_delay("127.0.0.1") <= 30
+    assert transport.scheduler.remaining_delay("localhost") == 0
+
+
+def test_server_error_lowers_window(transport: Transport, server_url: str):
+    for _ in range(10):
+        transport.get(f"{server_url}/file")
+    window = transport.scheduler.windows()["127.0.0.1"]
+    transport.get(f"{server_url}/unavailable")
+    assert transport.scheduler.windows()["127.0.0.1"] == max(1, window // 2)
+
+
+def _request_in_thread(transport: Transport, url: str) -> threading.Event:
+    done = threading.Event()
+
+    def request() -> None:
+        transport.get(url)
+        done.set()
+
+    threading.Thread(target=request, daemon=True).start()
+    return done
+
+
+def test_stream_holds_host_slot(transport: Transport, server_url: str):
+    transport.scheduler = HostScheduler({"127.0.0.1": HostLimit(1)}, adaptive=False)
+    response = transport.get(f"{server_url}/file", stream=True)
+    done = _request_in_thread(transport, f"{server_url}/file")
+    assert not done.wait(timeout=0.3)
+    assert b"".join(response.iter_content(chunk_size=1000)) == TEST_BODY
+    response.close()
+    assert done.wait(timeout=5)
+
+
+def test_request_releases_host_slot(transport: Transport, server_url: str):
+    transport.scheduler = HostScheduler({"127.0.0.1": HostLimit(1)}, adaptive=False)
+    transport.get(f"{server_url}/file")
+    assert _request_in_thread(transport, f"{server_url}/file").wait(timeout=5)
+
+
+@pytest.fixture()
+def async_transport() -> Iterator[AsyncTransport]:
+    pytest.importorskip("aiohttp")
+    transport = AsyncTransport(max_tasks=2)
+    yield transport
+    transport.close()
+
+
+def test_get_async(async_transport: AsyncTransport, server_url: str):
+    async def get() -> tuple[int, bytes]:
+        response = await async_transport.get_async(f"{server_url}/file")
+        try:
+            body = b"".join([chunk async for chunk in async_transport.iter_content_async(response, 1000)])
+        finally:
+            response.close()
+        return response.status_code, body
+
+    assert async_transport.run(get()) == (200, TEST_BODY)
+
+
+def test_get_async_holds_host_slot(async_transport: AsyncTransport, server_url: str):
+    async_transport.scheduler = HostScheduler({"127.0.0.1": HostLimit(1)}, adaptive=False)
+    response = async_transport.run(async_transport.get_async(f"{server_url}/file"))
+    done = _request_in_thread(async_transport, f"{server_url}/file")
+    assert not done.wait(timeout=0.3)
+    response.close()
+    assert done.wait(timeout=5)
+
+
+def test_get_async_connection_error(async_transport: AsyncTransport):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        async_transport.run(async_transport.get_async("http://127.0.0.1:1/", timeout=2))
+
+
+def test_submit_limits_tasks(async_transport: AsyncTransport):
+    running = 0
+    peak = 0
+
+    async def task() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    futures = [async_transport.submit(task()) for _ in range(10)]
+    for future in futures:
+        future.result(timeout=5)
+    assert peak == 2
+
+
+def test_create_transport():
+    assert isinstance(create_transport("requests"), RequestsTransport)
+    transport = create_transport("requests", pool_size=3, retries=5, timeout=2)
+    assert (transport.pool_size, transport.retries, transport.timeout) == (3, 5, 2)
+    with pytest.raises(BulkDownloaderException):
+        create_transport("random")